@@ -2,7 +2,7 @@ import sys
 import mysql.connector
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QMessageBox, QInputDialog
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from PyQt5.QtCore import QUrl, Qt, QObject, pyqtSlot
+from PyQt5.QtCore import QUrl, Qt, QObject, pyqtSlot, pyqtSignal
 from PyQt5.QtWebChannel import QWebChannel
 from login import Ui_MainWindow as Ui_LoginMainWindow
 from admin_interface import Ui_MainWindow as Ui_AdminMainWindow
@@ -10,8 +10,12 @@ from user_interface import Ui_MainWindow as Ui_UserMainWindow
 import os
 import json
 import logging
-from graph_utils import find_nearest_way, load_graph
+from graph_utils import find_nearest_way
+from graph_registry import graph_registry, GRAPH_FILE
 from routing import find_route
+from traffic import invalidate_traffic_snapshot
+from traffic_layer import TRAFFIC_COLORS, TRAFFIC_LAYER_JS, render_traffic_rows
+from map_scheme import register_map_scheme, install_map_scheme, leaflet_asset_url, TILE_URL, TILE_FALLBACK_JS
 
 # Thiết lập logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -42,6 +46,38 @@ class Bridge(QObject):
         else:
             logging.warning(f"findNearestWay not implemented in {type(self.parent).__name__}")
 
+class GraphStatusNotifier(QObject):
+    """Chuyển thông báo tải xong đồ thị (từ luồng nền của graph_registry) về luồng giao diện."""
+    ready = pyqtSignal(bool, str)
+
+    def notify(self, graph, error):
+        if error is None:
+            self.ready.emit(True, "Đồ thị đường đi đã sẵn sàng")
+        else:
+            self.ready.emit(False, f"Không thể tải đồ thị: {error}")
+
+def watch_graph_status(window):
+    """Hiện trạng thái tải đồ thị dùng chung trên thanh trạng thái của cửa sổ."""
+    if not graph_registry.is_ready(GRAPH_FILE):
+        window.statusBar().showMessage("Đang tải đồ thị đường đi...")
+    window.graph_notifier = GraphStatusNotifier(window)
+    window.graph_notifier.ready.connect(lambda ok, message: window.statusBar().showMessage(message, 5000))
+    graph_registry.when_ready(window.graph_notifier.notify, GRAPH_FILE)
+
+def shared_graph(window):
+    """
+    Đồ thị dùng chung nếu đã tải xong, không chờ trên luồng giao diện: khi đang tải thì hiện
+    trạng thái và trả về None (thanh trạng thái báo khi sẵn sàng). Lần tải lỗi được thử lại trên luồng nền.
+    """
+    failed = graph_registry.status(GRAPH_FILE) == 'failed'
+    future = graph_registry.preload(GRAPH_FILE)
+    if future.done():
+        return future.result()
+    if failed:
+        graph_registry.when_ready(window.graph_notifier.notify, GRAPH_FILE)
+    window.statusBar().showMessage("Đang tải đồ thị đường đi...")
+    return None
+
 class LoginMainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -49,6 +85,8 @@ class LoginMainWindow(QMainWindow):
         self.ui.setupUi(self)
 
         self.ui.loginButton.clicked.connect(self.check_login)
+        # Tải nền đồ thị dùng chung ngay khi hiện màn hình đăng nhập (không tải lại sau khi đăng xuất)
+        graph_registry.preload(GRAPH_FILE)
 
         try:
             self.db = mysql.connector.connect(
@@ -129,7 +167,7 @@ class AdminMainWindow(QMainWindow):
             'password': '',
             'database': 'map_app'
         }
-        self.graph = None  # Khởi tạo graph là None
+        self.graph = None  # Đồ thị dùng chung lấy từ graph_registry khi cần
 
         self.setWindowFlags(Qt.Window | Qt.WindowMinMaxButtonsHint | Qt.WindowCloseButtonHint)
         self.setMinimumSize(800, 600)
@@ -154,6 +192,7 @@ class AdminMainWindow(QMainWindow):
         self.create_initial_map()
         self.ui.editTrafficButton.clicked.connect(self.toggle_traffic_editing)
         self.ui.deleteButton.clicked.connect(self.delete_traffic_editing)
+        watch_graph_status(self)
         logging.info("Khởi tạo AdminMainWindow thành công")
 
     def create_initial_map(self):
@@ -169,7 +208,7 @@ class AdminMainWindow(QMainWindow):
                 <head>
                     <meta charset="utf-8">
                     <title>Bản đồ cố định</title>
-                    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
+                    <link rel="stylesheet" href="{leaflet_asset_url('leaflet.css')}" />
                     <style>
                         #map {{
                             position: absolute;
@@ -192,7 +231,7 @@ class AdminMainWindow(QMainWindow):
                 <body>
                     <div id="map"></div>
                     
-                    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+                    <script src="{leaflet_asset_url('leaflet.js')}"></script>
                     <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
                     <script>
                         var map = L.map('map', {{
@@ -207,13 +246,14 @@ class AdminMainWindow(QMainWindow):
                             zoomDelta: 0
                         }}).setView([{(min_lat + max_lat)/2}, {(min_lon + max_lon)/2}], 18);
                         
-                        L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
+                        var baseTiles = L.tileLayer('{TILE_URL}', {{
                             attribution: '© OpenStreetMap',
                             noWrap: true,
                             bounds: [[{min_lat}, {min_lon}], [{max_lat}, {max_lon}]],
                             minZoom: 18,
                             maxZoom: 18
                         }}).addTo(map);
+                        {TILE_FALLBACK_JS}
                         
                         var currentMapClick = null;
                         var highlightedWay = null;
@@ -230,6 +270,7 @@ class AdminMainWindow(QMainWindow):
                         if (!window.highlightedWays) {{
                             window.highlightedWays = {{}};
                         }}
+                        {TRAFFIC_LAYER_JS}
                     </script>
                 </body>
             </html>
@@ -256,6 +297,7 @@ class AdminMainWindow(QMainWindow):
             QMessageBox.critical(self, "Lỗi", "Không thể tải bản đồ")
 
     def highlight_traffic_changes(self):
+        """Tô mọi đoạn đường trong traffic_changes bằng một lần gọi JavaScript. Trả về {way_id: lý do} của các dòng lỗi."""
         try:
             if not self.db.is_connected():
                 logging.warning("CSDL không kết nối, thử kết nối lại trong highlight_traffic_changes")
@@ -266,46 +308,17 @@ class AdminMainWindow(QMainWindow):
             query = "SELECT DISTINCT way_id, coordinates, traffic_type FROM traffic_changes WHERE coordinates IS NOT NULL"
             self.cursor.execute(query)
             ways = self.cursor.fetchall()
-            logging.info(f"Lấy được {len(ways)} way_id từ traffic_changes: {[w['way_id'] for w in ways]}")
-
-            failed_ways = []
-            for way in ways:
-                way_id = way['way_id']
-                traffic_type = way['traffic_type']
-                if way_id not in self.highlighted_ways:
-                    try:
-                        coords = json.loads(way['coordinates'])
-                        if isinstance(coords, list) and all(isinstance(c, list) and len(c) == 2 for c in coords):
-                            color = {'slow': '#FFA500', 'blocked': 'red', 'closed': 'black'}.get(traffic_type, 'red')
-                            coords_json = json.dumps(coords)
-                            self.web_view.page().runJavaScript(f"""
-                                if (!window.highlightedWays) {{
-                                    window.highlightedWays = {{}};
-                                }}
-                                if (window.highlightedWays['{way_id}']) {{
-                                    map.removeLayer(window.highlightedWays['{way_id}']);
-                                }}
-                                window.highlightedWays['{way_id}'] = L.polyline({coords_json}, {{
-                                    color: '{color}',
-                                    weight: 5,
-                                    opacity: 0.8
-                                }}).addTo(map);
-                            """)
-                            self.highlighted_ways.add(way_id)
-                            logging.info(f"Highlighted way_id={way_id} with {len(coords)} coordinates, traffic_type={traffic_type}, color={color}")
-                        else:
-                            logging.warning(f"Tọa độ không hợp lệ cho way_id={way_id}")
-                            failed_ways.append(way_id)
-                    except json.JSONDecodeError as e:
-                        logging.error(f"Lỗi giải mã JSON cho way_id={way_id}: {e}")
-                        failed_ways.append(way_id)
-
-            if failed_ways:
+            logging.info(f"Lấy được {len(ways)} dòng từ traffic_changes")
+
+            way_ids, failures = render_traffic_rows(self.web_view.page(), ways, skip=self.highlighted_ways)
+            self.highlighted_ways.update(way_ids)
+            if failures:
                 QMessageBox.warning(
                     self,
                     "Cảnh báo",
-                    f"Không thể highlight các đoạn đường sau do tọa độ không hợp lệ: {', '.join(failed_ways)}"
+                    f"Không thể highlight {len(failures)} đoạn đường do tọa độ không hợp lệ: {', '.join(failures)}"
                 )
+            return failures
 
         except mysql.connector.Error as err:
             logging.error(f"Lỗi truy vấn CSDL trong highlight_traffic_changes: {err}")
@@ -329,11 +342,11 @@ class AdminMainWindow(QMainWindow):
 
     def find_nearest_way(self, marker_lat, marker_lon):
         try:
-            # Tải đồ thị nếu chưa có (lazy loading)
+            # Đồ thị dùng chung tải nền từ màn hình đăng nhập; chưa xong thì không chờ
             if self.graph is None:
-                self.graph = load_graph('road_network.graphml')
+                self.graph = shared_graph(self)
                 if self.graph is None:
-                    raise Exception("Không thể tải đồ thị")
+                    return
 
             way_id, way_nodes = find_nearest_way(marker_lat, marker_lon, self.graph)
             if way_id and way_nodes:
@@ -380,7 +393,7 @@ class AdminMainWindow(QMainWindow):
                     self.selected_way_id = way_id
                     self.selected_coords = way_nodes
                     self.selected_traffic_type = traffic_type
-                    color = {'slow': '#FFA500', 'blocked': 'red', 'closed': 'black'}[traffic_type]
+                    color = TRAFFIC_COLORS[traffic_type]
                     coords_json = json.dumps(way_nodes)
                     self.web_view.page().runJavaScript(f"""
                         if (window.highlightedWay) {{
@@ -486,26 +499,14 @@ class AdminMainWindow(QMainWindow):
                     coordinates_json
                 ))
                 self.db.commit()
+                invalidate_traffic_snapshot()
                 logging.info(f"Đã lưu way_id={self.selected_way_id} với {len(self.selected_coords)} tọa độ, traffic_type={self.selected_traffic_type} vào CSDL")
 
                 if self.selected_way_id not in self.highlighted_ways:
-                    color = {'slow': '#FFA500', 'blocked': 'red', 'closed': 'black'}[self.selected_traffic_type]
-                    coords_json = json.dumps(self.selected_coords)
-                    self.web_view.page().runJavaScript(f"""
-                        if (!window.highlightedWays) {{
-                            window.highlightedWays = {{}};
-                        }}
-                        if (window.highlightedWays['{self.selected_way_id}']) {{
-                            map.removeLayer(window.highlightedWays['{self.selected_way_id}']);
-                        }}
-                        window.highlightedWays['{self.selected_way_id}'] = L.polyline({coords_json}, {{
-                            color: '{color}',
-                            weight: 5,
-                            opacity: 0.8
-                        }}).addTo(map);
-                    """)
-                    self.highlighted_ways.add(self.selected_way_id)
-                    logging.info(f"Highlighted new way_id={self.selected_way_id} với {len(self.selected_coords)} coordinates, traffic_type={self.selected_traffic_type}, color={color}")
+                    row = {'way_id': self.selected_way_id, 'coordinates': coordinates_json,
+                           'traffic_type': self.selected_traffic_type}
+                    way_ids, _ = render_traffic_rows(self.web_view.page(), [row])
+                    self.highlighted_ways.update(way_ids)
 
                 QMessageBox.information(self, "Thông báo", f"Đã lưu thay đổi giao thông: {self.selected_traffic_type}!")
             except mysql.connector.Error as err:
@@ -560,6 +561,7 @@ class AdminMainWindow(QMainWindow):
                 query = "DELETE FROM traffic_changes WHERE way_id = %s"
                 self.cursor.execute(query, (self.selected_way_id,))
                 self.db.commit()
+                invalidate_traffic_snapshot()
                 logging.info(f"Đã xóa way_id={self.selected_way_id} khỏi traffic_changes")
 
                 self.web_view.page().runJavaScript(f"""
@@ -567,10 +569,7 @@ class AdminMainWindow(QMainWindow):
                         map.removeLayer(window.highlightedWay);
                         window.highlightedWay = null;
                     }}
-                    if (window.highlightedWays['{self.selected_way_id}']) {{
-                        map.removeLayer(window.highlightedWays['{self.selected_way_id}']);
-                        delete window.highlightedWays['{self.selected_way_id}'];
-                    }}
+                    window.removeTrafficWay({json.dumps(str(self.selected_way_id))});
                 """)
                 if self.selected_way_id in self.highlighted_ways:
                     self.highlighted_ways.remove(self.selected_way_id)
@@ -602,10 +601,9 @@ class AdminMainWindow(QMainWindow):
             if (window.highlightedWay) {
                 map.removeLayer(window.highlightedWay);
             }
-            for (var way_id in window.highlightedWays) {
-                if (window.highlightedWays[way_id]) {
-                    map.removeLayer(window.highlightedWays[way_id]);
-                }
+            if (window.trafficLayer) {
+                window.trafficLayer.clearLayers();
+                window.highlightedWays = {};
             }
         """)
         if hasattr(self, 'temp_file') and os.path.exists(self.temp_file):
@@ -614,7 +612,7 @@ class AdminMainWindow(QMainWindow):
             self.cursor.close()
             self.db.close()
             logging.info("Đóng kết nối CSDL trong AdminMainWindow")
-        # Giải phóng đồ thị
+        # Bỏ tham chiếu tới đồ thị dùng chung (graph_registry vẫn giữ cho lần đăng nhập sau)
         self.graph = None
         event.accept()
 
@@ -632,7 +630,7 @@ class UserMainWindow(QMainWindow):
             'password': '',
             'database': 'map_app'
         }
-        self.graph = None  # Khởi tạo graph là None
+        self.graph = None  # Đồ thị dùng chung lấy từ graph_registry khi cần
 
         self.setWindowFlags(Qt.Window | Qt.WindowMinMaxButtonsHint | Qt.WindowCloseButtonHint)
         self.setMinimumSize(800, 600)
@@ -657,6 +655,7 @@ class UserMainWindow(QMainWindow):
 
         self.ui.directionButton.clicked.connect(self.find_direction)
         self.ui.markButton.clicked.connect(self.add_marker)
+        watch_graph_status(self)
         logging.info("Khởi tạo UserMainWindow thành công")
 
     def create_initial_map(self):
@@ -672,7 +671,7 @@ class UserMainWindow(QMainWindow):
                 <head>
                     <meta charset="utf-8">
                     <title>Bản đồ cố định</title>
-                    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
+                    <link rel="stylesheet" href="{leaflet_asset_url('leaflet.css')}" />
                     <style>
                         #map {{
                             position: absolute;
@@ -695,7 +694,7 @@ class UserMainWindow(QMainWindow):
                 <body>
                     <div id="map"></div>
                     
-                    <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
+                    <script src="{leaflet_asset_url('leaflet.js')}"></script>
                     <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
                     <script>
                         var map = L.map('map', {{
@@ -710,13 +709,14 @@ class UserMainWindow(QMainWindow):
                             zoomDelta: 0
                         }}).setView([{(min_lat + max_lat)/2}, {(min_lon + max_lon)/2}], 18);
                         
-                        L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
+                        var baseTiles = L.tileLayer('{TILE_URL}', {{
                             attribution: '© OpenStreetMap',
                             noWrap: true,
                             bounds: [[{min_lat}, {min_lon}], [{max_lat}, {max_lon}]],
                             minZoom: 18,
                             maxZoom: 18
                         }}).addTo(map);
+                        {TILE_FALLBACK_JS}
                         
                         window.markers = [];
                         window.currentMapClick = null;
@@ -734,6 +734,7 @@ class UserMainWindow(QMainWindow):
                         if (!window.highlightedWays) {{
                             window.highlightedWays = {{}};
                         }}
+                        {TRAFFIC_LAYER_JS}
                     </script>
                 </body>
             </html>
@@ -760,6 +761,7 @@ class UserMainWindow(QMainWindow):
             QMessageBox.critical(self, "Lỗi", "Không thể tải bản đồ")
 
     def highlight_traffic_changes(self):
+        """Tô mọi đoạn đường trong traffic_changes bằng một lần gọi JavaScript. Trả về {way_id: lý do} của các dòng lỗi."""
         try:
             if not self.db.is_connected():
                 logging.warning("CSDL không kết nối, thử kết nối lại trong highlight_traffic_changes (UserMainWindow)")
@@ -770,46 +772,17 @@ class UserMainWindow(QMainWindow):
             query = "SELECT DISTINCT way_id, coordinates, traffic_type FROM traffic_changes WHERE coordinates IS NOT NULL"
             self.cursor.execute(query)
             ways = self.cursor.fetchall()
-            logging.info(f"Lấy được {len(ways)} way_id từ traffic_changes (UserMainWindow): {[w['way_id'] for w in ways]}")
-
-            failed_ways = []
-            for way in ways:
-                way_id = way['way_id']
-                traffic_type = way['traffic_type']
-                if way_id not in self.highlighted_ways:
-                    try:
-                        coords = json.loads(way['coordinates'])
-                        if isinstance(coords, list) and all(isinstance(c, list) and len(c) == 2 for c in coords):
-                            color = {'slow': '#FFA500', 'blocked': 'red', 'closed': 'black'}.get(traffic_type, 'red')
-                            coords_json = json.dumps(coords)
-                            self.web_view.page().runJavaScript(f"""
-                                if (!window.highlightedWays) {{
-                                    window.highlightedWays = {{}};
-                                }}
-                                if (window.highlightedWays['{way_id}']) {{
-                                    map.removeLayer(window.highlightedWays['{way_id}']);
-                                }}
-                                window.highlightedWays['{way_id}'] = L.polyline({coords_json}, {{
-                                    color: '{color}',
-                                    weight: 5,
-                                    opacity: 0.8
-                                }}).addTo(map);
-                            """)
-                            self.highlighted_ways.add(way_id)
-                            logging.info(f"Highlighted way_id={way_id} with {len(coords)} coordinates (UserMainWindow), traffic_type={traffic_type}, color={color}")
-                        else:
-                            logging.warning(f"Tọa độ không hợp lệ cho way_id={way_id} (UserMainWindow)")
-                            failed_ways.append(way_id)
-                    except json.JSONDecodeError as e:
-                        logging.error(f"Lỗi giải mã JSON cho way_id={way_id} (UserMainWindow): {e}")
-                        failed_ways.append(way_id)
-
-            if failed_ways:
+            logging.info(f"Lấy được {len(ways)} dòng từ traffic_changes (UserMainWindow)")
+
+            way_ids, failures = render_traffic_rows(self.web_view.page(), ways, skip=self.highlighted_ways)
+            self.highlighted_ways.update(way_ids)
+            if failures:
                 QMessageBox.warning(
                     self,
                     "Cảnh báo",
-                    f"Không thể highlight các đoạn đường sau do tọa độ không hợp lệ: {', '.join(failed_ways)}"
+                    f"Không thể highlight {len(failures)} đoạn đường do tọa độ không hợp lệ: {', '.join(failures)}"
                 )
+            return failures
 
         except mysql.connector.Error as err:
             logging.error(f"Lỗi truy vấn CSDL trong highlight_traffic_changes (UserMainWindow): {err}")
@@ -848,9 +821,9 @@ class UserMainWindow(QMainWindow):
         marker_js = f"""
             var newMarker = L.marker([{lat}, {lng}], {{
                 icon: L.icon({{
-                    iconUrl: 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.7.1/images/marker-icon.png',
-                    iconRetinaUrl: 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.7.1/images/marker-icon-2x.png',
-                    shadowUrl: 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.7.1/images/marker-shadow.png',
+                    iconUrl: '{leaflet_asset_url('images/marker-icon.png')}',
+                    iconRetinaUrl: '{leaflet_asset_url('images/marker-icon-2x.png')}',
+                    shadowUrl: '{leaflet_asset_url('images/marker-shadow.png')}',
                     iconSize: [25, 41],
                     iconAnchor: [12, 41],
                     popupAnchor: [1, -34]
@@ -882,16 +855,16 @@ class UserMainWindow(QMainWindow):
         start_lat, start_lng = self.start
         end_lat, end_lng = self.end
 
-        # Tải đồ thị nếu chưa có (lazy loading)
+        # Đồ thị dùng chung tải nền từ màn hình đăng nhập; chưa xong thì không chờ
         try:
             if self.graph is None:
-                self.graph = load_graph('road_network.graphml')
-                if self.graph is None:
-                    raise Exception("Không thể tải đồ thị")
+                self.graph = shared_graph(self)
         except Exception as e:
             logging.error(f"Lỗi tải đồ thị: {e}")
             QMessageBox.critical(self, "Lỗi", f"Không thể tải đồ thị: {str(e)}")
             return
+        if self.graph is None:
+            return
 
         route = find_route(start_lat, start_lng, end_lat, end_lng, self.graph)
 
@@ -922,10 +895,9 @@ class UserMainWindow(QMainWindow):
             if (window.directionLine) {
                 map.removeLayer(window.directionLine);
             }
-            for (var way_id in window.highlightedWays) {
-                if (window.highlightedWays[way_id]) {
-                    map.removeLayer(window.highlightedWays[way_id]);
-                }
+            if (window.trafficLayer) {
+                window.trafficLayer.clearLayers();
+                window.highlightedWays = {};
             }
             window.markers.forEach(function(marker) {
                 if (marker) {
@@ -939,12 +911,15 @@ class UserMainWindow(QMainWindow):
             self.cursor.close()
             self.db.close()
             logging.info("Đóng kết nối CSDL trong UserMainWindow")
-        # Giải phóng đồ thị
+        # Bỏ tham chiếu tới đồ thị dùng chung (graph_registry vẫn giữ cho lần đăng nhập sau)
         self.graph = None
         event.accept()
 
 if __name__ == "__main__":
+    # Scheme mapapp (tile và Leaflet ngoại tuyến) phải đăng ký trước khi tạo QApplication
+    register_map_scheme()
     app = QApplication(sys.argv)
+    install_map_scheme()
     login_window = LoginMainWindow()
     login_window.show()
     sys.exit(app.exec_())
\ No newline at end of file
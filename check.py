@@ -1,146 +1,334 @@
+import sys
+import json
+import time
+import argparse
 import networkx as nx
+import numpy as np
 import xml.etree.ElementTree as ET
 import folium
 import logging
-import json
-from collections import defaultdict
+from array import array
+from way_table import ensure_way_table
+from edge_geometry import ensure_edge_geometry, edge_points
+from graph_cache import load_graph_cache
+from osm_graph_builder import BBoxArea, DEFAULT_BBOX, load_polygon
 
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+VEHICLE_HIGHWAYS = {
+    'motorway', 'trunk', 'primary', 'secondary', 'tertiary',
+    'unclassified', 'residential', 'service', 'track',
+    'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link'
+}
+COORD_TOLERANCE = 1e-6  # độ
+MAX_EXAMPLES = 20  # Số ví dụ mỗi loại sai khác ghi trong báo cáo
+
+def coord_keys(lat, lon):
+    """Khóa số nguyên của tọa độ làm tròn 1e-7 độ (độ chính xác của OSM), dùng để khớp điểm hình học với node OSM."""
+    lat_i = np.rint(np.asarray(lat, dtype=np.float64) * 1e7).astype(np.int64) + 900_000_000
+    lon_i = np.rint(np.asarray(lon, dtype=np.float64) * 1e7).astype(np.int64) + 1_800_000_000
+    return (lat_i << 32) | lon_i
+
+class OsmData:
+    """
+    Node và way đường xe đọc từ file OSM, lưu dạng mảng: node sắp theo id (tra bằng
+    searchsorted), dãy node của các way nối phẳng theo offsets.
+    """
+    def __init__(self, node_ids, lat, lon, way_ids, highways, oneway, way_offsets, way_refs):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.way_ids = way_ids
+        self.highways = highways
+        self.oneway = oneway
+        self.way_offsets = way_offsets
+        self.way_refs = way_refs
+
+    def node_index(self, ids):
+        """Vị trí của các id trong mảng node (-1 nếu file OSM không có node đó)."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.node_ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.node_ids, ids), len(self.node_ids) - 1)
+        return np.where(self.node_ids[index] == ids, index, -1)
+
 def load_graphml(graphml_file):
-    """Tải đồ thị từ file GraphML."""
+    """Tải đồ thị từ cache nhị phân (nếu còn khớp) hoặc file GraphML."""
     logging.info(f"Tải đồ thị từ {graphml_file}")
-    G = nx.read_graphml(graphml_file, node_type=int)
-    for node, data in G.nodes(data=True):
-        data['lat'] = float(data['lat'])
-        data['lon'] = float(data['lon'])
+    G = load_graph_cache(graphml_file)
+    if G is None:
+        G = nx.read_graphml(graphml_file, node_type=int)
+        for node, data in G.nodes(data=True):
+            data['lat'] = float(data['lat'])
+            data['lon'] = float(data['lon'])
+        ensure_way_table(G)
+        ensure_edge_geometry(G)
     logging.info(f"Đồ thị GraphML: {G.number_of_nodes()} node, {G.number_of_edges()} cạnh")
     return G
 
 def parse_osm_file(osm_file):
-    """Đọc file OSM, trích xuất node và way, chỉ lấy các highway dành cho xe."""
+    """
+    Đọc file OSM XML theo luồng (iterparse, giải phóng từng phần tử sau khi đọc),
+    giữ mọi node và các way đường xe.
+    """
     logging.info(f"Đọc file OSM: {osm_file}")
-    tree = ET.parse(osm_file)
-    root = tree.getroot()
-
-    nodes = {}
-    ways = []
-    
-    # Đọc node
-    for node in root.findall('node'):
-        node_id = int(node.get('id'))
-        lat = float(node.get('lat'))
-        lon = float(node.get('lon'))
-        nodes[node_id] = {'lat': lat, 'lon': lon}
-    
-    # Đọc way, chỉ lấy các highway dành cho xe
-    vehicle_highways = [
-        'motorway', 'trunk', 'primary', 'secondary', 'tertiary',
-        'unclassified', 'residential', 'service', 'track',
-        'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link'
-    ]
-    for way in root.findall('way'):
-        way_id = int(way.get('id'))
-        way_nodes = [int(nd.get('ref')) for nd in way.findall('nd')]
-        tags = {tag.get('k'): tag.get('v') for tag in way.findall('tag')}
-        if 'highway' in tags and tags['highway'] in vehicle_highways:
-            ways.append({'id': way_id, 'nodes': way_nodes, 'tags': tags})
-            logging.info(f"Thêm way {way_id} với highway={tags['highway']}")
-        else:
-            logging.info(f"Bỏ qua way {way_id} vì không phải đường xe: highway={tags.get('highway')}")
+    node_ids, lat, lon = array('q'), array('d'), array('d')
+    way_ids, highways, oneway = [], [], bytearray()
+    way_offsets, way_refs = array('q', [0]), array('q')
+    skipped = 0
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'node':
+            node_ids.append(int(elem.get('id')))
+            lat.append(float(elem.get('lat')))
+            lon.append(float(elem.get('lon')))
+            root.clear()
+        elif elem.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if tags.get('highway') in VEHICLE_HIGHWAYS:
+                way_ids.append(int(elem.get('id')))
+                highways.append(tags['highway'])
+                oneway.append(1 if tags.get('oneway', 'no') == 'yes' else 0)
+                way_refs.extend(int(nd.get('ref')) for nd in elem.iter('nd'))
+                way_offsets.append(len(way_refs))
+            else:
+                skipped += 1
+            root.clear()
+        elif elem.tag == 'relation':
+            root.clear()
+
+    ids = np.frombuffer(node_ids, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    osm = OsmData(ids[order], np.frombuffer(lat)[order], np.frombuffer(lon)[order],
+                  way_ids, highways, np.frombuffer(bytes(oneway), dtype=np.uint8).astype(bool),
+                  np.frombuffer(way_offsets, dtype=np.int64), np.frombuffer(way_refs, dtype=np.int64))
+    logging.info(f"OSM file: {len(osm.node_ids)} node, {len(way_ids)} way đường xe (bỏ qua {skipped} way khác)")
+    return osm
+
+def expected_segments(osm, area):
+    """
+    Các đoạn (có hướng) mà đồ thị phải chứa: đoạn của way đường xe nằm trọn trong vùng cắt,
+    hai chiều nếu way không phải một chiều. Trả về dict mảng: src, dst (vị trí node trong
+    osm), way (vị trí way trong osm) theo thứ tự file, cùng số đoạn bị cắt hoặc ngoài vùng.
+    """
+    counts = np.diff(osm.way_offsets)
+    seg_way = np.repeat(np.arange(len(osm.way_ids)), np.maximum(counts - 1, 0))
+    has_next = np.ones(len(osm.way_refs), dtype=bool)
+    has_next[osm.way_offsets[1:][counts > 0] - 1] = False
+    starts = np.flatnonzero(has_next)  # vị trí node đầu của mỗi đoạn trong way_refs
+    src = osm.node_index(osm.way_refs[starts])
+    dst = osm.node_index(osm.way_refs[starts + 1])
+    valid = (src >= 0) & (dst >= 0)
+
+    inside = np.zeros(len(src), dtype=bool)
+    lat1, lon1 = osm.lat[src].tolist(), osm.lon[src].tolist()
+    lat2, lon2 = osm.lat[dst].tolist(), osm.lon[dst].tolist()
+    for i in np.flatnonzero(valid).tolist():
+        pieces = area.clip_segment(lon1[i], lat1[i], lon2[i], lat2[i])
+        inside[i] = len(pieces) == 1 and pieces[0] == ((lon1[i], lat1[i]), (lon2[i], lat2[i]))
+
+    src, dst, seg_way = src[inside], dst[inside], seg_way[inside]
+    both = ~osm.oneway[seg_way]
+    # Chiều về đặt ngay sau chiều đi như khi xây đồ thị
+    order = np.argsort(np.concatenate([np.arange(len(src)), np.flatnonzero(both)]), kind='stable')
+    return {
+        'src': np.concatenate([src, dst[both]])[order],
+        'dst': np.concatenate([dst, src[both]])[order],
+        'way': np.concatenate([seg_way, seg_way[both]])[order],
+        'missing_nodes': int((~valid).sum()),
+        'clipped': int((valid & ~inside).sum()),
+    }
+
+def graph_segments(G, osm):
+    """
+    Trải mọi cạnh đồ thị (kể cả hình học của cạnh gộp) thành các đoạn giữa hai điểm liên tiếp,
+    khớp mỗi điểm với node OSM: đầu cạnh theo id, điểm trung gian theo tọa độ.
+    Điểm không khớp (node tạo tại điểm cắt vùng) có vị trí -1.
+    Trả về dict mảng: src, dst (vị trí node trong osm), row (dòng bảng way) và vị trí điểm trung gian đã khớp.
+    """
+    ensure_edge_geometry(G)
+    graph_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    graph_index = dict(zip(graph_ids.tolist(), osm.node_index(graph_ids).tolist()))
+    src, dst, rows = array('q'), array('q'), array('i')
+    point_lat, point_lon = array('d'), array('d')
+    point_slots = []  # vị trí đoạn nhận điểm trung gian làm node cuối, điền sau khi khớp tọa độ
+    for u, v, data in G.edges(data=True):
+        points = edge_points(G, data)
+        row = data.get('way', -1)
+        chain = [graph_index[u]] + [-1] * len(points) + [graph_index[v]]
+        base = len(src)
+        for k, (lat, lon) in enumerate(points):
+            point_lat.append(lat)
+            point_lon.append(lon)
+            point_slots.append(base + k)
+        src.extend(chain[:-1])
+        dst.extend(chain[1:])
+        rows.extend([row] * (len(chain) - 1))
+
+    src = np.frombuffer(src, dtype=np.int64).copy()
+    dst = np.frombuffer(dst, dtype=np.int64).copy()
+    point_index = np.full(len(point_slots), -1, dtype=np.int64)
+    if point_slots:
+        used = np.unique(osm.node_index(osm.way_refs))
+        used = used[used >= 0]
+        keys = coord_keys(osm.lat[used], osm.lon[used])
+        order = np.argsort(keys, kind='stable')
+        keys, used = keys[order], used[order]
+        wanted = coord_keys(point_lat, point_lon)
+        found = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+        if len(keys):
+            point_index = np.where(keys[found] == wanted, used[found], -1)
+        slots = np.asarray(point_slots, dtype=np.int64)
+        # Điểm trung gian thứ k là node cuối của đoạn k và node đầu của đoạn k + 1
+        dst[slots] = point_index
+        src[slots + 1] = point_index
+    return {'src': src, 'dst': dst, 'row': np.frombuffer(rows, dtype=np.int32), 'points': point_index}
 
-    logging.info(f"OSM file: {len(nodes)} node, {len(ways)} way (chỉ đường xe)")
-    return nodes, ways
+def _pair_keys(src, dst):
+    return (np.asarray(src, dtype=np.int64) << 32) | np.asarray(dst, dtype=np.int64)
 
-def compare_nodes(graph_nodes, osm_nodes):
-    """So sánh node giữa đồ thị GraphML và file OSM."""
+def _examples(values):
+    return list(values[:MAX_EXAMPLES])
+
+def compare_nodes(G, osm, expected, segments):
+    """So sánh node giữa đồ thị và file OSM."""
     logging.info("So sánh node...")
-    
-    # Trích xuất node ID từ NodeDataView
-    graph_node_ids = set(node for node, data in graph_nodes)
-    osm_node_ids = set(osm_nodes.keys())
-    
-    missing_in_graph = osm_node_ids - graph_node_ids
-    extra_in_graph = graph_node_ids - osm_node_ids
-    
-    coord_mismatches = []
-    for node_id, data in graph_nodes:
-        if node_id in osm_nodes:
-            g_lat, g_lon = data['lat'], data['lon']
-            o_lat, o_lon = osm_nodes[node_id]['lat'], osm_nodes[node_id]['lon']
-            if abs(g_lat - o_lat) > 1e-6 or abs(g_lon - o_lon) > 1e-6:
-                coord_mismatches.append((node_id, (g_lat, g_lon), (o_lat, o_lon)))
-    
-    print(f"Node trong GraphML: {len(graph_node_ids)}")
-    print(f"Node trong OSM (chỉ đường xe): {len(osm_node_ids)}")
-    print(f"Node thiếu trong GraphML: {len(missing_in_graph)}")
-    print(f"Node thừa trong GraphML: {len(extra_in_graph)}")
-    print(f"Node có tọa độ không khớp: {len(coord_mismatches)}")
-    if coord_mismatches:
-        print("Ví dụ tọa độ không khớp:", coord_mismatches[:5])
-    
-    return len(missing_in_graph) == 0 and len(extra_in_graph) == 0 and len(coord_mismatches) == 0
-
-def compare_ways(G, osm_ways):
-    """So sánh way/cạnh giữa đồ thị GraphML và file OSM."""
+    graph_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    graph_lat = np.fromiter((data['lat'] for _, data in G.nodes(data=True)), dtype=np.float64, count=len(graph_ids))
+    graph_lon = np.fromiter((data['lon'] for _, data in G.nodes(data=True)), dtype=np.float64, count=len(graph_ids))
+    index = osm.node_index(graph_ids)
+    in_osm = index >= 0
+    mismatch = in_osm & ((np.abs(graph_lat - osm.lat[index]) > COORD_TOLERANCE) |
+                         (np.abs(graph_lon - osm.lon[index]) > COORD_TOLERANCE))
+
+    # Node OSM phải có mặt: đầu mút các đoạn nằm trọn trong vùng, là node đồ thị
+    # hoặc điểm trung gian của cạnh gộp
+    required = np.unique(np.concatenate([expected['src'], expected['dst']]))
+    covered = np.unique(np.concatenate([index[in_osm], segments['points'][segments['points'] >= 0]]))
+    missing = required[~np.isin(required, covered)]
+
+    result = {
+        'graph': int(len(graph_ids)),
+        'required': int(len(required)),
+        'missing': int(len(missing)),
+        'clip_nodes': int((~in_osm).sum()),
+        'coord_mismatches': int(mismatch.sum()),
+        'examples': {
+            'missing': _examples(osm.node_ids[missing].tolist()),
+            'coord_mismatches': [
+                {'id': int(node_id), 'graph': [float(a), float(b)], 'osm': [float(c), float(d)]}
+                for node_id, a, b, c, d in zip(graph_ids[mismatch][:MAX_EXAMPLES], graph_lat[mismatch], graph_lon[mismatch],
+                                               osm.lat[index[mismatch]], osm.lon[index[mismatch]])
+            ],
+        },
+        'missing_ids': osm.node_ids[missing],
+        'mismatch_ids': graph_ids[mismatch],
+    }
+    print(f"Node trong đồ thị: {result['graph']} (trong đó {result['clip_nodes']} node tạo tại điểm cắt vùng)")
+    print(f"Node OSM cần có (đường xe trong vùng): {result['required']}")
+    print(f"Node thiếu trong đồ thị: {result['missing']}")
+    print(f"Node có tọa độ không khớp: {result['coord_mismatches']}")
+    return result['missing'] == 0 and result['coord_mismatches'] == 0, result
+
+def compare_ways(G, osm, expected, segments):
+    """So sánh đoạn đường và thuộc tính way giữa đồ thị và file OSM."""
     logging.info("So sánh way/cạnh...")
-    
-    # Tạo danh sách cạnh từ OSM ways
-    osm_edges = []
-    osm_way_tags = {}
-    for way in osm_ways:
-        way_id = way['id']
-        nodes = way['nodes']
-        tags = way['tags']
-        is_oneway = tags.get('oneway', 'no') == 'yes'
-        for i in range(len(nodes) - 1):
-            n1, n2 = nodes[i], nodes[i + 1]
-            osm_edges.append((n1, n2))
-            if not is_oneway:
-                osm_edges.append((n2, n1))
-        osm_way_tags[way_id] = tags
-    
-    # Tạo danh sách cạnh từ GraphML
-    graph_edges_set = set((u, v) for u, v in G.edges())
-    osm_edges_set = set(osm_edges)
-    
-    missing_edges = osm_edges_set - graph_edges_set
-    extra_edges = graph_edges_set - osm_edges_set
-    
-    # So sánh tag highway
-    tag_mismatches = []
-    for way_id, tags in osm_way_tags.items():
-        highway_osm = tags.get('highway')
-        # Tìm cạnh trong GraphML tương ứng với way
-        for u, v, data in G.edges(data=True):
-            tags_graph = json.loads(data['tags'])
-            if tags_graph.get('highway') == highway_osm:
-                break
-        else:
-            tag_mismatches.append((way_id, highway_osm))
-    
-    print(f"Cạnh trong GraphML: {len(graph_edges_set)}")
-    print(f"Cạnh trong OSM (chỉ đường xe): {len(osm_edges_set)}")
-    print(f"Cạnh thiếu trong GraphML: {len(missing_edges)}")
-    print(f"Cạnh thừa trong GraphML: {len(extra_edges)}")
-    print(f"Way có tag highway không khớp: {len(tag_mismatches)}")
-    if tag_mismatches:
-        print("Ví dụ tag không khớp:", tag_mismatches[:5])
-    
-    return len(missing_edges) == 0 and len(extra_edges) == 0 and len(tag_mismatches) == 0
-
-def visualize_comparison(graph_nodes, graph_edges, osm_nodes, osm_ways, output_html='comparison_map.html'):
+    table = ensure_way_table(G)
+    matched = (segments['src'] >= 0) & (segments['dst'] >= 0)
+    graph_keys = _pair_keys(segments['src'][matched], segments['dst'][matched])
+    graph_rows = segments['row'][matched]
+    expected_keys = _pair_keys(expected['src'], expected['dst'])
+
+    missing = ~np.isin(expected_keys, graph_keys)
+    extra = ~np.isin(graph_keys, expected_keys)
+
+    # Way của đoạn: cạnh trùng giữ thuộc tính của way đọc sau cùng như khi xây đồ thị
+    last_keys, last = np.unique(expected_keys[::-1], return_index=True)
+    last_way = expected['way'][::-1][last]
+    position = np.minimum(np.searchsorted(last_keys, graph_keys), max(len(last_keys) - 1, 0))
+    row_way_ids = np.array([int(way_id) for way_id in table.way_ids] + [-1], dtype=np.int64)
+    osm_way_ids = np.asarray(osm.way_ids, dtype=np.int64)
+    graph_way_ids = row_way_ids[graph_rows]
+    osm_segment_way_ids = osm_way_ids[last_way[position]] if len(last_keys) else np.full(len(graph_keys), -1)
+    wrong_way = ~extra & (graph_way_ids != osm_segment_way_ids)
+
+    # Thuộc tính của các way có đoạn trong vùng hoặc có trong bảng way của đồ thị (kể cả way
+    # chỉ có đoạn bị cắt ở biên); giữ vị trí way trong osm để vẽ sai khác
+    osm_way_index = {way_id: w for w, way_id in enumerate(osm.way_ids)}
+    in_table = [osm_way_index[int(way_id)] for way_id in table.way_ids if int(way_id) in osm_way_index]
+    way_missing, highway_mismatches, oneway_mismatches = [], [], []
+    missing_index, highway_index, oneway_index = array('q'), array('q'), array('q')
+    for w in np.union1d(expected['way'], np.asarray(in_table, dtype=np.int64)).tolist():
+        way_id = osm.way_ids[w]
+        row = table.row_of(way_id)
+        if row is None:
+            way_missing.append(way_id)
+            missing_index.append(w)
+            continue
+        if table.highway(row) != osm.highways[w]:
+            highway_mismatches.append({'id': way_id, 'graph': table.highway(row), 'osm': osm.highways[w]})
+            highway_index.append(w)
+        if bool(table.oneway(row)) != bool(osm.oneway[w]):
+            oneway_mismatches.append(way_id)
+            oneway_index.append(w)
+
+    missing_pairs = np.stack([expected['src'][missing], expected['dst'][missing]], axis=1)
+    extra_pairs = np.stack([segments['src'][matched][extra], segments['dst'][matched][extra]], axis=1)
+    result = {
+        'graph_segments': int(len(segments['src'])),
+        'clipped_segments': int((~matched).sum()),
+        'expected_segments': int(len(expected_keys)),
+        'outside_segments': expected['clipped'],
+        'missing': int(missing.sum()),
+        'extra': int(extra.sum()),
+        'wrong_way': int(np.sum(wrong_way)),
+        'ways_expected': int(len(np.unique(expected['way']))),
+        'ways_missing': len(way_missing),
+        'highway_mismatches': len(highway_mismatches),
+        'oneway_mismatches': len(oneway_mismatches),
+        'examples': {
+            'missing': osm.node_ids[missing_pairs[:MAX_EXAMPLES]].tolist(),
+            'extra': osm.node_ids[extra_pairs[:MAX_EXAMPLES]].tolist(),
+            'ways_missing': _examples(way_missing),
+            'highway_mismatches': _examples(highway_mismatches),
+            'oneway_mismatches': _examples(oneway_mismatches),
+        },
+        'missing_pairs': missing_pairs,
+        'extra_pairs': extra_pairs,
+        'wrong_way_pairs': np.stack([segments['src'][matched][wrong_way], segments['dst'][matched][wrong_way]], axis=1),
+        'wrong_way_ids': np.stack([graph_way_ids[wrong_way], osm_segment_way_ids[wrong_way]], axis=1),
+        'way_missing_index': np.frombuffer(missing_index, dtype=np.int64),
+        'highway_mismatch_index': np.frombuffer(highway_index, dtype=np.int64),
+        'oneway_mismatch_index': np.frombuffer(oneway_index, dtype=np.int64),
+    }
+    print(f"Đoạn trong đồ thị: {result['graph_segments']} ({result['clipped_segments']} đoạn có đầu tại điểm cắt vùng)")
+    print(f"Đoạn OSM cần có (đường xe trong vùng): {result['expected_segments']}")
+    print(f"Đoạn thiếu trong đồ thị: {result['missing']}")
+    print(f"Đoạn thừa trong đồ thị: {result['extra']}")
+    print(f"Đoạn gán sai way: {result['wrong_way']}")
+    print(f"Way thiếu trong bảng way: {result['ways_missing']}")
+    print(f"Way có tag highway không khớp: {result['highway_mismatches']}")
+    print(f"Way có oneway không khớp: {result['oneway_mismatches']}")
+    ok = not (result['missing'] or result['extra'] or result['wrong_way'] or result['ways_missing']
+              or result['highway_mismatches'] or result['oneway_mismatches'])
+    return ok, result
+
+def visualize_comparison(G, osm, output_html='comparison_map.html'):
     """Vẽ đồ thị GraphML và OSM lên bản đồ folium để so sánh trực quan."""
     logging.info("Tạo bản đồ so sánh...")
-    
+
     # Tạo bản đồ folium
     center_lat = (21.00017 + 21.01114) / 2
     center_lon = (105.82875 + 105.83827) / 2
     m = folium.Map(location=[center_lat, center_lon], zoom_start=15, tiles='OpenStreetMap')
-    
+
     # Vẽ node từ GraphML (màu xanh)
-    for node_id, data in graph_nodes:
+    for node_id, data in G.nodes(data=True):
         folium.CircleMarker(
             location=[data['lat'], data['lon']],
             radius=3,
@@ -149,72 +337,236 @@ def visualize_comparison(graph_nodes, graph_edges, osm_nodes, osm_ways, output_h
             fill_opacity=0.5,
             popup=f"GraphML Node {node_id}"
         ).add_to(m)
-    
-    # Vẽ cạnh từ GraphML (màu xanh)
-    for u, v, data in graph_edges.edges(data=True):
-        u_data = graph_edges.nodes[u]
-        v_data = graph_edges.nodes[v]
-        u_lat, u_lon = u_data['lat'], u_data['lon']
-        v_lat, v_lon = v_data['lat'], v_data['lon']
+
+    # Vẽ cạnh từ GraphML (màu xanh), theo hình học nếu là cạnh gộp
+    for u, v, data in G.edges(data=True):
+        locations = [[G.nodes[u]['lat'], G.nodes[u]['lon']]]
+        locations += [[lat, lon] for lat, lon in edge_points(G, data)]
+        locations.append([G.nodes[v]['lat'], G.nodes[v]['lon']])
         folium.PolyLine(
-            locations=[[u_lat, u_lon], [v_lat, v_lon]],
+            locations=locations,
             color='blue',
             weight=3,
             opacity=0.5,
             popup=f"GraphML Edge ({u}, {v})"
         ).add_to(m)
-    
-    # Vẽ node từ OSM (chỉ đường xe) (màu đỏ)
-    for node_id, data in osm_nodes.items():
-        # Chỉ vẽ node được sử dụng trong ways của đường xe
-        used_nodes = set()
-        for way in osm_ways:
-            used_nodes.update(way['nodes'])
-        if node_id in used_nodes:
-            folium.CircleMarker(
-                location=[data['lat'], data['lon']],
-                radius=3,
-                color='red',
-                fill=True,
-                fill_opacity=0.5,
-                popup=f"OSM Node {node_id}"
-            ).add_to(m)
-    
+
+    # Vẽ node từ OSM (màu đỏ): chỉ node được sử dụng trong way đường xe, tính một lần
+    used = np.unique(osm.node_index(osm.way_refs))
+    for i in used[used >= 0].tolist():
+        folium.CircleMarker(
+            location=[osm.lat[i], osm.lon[i]],
+            radius=3,
+            color='red',
+            fill=True,
+            fill_opacity=0.5,
+            popup=f"OSM Node {osm.node_ids[i]}"
+        ).add_to(m)
+
     # Vẽ way từ OSM (chỉ đường xe) (màu đỏ)
-    for way in osm_ways:
-        coords = [[osm_nodes[n]['lat'], osm_nodes[n]['lon']] for n in way['nodes'] if n in osm_nodes]
-        if len(coords) > 1:
+    for w, way_id in enumerate(osm.way_ids):
+        index = osm.node_index(osm.way_refs[osm.way_offsets[w]:osm.way_offsets[w + 1]])
+        index = index[index >= 0]
+        if len(index) > 1:
             folium.PolyLine(
-                locations=coords,
+                locations=np.stack([osm.lat[index], osm.lon[index]], axis=1).tolist(),
                 color='red',
                 weight=3,
                 opacity=0.5,
-                popup=f"OSM Way {way['id']}"
+                popup=f"OSM Way {way_id}"
             ).add_to(m)
-    
+
     # Lưu bản đồ
     m.save(output_html)
     logging.info(f"Đã lưu bản đồ so sánh vào {output_html}")
 
-def main(osm_file='kim_lien.osm', graphml_file='road_network.graphml'):
+def _segment_features(osm, pairs, kind, extra_properties=None):
+    features = []
+    for k, (a, b) in enumerate(pairs.tolist()):
+        properties = {'kind': kind, 'from': int(osm.node_ids[a]), 'to': int(osm.node_ids[b])}
+        if extra_properties is not None:
+            properties.update(extra_properties(k))
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString',
+                         'coordinates': [[float(osm.lon[a]), float(osm.lat[a])], [float(osm.lon[b]), float(osm.lat[b])]]},
+            'properties': properties,
+        })
+    return features
+
+def _point_feature(lat, lon, properties):
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+            'properties': properties}
+
+def _way_features(osm, way_index, kind, properties=None):
+    features = []
+    for w in way_index.tolist():
+        index = osm.node_index(osm.way_refs[osm.way_offsets[w]:osm.way_offsets[w + 1]])
+        index = index[index >= 0]
+        if len(index) < 2:
+            continue
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': np.stack([osm.lon[index], osm.lat[index]], axis=1).tolist()},
+            'properties': {'kind': kind, 'way': osm.way_ids[w], 'highway': osm.highways[w],
+                           'oneway': bool(osm.oneway[w]), **(properties(w) if properties else {})},
+        })
+    return features
+
+def mismatch_layers(G, osm, nodes, edges):
+    """
+    Hai FeatureCollection GeoJSON chỉ gồm các sai khác: lớp 'graphml' (đoạn thừa, đoạn gán
+    sai way, node lệch tọa độ theo vị trí trong đồ thị) và lớp 'osm' (đoạn thiếu, node thiếu,
+    way thiếu hoặc sai highway/oneway theo hình dạng trong file OSM).
+    """
+    table = ensure_way_table(G)
+    graph_features = _segment_features(osm, edges['extra_pairs'], 'extra_segment')
+    wrong_way_ids = edges['wrong_way_ids'].tolist()
+    graph_features += _segment_features(osm, edges['wrong_way_pairs'], 'wrong_way',
+                                        lambda k: {'graph_way': wrong_way_ids[k][0], 'osm_way': wrong_way_ids[k][1]})
+    for node_id in nodes['mismatch_ids'].tolist():
+        data = G.nodes[node_id]
+        i = int(osm.node_index([node_id])[0])
+        graph_features.append(_point_feature(data['lat'], data['lon'], {
+            'kind': 'coord_mismatch', 'id': node_id, 'osm_lat': float(osm.lat[i]), 'osm_lon': float(osm.lon[i])}))
+
+    osm_features = _segment_features(osm, edges['missing_pairs'], 'missing_segment')
+    for i in osm.node_index(nodes['missing_ids']).tolist():
+        osm_features.append(_point_feature(osm.lat[i], osm.lon[i], {'kind': 'missing_node', 'id': int(osm.node_ids[i])}))
+    osm_features += _way_features(osm, edges['way_missing_index'], 'way_missing')
+    osm_features += _way_features(osm, edges['highway_mismatch_index'], 'highway_mismatch',
+                                  lambda w: {'graph_highway': table.highway(table.row_of(osm.way_ids[w]))})
+    osm_features += _way_features(osm, edges['oneway_mismatch_index'], 'oneway_mismatch')
+    return {
+        'graphml': {'type': 'FeatureCollection', 'features': graph_features},
+        'osm': {'type': 'FeatureCollection', 'features': osm_features},
+    }
+
+def write_geojson_layers(layers, prefix):
+    """Ghi mỗi lớp thành một file <prefix>.<lớp>.geojson. Trả về danh sách file."""
+    paths = []
+    for name, collection in layers.items():
+        path = f"{prefix}.{name}.geojson"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(collection, f, ensure_ascii=False, separators=(',', ':'))
+        logging.info(f"Đã ghi {len(collection['features'])} sai khác lớp {name} vào {path}")
+        paths.append(path)
+    return paths
+
+LAYER_COLORS = {'graphml': 'blue', 'osm': 'red'}
+
+def visualize_mismatches(layers, area, output_html='comparison_map.html', cluster=False):
+    """
+    Bản đồ so sánh gọn: mỗi lớp GeoJSON (chỉ sai khác) là một layer folium, kích thước không
+    phụ thuộc số cạnh của đồ thị. cluster gom các điểm sai khác phía trình duyệt (FastMarkerCluster).
+    """
+    min_lat, min_lon, max_lat, max_lon = area.bounds
+    m = folium.Map(location=[(min_lat + max_lat) / 2, (min_lon + max_lon) / 2], zoom_start=15, tiles='OpenStreetMap')
+    for name, collection in layers.items():
+        color = LAYER_COLORS.get(name, 'black')
+        lines = [f for f in collection['features'] if f['geometry']['type'] == 'LineString']
+        points = [f for f in collection['features'] if f['geometry']['type'] == 'Point']
+        if cluster:
+            if points:
+                from folium.plugins import FastMarkerCluster
+                FastMarkerCluster([[f['geometry']['coordinates'][1], f['geometry']['coordinates'][0]] for f in points],
+                                  name=f"{name}: điểm").add_to(m)
+            features = lines
+        else:
+            features = lines + points
+        if features:
+            folium.GeoJson(
+                {'type': 'FeatureCollection', 'features': features},
+                name=name,
+                style_function=lambda feature, color=color: {'color': color, 'weight': 4, 'opacity': 0.8},
+                marker=folium.CircleMarker(radius=4, color=color, fill=True, fill_opacity=0.7),
+                tooltip=folium.GeoJsonTooltip(fields=['kind']),
+                popup=folium.GeoJsonPopup(fields=['kind']),
+            ).add_to(m)
+    folium.LayerControl().add_to(m)
+    m.save(output_html)
+    logging.info(f"Đã lưu bản đồ sai khác vào {output_html}")
+
+def _public(section):
+    """Phần báo cáo JSON: bỏ các mảng đầy đủ dùng nội bộ."""
+    return {key: value for key, value in section.items() if not isinstance(value, np.ndarray)}
+
+def main(osm_file='kim_lien.osm', graphml_file='road_network.graphml', area=None,
+         report_file=None, output_html='comparison_map.html', geojson_prefix=None, full_map=False, cluster=False):
+    """
+    Kiểm tra đồ thị GraphML khớp với file OSM trong vùng cắt area (mặc định như khi xây đồ thị).
+    Ghi báo cáo JSON vào report_file nếu có, các lớp GeoJSON sai khác vào <geojson_prefix>.*.geojson
+    nếu có, bản đồ so sánh vào output_html (None để bỏ qua): mặc định chỉ vẽ sai khác,
+    full_map vẽ mọi node/cạnh như trước (chỉ hợp với đồ thị nhỏ).
+    Trả về True nếu khớp hoàn toàn.
+    """
+    started = time.perf_counter()
+    area = area or BBoxArea(*DEFAULT_BBOX)
     # Tải dữ liệu
     G = load_graphml(graphml_file)
-    osm_nodes, osm_ways = parse_osm_file(osm_file)
-    
+    osm = parse_osm_file(osm_file)
+    expected = expected_segments(osm, area)
+    segments = graph_segments(G, osm)
+
     # So sánh node
-    nodes_match = compare_nodes(G.nodes(data=True), osm_nodes)
-    
+    nodes_match, nodes = compare_nodes(G, osm, expected, segments)
+
     # So sánh way/cạnh
-    edges_match = compare_ways(G, osm_ways)
-    
+    edges_match, edges = compare_ways(G, osm, expected, segments)
+
     # Trực quan hóa
-    visualize_comparison(G.nodes(data=True), G, osm_nodes, osm_ways)
-    
+    if geojson_prefix or (output_html and not full_map):
+        layers = mismatch_layers(G, osm, nodes, edges)
+        if geojson_prefix:
+            write_geojson_layers(layers, geojson_prefix)
+        if output_html and not full_map:
+            visualize_mismatches(layers, area, output_html, cluster)
+    if output_html and full_map:
+        visualize_comparison(G, osm, output_html)
+
+    ok = nodes_match and edges_match
+    if report_file:
+        report = {
+            'osm_file': osm_file,
+            'graphml_file': graphml_file,
+            'area_bounds': list(area.bounds),
+            'ok': ok,
+            'nodes': _public(nodes),
+            'edges': _public(edges),
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logging.info(f"Đã ghi báo cáo kiểm tra vào {report_file}")
+
     # Kết luận
-    if nodes_match and edges_match:
+    if ok:
         print("Đồ thị GraphML khớp hoàn toàn với dữ liệu OSM (chỉ đường xe)!")
     else:
         print("Có sự khác biệt giữa đồ thị GraphML và dữ liệu OSM (chỉ đường xe). Kiểm tra log và bản đồ so sánh.")
+    return ok
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm tra đồ thị GraphML khớp với file OSM (chỉ đường xe)")
+    parser.add_argument('osm_file', nargs='?', default='kim_lien.osm', help="File OSM XML đã dùng để xây đồ thị")
+    parser.add_argument('graphml_file', nargs='?', default='road_network.graphml', help="File GraphML cần kiểm tra")
+    area = parser.add_mutually_exclusive_group()
+    area.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                      help="Hộp giới hạn đã dùng khi xây đồ thị (mặc định khu Kim Liên)")
+    area.add_argument('--polygon', help="Vùng đa giác đã dùng khi xây đồ thị: file .poly hoặc GeoJSON")
+    parser.add_argument('--report', help="Ghi báo cáo JSON vào file này")
+    parser.add_argument('--map', default='comparison_map.html', help="File HTML bản đồ so sánh")
+    parser.add_argument('--no-map', action='store_true', help="Không tạo bản đồ so sánh (chạy hàng loạt)")
+    parser.add_argument('--full-map', action='store_true',
+                        help="Vẽ mọi node và cạnh của hai nguồn thay vì chỉ sai khác (chỉ dùng cho vùng nhỏ)")
+    parser.add_argument('--cluster', action='store_true', help="Gom các điểm sai khác trên bản đồ (phía trình duyệt)")
+    parser.add_argument('--geojson', metavar='PREFIX',
+                        help="Ghi sai khác thành PREFIX.graphml.geojson và PREFIX.osm.geojson")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    area = load_polygon(args.polygon) if args.polygon else BBoxArea(*(args.bbox or DEFAULT_BBOX))
+    ok = main(args.osm_file, args.graphml_file, area, args.report, None if args.no_map else args.map,
+              args.geojson, args.full_map, args.cluster)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,138 @@
+import logging
+from array import array
+
+# Số thành phần giữ lại tập đến được trong bộ nhớ
+REACH_CACHE_SIZE = 256
+
+class ConnectivityIndex:
+    """
+    Nhãn thành phần liên thông mạnh (SCC) của đồ thị CSR và đồ thị rút gọn (DAG) giữa các SCC.
+    Hai node cùng SCC luôn tới được nhau; khác SCC thì tra tập thành phần đến được
+    (tính một lần cho mỗi thành phần nguồn rồi dùng lại).
+    """
+    def __init__(self, labels, component_succ):
+        self.labels = labels  # array('q'): chỉ số CSR -> SCC
+        self.component_succ = component_succ  # [set(SCC kề)] cạnh của DAG rút gọn
+        self._reach = {}  # {SCC nguồn: frozenset(SCC đến được)}
+
+    @classmethod
+    def from_csr(cls, csr, removed=frozenset()):
+        """Tính SCC bằng Tarjan (không đệ quy), bỏ qua các cạnh (u, v) chỉ số CSR trong removed."""
+        n = len(csr)
+        offsets, targets = csr.offsets, csr.targets
+        index = array('q', [-1]) * n
+        low = array('q', [0]) * n
+        labels = array('q', [-1]) * n
+        on_stack = bytearray(n)
+        stack = []
+        counter = 0
+        components = 0
+        for root in range(n):
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, offsets[root])]
+            while work:
+                v, e = work[-1]
+                end = offsets[v + 1]
+                descended = False
+                while e < end:
+                    w = targets[e]
+                    e += 1
+                    if removed and (v, w) in removed:
+                        continue
+                    if index[w] == -1:
+                        work[-1] = (v, e)
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = 1
+                        work.append((w, offsets[w]))
+                        descended = True
+                        break
+                    if on_stack[w] and index[w] < low[v]:
+                        low[v] = index[w]
+                if descended:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[v] < low[parent]:
+                        low[parent] = low[v]
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = 0
+                        labels[w] = components
+                        if w == v:
+                            break
+                    components += 1
+
+        component_succ = [set() for _ in range(components)]
+        for v in range(n):
+            for e in range(offsets[v], offsets[v + 1]):
+                w = targets[e]
+                if labels[v] != labels[w] and not (removed and (v, w) in removed):
+                    component_succ[labels[v]].add(labels[w])
+        logging.info(f"Đã tính {components} thành phần liên thông mạnh cho {n} node")
+        return cls(labels, component_succ)
+
+    def component_reach(self, component):
+        reach = self._reach.get(component)
+        if reach is None:
+            seen = {component}
+            stack = [component]
+            while stack:
+                for nxt in self.component_succ[stack.pop()]:
+                    if nxt not in seen:
+                        seen.add(nxt)
+                        stack.append(nxt)
+            if len(self._reach) >= REACH_CACHE_SIZE:
+                self._reach.clear()
+            reach = self._reach[component] = frozenset(seen)
+        return reach
+
+    def can_reach(self, source_key, target_key):
+        """True nếu có đường từ source_key đến target_key (chỉ số CSR của node gốc)."""
+        source_component = self.labels[source_key]
+        target_component = self.labels[target_key]
+        if source_component == target_component:
+            return True
+        return target_component in self.component_reach(source_component)
+
+def _virtual_neighbors(overlay, node, backward):
+    """
+    Từ node (có thể là node ảo) đi qua các node ảo của lớp phủ; trả về
+    (các node gốc gặp đầu tiên, các node đã đi qua).
+    """
+    if not overlay.is_virtual(node):
+        return {node}, {node}
+    seen = {node}
+    stack = [node]
+    base = set()
+    while stack:
+        current = stack.pop()
+        neighbors = overlay.pred[current] if backward else overlay[current]
+        for neighbor in neighbors:
+            if not overlay.is_virtual(neighbor):
+                base.add(neighbor)
+            elif neighbor not in seen:
+                seen.add(neighbor)
+                stack.append(neighbor)
+    return base, seen
+
+def reachable(connectivity, csr, source, target, overlay=None):
+    """
+    Kiểm tra nhanh có đường từ source đến target hay không (node gốc hoặc node ảo của lớp phủ).
+    connectivity phải được tính với cùng các cạnh bị cấm như lớp phủ.
+    """
+    if overlay is None:
+        return connectivity.can_reach(csr.key_of(source), csr.key_of(target))
+    sources, seen = _virtual_neighbors(overlay, source, backward=False)
+    if target in seen:
+        return True
+    targets, _ = _virtual_neighbors(overlay, target, backward=True)
+    return any(connectivity.can_reach(csr.key_of(s), csr.key_of(t)) for s in sources for t in targets)
@@ -0,0 +1,262 @@
+import os
+import math
+import heapq
+import logging
+import numpy as np
+
+# Giới hạn số node được duyệt trong tìm kiếm witness khi co một node
+WITNESS_SETTLE_LIMIT = 60
+
+def ch_path_for(graphml_file):
+    """Đường dẫn file Contraction Hierarchies nằm cạnh file GraphML."""
+    return os.path.splitext(graphml_file)[0] + '.ch.npz'
+
+class ContractionHierarchy:
+    """
+    Contraction Hierarchies trên id node của đồ thị gốc.
+    edges: {(u, v): (trọng số, node giữa)}, node giữa = -1 với cạnh gốc,
+    ngược lại cạnh là shortcut u -> giữa -> v.
+    """
+    def __init__(self, rank, edges, signature):
+        self.rank = rank  # {node: thứ hạng}
+        self.edges = edges
+        self.signature = signature
+        self.up_out = {}  # {u: [(v, w)]} cạnh lên theo chiều tiến
+        self.down_in = {}  # {v: [(u, w)]} cạnh lên theo chiều lùi (u có hạng cao hơn v)
+        for (u, v), (weight, _) in edges.items():
+            if rank[u] < rank[v]:
+                self.up_out.setdefault(u, []).append((v, weight))
+            else:
+                self.down_in.setdefault(v, []).append((u, weight))
+
+    def matches(self, csr):
+        """Kiểm tra hierarchy được xây từ đúng đồ thị đang dùng."""
+        n, m, total = self.signature
+        n2, m2, total2 = csr.signature()
+        return n == n2 and m == m2 and math.isclose(total, total2, rel_tol=1e-9)
+
+    def save(self, path):
+        nodes = list(self.rank)
+        src = [u for u, _ in self.edges]
+        dst = [v for _, v in self.edges]
+        weight = [w for w, _ in self.edges.values()]
+        middle = [mid for _, mid in self.edges.values()]
+        np.savez_compressed(path,
+                            node_ids=np.array(nodes, dtype=np.int64),
+                            rank=np.array([self.rank[n] for n in nodes], dtype=np.int64),
+                            src=np.array(src, dtype=np.int64),
+                            dst=np.array(dst, dtype=np.int64),
+                            weight=np.array(weight, dtype=np.float64),
+                            middle=np.array(middle, dtype=np.int64),
+                            signature=np.array(self.signature, dtype=np.float64))
+        logging.info(f"Đã lưu Contraction Hierarchies ({len(self.edges)} cạnh) vào {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            rank = dict(zip(data['node_ids'].tolist(), data['rank'].tolist()))
+            edges = {(u, v): (w, mid) for u, v, w, mid in zip(data['src'].tolist(), data['dst'].tolist(),
+                                                            data['weight'].tolist(), data['middle'].tolist())}
+            n, m, total = data['signature'].tolist()
+        return cls(rank, edges, (int(n), int(m), total))
+
+    def _unpack(self, u, v):
+        """Mở shortcut (u, v) thành dãy node gốc, không gồm u."""
+        result = []
+        stack = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            middle = self.edges[(a, b)][1]
+            if middle == -1:
+                result.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return result
+
+    def _seeds(self, start, overlay, backward):
+        if overlay is None:
+            return {start: (0.0, [start])}
+        return overlay.base_frontier(start, backward=backward)
+
+    def query(self, source, target, overlay=None):
+        """
+        Truy vấn hai chiều chỉ đi lên theo thứ hạng, sau đó mở các shortcut.
+        Trả về danh sách id node của đồ thị gốc (và node ảo ở hai đầu), hoặc [].
+        """
+        if source == target:
+            return [source]
+        forward_seeds = self._seeds(source, overlay, backward=False)
+        backward_seeds = self._seeds(target, overlay, backward=True)
+
+        best, meeting, direct = math.inf, None, None
+        # Hai node ảo trên cùng một cạnh có thể nối trực tiếp qua lớp phủ
+        if overlay is not None and overlay.is_virtual(target):
+            found = self._direct(source, target, overlay)
+            if found is not None:
+                best, direct = found
+
+        dist = ({}, {})
+        parent = ({}, {})
+        heaps = ([], [])
+        for side, seeds in ((0, forward_seeds), (1, backward_seeds)):
+            for node, (d, _) in seeds.items():
+                dist[side][node] = d
+                parent[side][node] = None
+                heaps[side].append((d, node))
+            heapq.heapify(heaps[side])
+        settled = (set(), set())
+        adjacency = (self.up_out, self.down_in)
+
+        while True:
+            active = [side for side in (0, 1) if heaps[side] and heaps[side][0][0] < best]
+            if not active:
+                break
+            side = min(active, key=lambda s: heaps[s][0][0])
+            d, node = heapq.heappop(heaps[side])
+            if node in settled[side] or d > dist[side][node]:
+                continue
+            settled[side].add(node)
+            other = dist[1 - side].get(node)
+            if other is not None and d + other < best:
+                best, meeting, direct = d + other, node, None
+            for neighbor, weight in adjacency[side].get(node, ()):
+                new_dist = d + weight
+                if new_dist < dist[side].get(neighbor, math.inf):
+                    dist[side][neighbor] = new_dist
+                    parent[side][neighbor] = node
+                    heapq.heappush(heaps[side], (new_dist, neighbor))
+
+        if direct is not None:
+            return direct
+        if meeting is None:
+            logging.warning(f"CH không tìm thấy đường từ {source} đến {target}")
+            return []
+
+        # Chuỗi tiến: seed -> ... -> meeting
+        chain = []
+        node = meeting
+        while node is not None:
+            chain.append(node)
+            node = parent[0][node]
+        chain.reverse()
+        forward_seed = chain[0]
+        # Chuỗi lùi: meeting -> ... -> seed
+        node = parent[1][meeting]
+        while node is not None:
+            chain.append(node)
+            node = parent[1][node]
+        backward_seed = chain[-1]
+
+        path = list(forward_seeds[forward_seed][1])
+        for a, b in zip(chain, chain[1:]):
+            path.extend(self._unpack(a, b))
+        path.extend(reversed(backward_seeds[backward_seed][1][:-1]))
+        return path
+
+    def _direct(self, source, target, overlay):
+        """Đường chỉ đi qua node ảo từ source đến target (nếu có)."""
+        visited = set()
+        frontier = [(0.0, source, [source])]
+        while frontier:
+            dist, node, path = heapq.heappop(frontier)
+            if node in visited:
+                continue
+            visited.add(node)
+            if node == target:
+                return dist, path
+            for neighbor, data in overlay[node].items():
+                if overlay.is_virtual(neighbor):
+                    heapq.heappush(frontier, (dist + data['weight'], neighbor, path + [neighbor]))
+        return None
+
+def _witness_exists(out_edges, contracted, source, excluded, target, limit):
+    """Tìm đường từ source đến target không qua excluded với độ dài <= limit."""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap and settled < WITNESS_SETTLE_LIMIT:
+        d, node = heapq.heappop(heap)
+        if d > limit:
+            return False
+        if node == target:
+            return True
+        if d > dist[node]:
+            continue
+        settled += 1
+        for neighbor, (weight, _) in out_edges[node].items():
+            if neighbor == excluded or neighbor in contracted:
+                continue
+            new_dist = d + weight
+            if new_dist <= limit and new_dist < dist.get(neighbor, math.inf):
+                dist[neighbor] = new_dist
+                heapq.heappush(heap, (new_dist, neighbor))
+    return False
+
+def build_contraction_hierarchy(csr):
+    """
+    Tiền xử lý Contraction Hierarchies từ đồ thị CSR.
+    Thứ tự co node theo edge difference + số láng giềng đã co, cập nhật lười.
+    """
+    n = len(csr)
+    out_edges = [dict() for _ in range(n)]  # {v: (w, giữa)} trên chỉ số CSR
+    in_edges = [dict() for _ in range(n)]
+    for u in range(n):
+        for e in range(csr.offsets[u], csr.offsets[u + 1]):
+            v, w = csr.targets[e], csr.weights[e]
+            if v != u and (v not in out_edges[u] or w < out_edges[u][v][0]):
+                out_edges[u][v] = (w, -1)
+                in_edges[v][u] = (w, -1)
+    all_edges = {(u, v): wm for u in range(n) for v, wm in out_edges[u].items()}
+
+    contracted = set()
+    contracted_neighbors = [0] * n
+
+    def shortcuts_for(node):
+        shortcuts = []
+        for u, (w_in, _) in in_edges[node].items():
+            if u in contracted:
+                continue
+            for v, (w_out, _) in out_edges[node].items():
+                if v in contracted or v == u:
+                    continue
+                candidate = w_in + w_out
+                if not _witness_exists(out_edges, contracted, u, node, v, candidate):
+                    shortcuts.append((u, v, candidate))
+        return shortcuts
+
+    def priority(node):
+        degree = sum(1 for u in in_edges[node] if u not in contracted) + \
+                 sum(1 for v in out_edges[node] if v not in contracted)
+        return len(shortcuts_for(node)) - degree + contracted_neighbors[node]
+
+    heap = [(priority(node), node) for node in range(n)]
+    heapq.heapify(heap)
+    rank = [0] * n
+    order = 0
+    while heap:
+        _, node = heapq.heappop(heap)
+        if node in contracted:
+            continue
+        # Cập nhật lười: nếu độ ưu tiên đã tăng thì đẩy lại vào heap
+        current = priority(node)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, node))
+            continue
+
+        for u, v, weight in shortcuts_for(node):
+            if v not in out_edges[u] or weight < out_edges[u][v][0]:
+                out_edges[u][v] = (weight, node)
+                in_edges[v][u] = (weight, node)
+                all_edges[(u, v)] = (weight, node)
+        contracted.add(node)
+        rank[node] = order
+        order += 1
+        for neighbor in list(in_edges[node]) + list(out_edges[node]):
+            contracted_neighbors[neighbor] += 1
+
+    ids = csr.node_ids
+    edges = {(ids[u], ids[v]): (w, ids[mid] if mid != -1 else -1) for (u, v), (w, mid) in all_edges.items()}
+    hierarchy = ContractionHierarchy({ids[i]: rank[i] for i in range(n)}, edges, csr.signature())
+    logging.info(f"Đã xây Contraction Hierarchies: {n} node, {len(edges) - csr.offsets[n]} shortcut")
+    return hierarchy
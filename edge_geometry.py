@@ -0,0 +1,113 @@
+import json
+import math
+from array import array
+
+R_EARTH_KM = 6371.0
+
+class EdgeGeometry:
+    """
+    Bảng hình học của các cạnh gộp từ chuỗi node bậc 2: mỗi dòng là dãy điểm trung gian
+    (lat, lon) nằm giữa hai đầu cạnh, lưu phẳng theo offsets như CSR.
+    Cạnh lưu mã 'geometry' = 2 * dòng (+1 nếu đi ngược dãy điểm, dùng cho chiều về
+    của đường hai chiều), cạnh thẳng không có mã.
+    """
+    def __init__(self, offsets=None, lat=None, lon=None):
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.lat = lat if lat is not None else array('d')
+        self.lon = lon if lon is not None else array('d')
+
+    def add(self, points):
+        """Thêm một dãy điểm trung gian [(lat, lon)], trả về số dòng."""
+        for lat, lon in points:
+            self.lat.append(lat)
+            self.lon.append(lon)
+        self.offsets.append(len(self.lat))
+        return len(self.offsets) - 2
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def points(self, code):
+        """Các điểm trung gian theo chiều của cạnh có mã code."""
+        row = code >> 1
+        start, end = self.offsets[row], self.offsets[row + 1]
+        points = list(zip(self.lat[start:end], self.lon[start:end]))
+        if code & 1:
+            points.reverse()
+        return points
+
+    def to_json(self):
+        """Chuỗi JSON các mảng, lưu làm thuộc tính đồ thị trong file GraphML."""
+        return json.dumps({'offsets': self.offsets.tolist(), 'lat': self.lat.tolist(), 'lon': self.lon.tolist()})
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls(array('q', data['offsets']), array('d', data['lat']), array('d', data['lon']))
+
+def ensure_edge_geometry(G):
+    """
+    Chuyển chuỗi JSON trong G.graph['edge_geometry'] (khi đọc từ GraphML) thành EdgeGeometry.
+    Trả về None nếu đồ thị chưa gộp chuỗi (mọi cạnh là đoạn thẳng).
+    """
+    geometry = G.graph.get('edge_geometry')
+    if isinstance(geometry, str):
+        geometry = G.graph['edge_geometry'] = EdgeGeometry.from_json(geometry)
+    return geometry
+
+def edge_points(G, data):
+    """
+    Điểm trung gian [(lat, lon)] của cạnh có thuộc tính data: 'points' (cạnh tách tại
+    node ảo của lớp phủ) hoặc mã 'geometry' trong bảng G.graph['edge_geometry'].
+    """
+    points = data.get('points')
+    if points is not None:
+        return list(points)
+    code = data.get('geometry')
+    if code is None:
+        return []
+    return G.graph['edge_geometry'].points(code)
+
+def has_geometry(data):
+    return 'points' in data or 'geometry' in data
+
+def edge_polyline(G, u, v, data):
+    """Dãy điểm (lat, lon) của cạnh (u, v) từ u đến v, gồm cả hai đầu."""
+    start, end = G.nodes[u], G.nodes[v]
+    return [(start['lat'], start['lon'])] + edge_points(G, data) + [(end['lat'], end['lon'])]
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * R_EARTH_KM * math.asin(min(1.0, math.sqrt(h)))
+
+def polyline_length_km(points):
+    return sum(haversine_km(*a, *b) for a, b in zip(points, points[1:]))
+
+def edge_length_km(G, u, v, data):
+    return polyline_length_km(edge_polyline(G, u, v, data))
+
+def _planar_offsets(points):
+    """Độ dài cộng dồn (theo độ, phẳng) dọc dãy điểm, cùng thước đo với t của project_to_edge."""
+    offsets = [0.0]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        offsets.append(offsets[-1] + math.hypot(x2 - x1, y2 - y1))
+    return offsets
+
+def polyline_fraction(points, segment, t):
+    """Vị trí (0..1) dọc dãy điểm của điểm nằm ở tỉ lệ t trên đoạn thứ segment."""
+    offsets = _planar_offsets(points)
+    total = offsets[-1]
+    if total == 0:
+        return 0.0
+    return (offsets[segment] + t * (offsets[segment + 1] - offsets[segment])) / total
+
+def split_points(points, fraction):
+    """
+    Chia dãy điểm (gồm hai đầu) tại vị trí fraction dọc dãy. Trả về (điểm trung gian trước,
+    điểm trung gian sau) điểm chia; điểm trùng đúng vị trí chia bị bỏ.
+    """
+    offsets = _planar_offsets(points)
+    at = fraction * offsets[-1]
+    interior = list(zip(points[1:-1], offsets[1:-1]))
+    return [p for p, d in interior if d < at], [p for p, d in interior if d > at]
@@ -0,0 +1,245 @@
+import os
+import hashlib
+import logging
+import zipfile
+import threading
+from array import array
+from xml.sax.saxutils import escape
+import networkx as nx
+import numpy as np
+from way_table import WayTable, ensure_way_table
+from edge_geometry import EdgeGeometry, ensure_edge_geometry
+
+def graph_cache_path_for(graphml_file):
+    """Đường dẫn file cache nhị phân nằm cạnh file GraphML."""
+    return os.path.splitext(graphml_file)[0] + '.graph.npz'
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def temp_path_for(path):
+    """File tạm cạnh path, riêng cho từng tiến trình và luồng (ghi song song không đè nhau)."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def save_npz_atomic(path, **arrays):
+    """
+    np.savez vào file tạm riêng trong cùng thư mục rồi os.replace, để tiến trình khác
+    (hoặc lần chạy sau một sự cố) không bao giờ đọc phải file ghi dở.
+    """
+    tmp_path = temp_path_for(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _pack_strings(strings):
+    """Gộp danh sách chuỗi thành (bytes UTF-8 nối liền, offsets)."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def _unpack_strings(blob, offsets):
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[bounds[i]:bounds[i + 1]].decode('utf-8') for i in range(len(bounds) - 1)]
+
+def write_graphml(G, graphml_file):
+    """
+    Ghi đồ thị ra GraphML; bảng way và bảng hình học cạnh được ghi thành chuỗi JSON
+    thuộc tính của đồ thị.
+    """
+    table = G.graph.get('way_table')
+    geometry = G.graph.get('edge_geometry')
+    if isinstance(table, WayTable):
+        G.graph['way_table'] = table.to_json()
+    if isinstance(geometry, EdgeGeometry):
+        G.graph['edge_geometry'] = geometry.to_json()
+    try:
+        nx.write_graphml(G, graphml_file)
+    finally:
+        if table is not None:
+            G.graph['way_table'] = table
+        if geometry is not None:
+            G.graph['edge_geometry'] = geometry
+
+def save_graph_cache(G, graphml_file, cache_file=None):
+    """
+    Ghi đồ thị ra file .npz: mảng node/tọa độ, mảng cạnh/trọng số/số dòng way/mã hình học, các cột
+    của bảng way, bảng hình học cạnh gộp và (với đồ thị cũ) bảng tags, mỗi chuỗi chỉ lưu một lần. Kèm mtime, kích thước
+    và SHA-256 của file GraphML nguồn để kiểm tra.
+    Thứ tự node và cạnh giữ như G để đồ thị tải lại giống hệt khi đọc GraphML.
+    """
+    table = ensure_way_table(G)
+    nodes = list(G.nodes())
+    tag_ids = {}
+    src, dst, weight, way, tag_index, geometry = [], [], [], [], [], []
+    for u, v, data in G.edges(data=True):
+        src.append(u)
+        dst.append(v)
+        weight.append(data['weight'])
+        way.append(data.get('way', -1))
+        geometry.append(data.get('geometry', -1))
+        tags = data.get('tags')
+        tag_index.append(-1 if tags is None else tag_ids.setdefault(tags, len(tag_ids)))
+    return save_graph_cache_arrays(graphml_file, nodes,
+                                   [G.nodes[n]['lat'] for n in nodes], [G.nodes[n]['lon'] for n in nodes],
+                                   src, dst, weight, way, table,
+                                   tags=list(tag_ids), tag_index=tag_index,
+                                   geometry=geometry, edge_geometry=ensure_edge_geometry(G), cache_file=cache_file)
+
+def save_graph_cache_arrays(graphml_file, node_ids, lat, lon, src, dst, weight, way, table,
+                            tags=(), tag_index=None, geometry=None, edge_geometry=None, cache_file=None):
+    """
+    Ghi cache .npz trực tiếp từ các mảng (src/dst là id node), không cần đồ thị networkx.
+    geometry là mã hình học của từng cạnh (-1 nếu là đoạn thẳng) trong bảng edge_geometry.
+    """
+    cache_file = cache_file or graph_cache_path_for(graphml_file)
+    if tag_index is None:
+        tag_index = np.full(len(src), -1, dtype=np.int32)
+    if edge_geometry is None:
+        geometry, edge_geometry = np.full(len(src), -1, dtype=np.int64), EdgeGeometry()
+        has_geometry = False
+    else:
+        has_geometry = True
+    tags_blob, tags_offsets = _pack_strings(list(tags))
+    way_ids_blob, way_ids_offsets = _pack_strings(table.way_ids)
+    strings_blob, strings_offsets = _pack_strings(table.strings)
+    stat = os.stat(graphml_file)
+    save_npz_atomic(cache_file,
+                    node_ids=np.asarray(node_ids, dtype=np.int64),
+                    lat=np.asarray(lat, dtype=np.float64),
+                    lon=np.asarray(lon, dtype=np.float64),
+                    src=np.asarray(src, dtype=np.int64),
+                    dst=np.asarray(dst, dtype=np.int64),
+                    weight=np.asarray(weight, dtype=np.float64),
+                    way=np.asarray(way, dtype=np.int32),
+                    tag_index=np.asarray(tag_index, dtype=np.int32),
+                    geometry=np.asarray(geometry, dtype=np.int64),
+                    has_geometry=np.bool_(has_geometry),
+                    geometry_offsets=np.frombuffer(edge_geometry.offsets, dtype=np.int64),
+                    geometry_lat=np.frombuffer(edge_geometry.lat, dtype=np.float64),
+                    geometry_lon=np.frombuffer(edge_geometry.lon, dtype=np.float64),
+                    tags_blob=tags_blob,
+                    tags_offsets=tags_offsets,
+                    way_ids_blob=way_ids_blob,
+                    way_ids_offsets=way_ids_offsets,
+                    strings_blob=strings_blob,
+                    strings_offsets=strings_offsets,
+                    highway=np.frombuffer(table.highway_codes, dtype=np.int32),
+                    maxspeed=np.frombuffer(table.maxspeed_codes, dtype=np.int32),
+                    name=np.frombuffer(table.name_codes, dtype=np.int32),
+                    oneway=np.frombuffer(bytes(table.oneway_flags), dtype=np.uint8),
+                    source_mtime_ns=np.int64(stat.st_mtime_ns),
+                    source_size=np.int64(stat.st_size),
+                    source_sha256=np.frombuffer(file_sha256(graphml_file).encode('ascii'), dtype=np.uint8))
+    logging.info(f"Đã lưu cache đồ thị nhị phân vào {cache_file} ({len(node_ids)} node, {len(src)} cạnh, {len(tags)} tags)")
+    return cache_file
+
+def write_graphml_arrays(graphml_file, node_ids, lat, lon, offsets, targets, weights, ways, table,
+                         geometry=None, edge_geometry=None):
+    """
+    Ghi GraphML trực tiếp từ mảng CSR (chỉ số node), từng dòng một, không dựng đồ thị networkx.
+    Định dạng giống nx.write_graphml nên load_graph đọc được như bình thường.
+    geometry/edge_geometry (nếu có) là mã hình học từng cạnh và bảng hình học cạnh gộp.
+    """
+    with open(graphml_file, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+                'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+                'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n')
+        if edge_geometry is not None:
+            f.write('  <key id="d6" for="graph" attr.name="edge_geometry" attr.type="string" />\n')
+            f.write('  <key id="d5" for="edge" attr.name="geometry" attr.type="long" />\n')
+        f.write('  <key id="d4" for="edge" attr.name="way" attr.type="long" />\n')
+        f.write('  <key id="d3" for="edge" attr.name="weight" attr.type="double" />\n')
+        f.write('  <key id="d2" for="node" attr.name="lon" attr.type="double" />\n')
+        f.write('  <key id="d1" for="node" attr.name="lat" attr.type="double" />\n')
+        f.write('  <key id="d0" for="graph" attr.name="way_table" attr.type="string" />\n')
+        f.write('  <graph edgedefault="directed">\n')
+        for node, y, x in zip(node_ids, lat, lon):
+            f.write(f'    <node id="{node}">\n      <data key="d1">{y!r}</data>\n      <data key="d2">{x!r}</data>\n    </node>\n')
+        for u in range(len(node_ids)):
+            source = node_ids[u]
+            for e in range(offsets[u], offsets[u + 1]):
+                f.write(f'    <edge source="{source}" target="{node_ids[targets[e]]}">\n'
+                        f'      <data key="d3">{weights[e]!r}</data>\n')
+                if ways[e] >= 0:
+                    f.write(f'      <data key="d4">{ways[e]}</data>\n')
+                if geometry is not None and geometry[e] >= 0:
+                    f.write(f'      <data key="d5">{geometry[e]}</data>\n')
+                f.write('    </edge>\n')
+        f.write(f'    <data key="d0">{escape(table.to_json())}</data>\n')
+        if edge_geometry is not None:
+            f.write(f'    <data key="d6">{edge_geometry.to_json()}</data>\n')
+        f.write('  </graph>\n</graphml>\n')
+    logging.info(f"Đã ghi GraphML {graphml_file} ({len(node_ids)} node, {len(targets)} cạnh)")
+
+def load_graph_cache(graphml_file, cache_file=None):
+    """
+    Tải đồ thị từ cache nhị phân nếu còn khớp với file GraphML: cùng mtime và kích thước,
+    hoặc (khi mtime đổi, ví dụ sau khi sao chép) cùng SHA-256. Trả về None nếu không dùng được.
+    """
+    cache_file = cache_file or graph_cache_path_for(graphml_file)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as data:
+            stat = os.stat(graphml_file)
+            if int(data['source_mtime_ns']) != stat.st_mtime_ns or int(data['source_size']) != stat.st_size:
+                if data['source_sha256'].tobytes().decode('ascii') != file_sha256(graphml_file):
+                    logging.warning(f"Cache {cache_file} không khớp với {graphml_file}, bỏ qua")
+                    return None
+            node_ids = data['node_ids'].tolist()
+            lat = data['lat'].tolist()
+            lon = data['lon'].tolist()
+            src = data['src'].tolist()
+            dst = data['dst'].tolist()
+            weight = data['weight'].tolist()
+            way = data['way'].tolist()
+            tag_index = data['tag_index'].tolist()
+            # Cache ghi trước khi có hình học cạnh gộp không có các mảng này
+            edge_geometry = None
+            geometry = [-1] * len(src)
+            if 'has_geometry' in data.files and bool(data['has_geometry']):
+                geometry = data['geometry'].tolist()
+                edge_geometry = EdgeGeometry(array('q', data['geometry_offsets'].astype(np.int64).tobytes()),
+                                             array('d', data['geometry_lat'].astype(np.float64).tobytes()),
+                                             array('d', data['geometry_lon'].astype(np.float64).tobytes()))
+            tags = _unpack_strings(data['tags_blob'], data['tags_offsets'])
+            table = WayTable.from_columns(_unpack_strings(data['way_ids_blob'], data['way_ids_offsets']),
+                                          _unpack_strings(data['strings_blob'], data['strings_offsets']),
+                                          data['highway'].tolist(), data['maxspeed'].tolist(),
+                                          data['name'].tolist(), data['oneway'].tolist())
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        # File cache hỏng (ví dụ ghi dở) coi như không có cache
+        logging.warning(f"Không đọc được cache {cache_file}: {e}")
+        return None
+
+    def edge_data(w, row, t, code):
+        data = {'weight': w}
+        if row != -1:
+            data['way'] = row
+        if code != -1:
+            data['geometry'] = code
+        if t != -1:
+            data['tags'] = tags[t]
+        return data
+
+    G = nx.DiGraph(way_table=table)
+    if edge_geometry is not None:
+        G.graph['edge_geometry'] = edge_geometry
+    G.add_nodes_from((node, {'lat': y, 'lon': x}) for node, y, x in zip(node_ids, lat, lon))
+    G.add_edges_from((u, v, edge_data(w, row, t, code))
+                     for u, v, w, row, t, code in zip(src, dst, weight, way, tag_index, geometry))
+    logging.info(f"Đã tải đồ thị từ cache {cache_file}")
+    return G
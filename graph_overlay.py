@@ -0,0 +1,218 @@
+import heapq
+import logging
+from edge_geometry import edge_polyline, has_geometry, split_points
+
+class _OverlayNodes:
+    """Truy cập thuộc tính node (lat, lon) của đồ thị gốc và các node ảo."""
+    def __init__(self, overlay):
+        self._overlay = overlay
+
+    def __getitem__(self, node):
+        virtual = self._overlay.virtual_nodes.get(node)
+        if virtual is not None:
+            return virtual
+        return self._overlay.base.nodes[node]
+
+    def __contains__(self, node):
+        return node in self._overlay.virtual_nodes or node in self._overlay.base.nodes
+
+    def __iter__(self):
+        yield from self._overlay.base.nodes
+        yield from self._overlay.virtual_nodes
+
+    def __len__(self):
+        return len(self._overlay.base.nodes) + len(self._overlay.virtual_nodes)
+
+class GraphOverlay:
+    """
+    Lớp phủ nhẹ cho một truy vấn, đặt trên đồ thị gốc dùng chung và chỉ đọc.
+    Lưu node ảo, cạnh thêm/ghi đè và cạnh bị xóa mà không sao chép đồ thị gốc.
+    Hỗ trợ phần giao diện DiGraph mà routing sử dụng (nodes, neighbors, G[u][v], ...).
+    """
+    def __init__(self, base):
+        self.base = base
+        self.graph = base.graph  # Dùng chung các chỉ mục đã xây khi tải đồ thị
+        self.virtual_nodes = {}  # {node ảo: {'lat': ..., 'lon': ...}}
+        self.splits = {}  # {node ảo: (u, v, t)} cạnh bị tách và vị trí tách
+        self._succ = {}  # {u: {v: data}} cạnh thêm hoặc ghi đè
+        self._pred = {}  # {v: {u: data}}
+        self._removed = set()  # Cạnh của đồ thị gốc bị ẩn
+        self._touched_succ = set()  # Node có danh sách cạnh ra khác đồ thị gốc
+        self._touched_pred = set()  # Node có danh sách cạnh vào khác đồ thị gốc
+        self._next_virtual_id = -1  # Node ảo dùng id âm để không trùng id OSM
+        self.nodes = _OverlayNodes(self)
+
+    def add_virtual_node(self, lat, lon):
+        node = self._next_virtual_id
+        self._next_virtual_id -= 1
+        self.virtual_nodes[node] = {'lat': lat, 'lon': lon}
+        return node
+
+    def is_virtual(self, node):
+        return node in self.virtual_nodes
+
+    def modifies_base_weights(self):
+        """
+        True nếu lớp phủ thay đổi đồ thị gốc ngoài việc tách cạnh tại node ảo
+        (cạnh bị phạt hoặc bị xóa do giao thông).
+        """
+        split_edges = set()
+        for u, v, _ in self.splits.values():
+            split_edges.add((u, v))
+            split_edges.add((v, u))
+        if any(edge not in split_edges for edge in self._removed):
+            return True
+        return any(u not in self.virtual_nodes and v not in self.virtual_nodes
+                   for u, nbrs in self._succ.items() for v in nbrs)
+
+    def successors_modified(self, u):
+        """True nếu danh sách cạnh ra của u khác đồ thị gốc (node ảo, cạnh bị phạt/xóa)."""
+        return u in self._touched_succ or u in self.virtual_nodes
+
+    def predecessors_modified(self, v):
+        """True nếu danh sách cạnh vào của v khác đồ thị gốc."""
+        return v in self._touched_pred or v in self.virtual_nodes
+
+    def _base_succ(self, u):
+        if u in self.virtual_nodes or u not in self.base.nodes:
+            return {}
+        return self.base[u]
+
+    def _base_pred(self, v):
+        if v in self.virtual_nodes or v not in self.base.nodes:
+            return {}
+        return self.base.pred[v]
+
+    def __getitem__(self, u):
+        if u not in self._touched_succ:
+            return self._base_succ(u)
+        adj = {v: data for v, data in self._base_succ(u).items() if (u, v) not in self._removed}
+        adj.update(self._succ.get(u, {}))
+        return adj
+
+    @property
+    def pred(self):
+        return _OverlayPred(self)
+
+    def _pred_of(self, v):
+        if v not in self._touched_pred:
+            return self._base_pred(v)
+        adj = {u: data for u, data in self._base_pred(v).items() if (u, v) not in self._removed}
+        adj.update(self._pred.get(v, {}))
+        return adj
+
+    def neighbors(self, u):
+        return iter(self[u])
+
+    successors = neighbors
+
+    def predecessors(self, v):
+        return iter(self._pred_of(v))
+
+    def has_node(self, node):
+        return node in self.nodes
+
+    def has_edge(self, u, v):
+        return v in self[u]
+
+    def get_edge_data(self, u, v, default=None):
+        return self[u].get(v, default)
+
+    def edges(self, data=False):
+        for u in self.nodes:
+            for v, attr in self[u].items():
+                yield (u, v, attr) if data else (u, v)
+
+    def virtual_edges(self):
+        """Các cạnh có ít nhất một đầu là node ảo."""
+        return [(u, v) for u, nbrs in self._succ.items() for v in nbrs
+                if u in self.virtual_nodes or v in self.virtual_nodes]
+
+    def add_edge(self, u, v, **attr):
+        self._succ.setdefault(u, {})[v] = attr
+        self._pred.setdefault(v, {})[u] = attr
+        self._touched_succ.add(u)
+        self._touched_pred.add(v)
+
+    def remove_edge(self, u, v):
+        found = False
+        if v in self._succ.get(u, {}):
+            del self._succ[u][v]
+            del self._pred[v][u]
+            found = True
+        if v in self._base_succ(u):
+            self._removed.add((u, v))
+            found = True
+        if not found:
+            raise KeyError(f"Cạnh ({u}, {v}) không có trong đồ thị")
+        self._touched_succ.add(u)
+        self._touched_pred.add(v)
+
+    def base_frontier(self, start, backward=False):
+        """
+        Khoảng cách từ start (có thể là node ảo) đến các node gốc đầu tiên gặp được
+        khi chỉ đi qua node ảo (chiều lùi theo cạnh vào nếu backward).
+        Trả về {node gốc: (khoảng cách, [đường đi từ start])}.
+        """
+        if start not in self.virtual_nodes:
+            return {start: (0.0, [start])}
+        frontier = {}
+        visited = set()
+        heap = [(0.0, start, [start])]
+        while heap:
+            dist, node, path = heapq.heappop(heap)
+            if node in visited:
+                continue
+            visited.add(node)
+            neighbors = self._pred_of(node) if backward else self[node]
+            for neighbor, data in neighbors.items():
+                new_dist = dist + data['weight']
+                if neighbor in self.virtual_nodes:
+                    heapq.heappush(heap, (new_dist, neighbor, path + [neighbor]))
+                elif neighbor not in frontier or new_dist < frontier[neighbor][0]:
+                    frontier[neighbor] = (new_dist, path + [neighbor])
+        return frontier
+
+    def split_edge(self, u, v, t, lat, lon):
+        """
+        Tách cạnh (u, v) (và cạnh ngược nếu có) tại vị trí t bằng một node ảo mới.
+        Trọng số được chia theo tỉ lệ t. Cạnh gộp từ chuỗi node bậc 2 được chia cả
+        hình học: hai nửa mang điểm trung gian riêng trong thuộc tính 'points'.
+        Trả về id node ảo.
+        """
+        edge_data = self.get_edge_data(u, v)
+        reverse_data = self.get_edge_data(v, u)
+        before, after = [], []
+        if has_geometry(edge_data):
+            before, after = split_points(edge_polyline(self, u, v, edge_data), t)
+
+        new_node = self.add_virtual_node(lat, lon)
+        self.splits[new_node] = (u, v, t)
+
+        def piece(data, weight, points):
+            attr = {key: value for key, value in data.items() if key not in ('geometry', 'points')}
+            attr['weight'] = weight
+            if has_geometry(data):
+                attr['points'] = tuple(points)
+            return attr
+
+        self.add_edge(u, new_node, **piece(edge_data, edge_data['weight'] * t, before))
+        self.add_edge(new_node, v, **piece(edge_data, edge_data['weight'] * (1 - t), after))
+        if reverse_data is not None:
+            self.add_edge(v, new_node, **piece(reverse_data, reverse_data['weight'] * (1 - t), after[::-1]))
+            self.add_edge(new_node, u, **piece(reverse_data, reverse_data['weight'] * t, before[::-1]))
+
+        self.remove_edge(u, v)
+        if reverse_data is not None:
+            self.remove_edge(v, u)
+
+        logging.debug(f"Tách cạnh ({u}, {v}) tại t={t:.3f} bằng node ảo {new_node}")
+        return new_node
+
+class _OverlayPred:
+    """Truy cập G.pred[v] trên lớp phủ."""
+    def __init__(self, overlay):
+        self._overlay = overlay
+
+    def __getitem__(self, v):
+        return self._overlay._pred_of(v)
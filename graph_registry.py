@@ -0,0 +1,83 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from graph_utils import load_graph
+
+GRAPH_FILE = 'road_network.graphml'
+
+class GraphRegistry:
+    """
+    Đồ thị dùng chung trong tiến trình: mỗi file GraphML được tải một lần trên luồng nền
+    (preload) và mọi cửa sổ dùng chung cùng một đối tượng, kể cả qua các lần đăng xuất/đăng nhập.
+    Lần tải lỗi được báo qua status() và tải lại ở lần preload/get sau.
+    """
+    def __init__(self, loader=load_graph):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._futures = {}  # {graphml_file: Future}
+
+    def preload(self, graphml_file=GRAPH_FILE):
+        """Bắt đầu tải đồ thị trên luồng nền nếu chưa tải. Trả về Future của đồ thị."""
+        with self._lock:
+            future = self._futures.get(graphml_file)
+            # Lần tải lỗi được thử lại ở lần gọi sau
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+            future = self._futures[graphml_file] = Future()
+            future.set_running_or_notify_cancel()
+        threading.Thread(target=self._load, args=(graphml_file, future),
+                         name=f"graph-preload-{graphml_file}", daemon=True).start()
+        logging.info(f"Bắt đầu tải nền đồ thị {graphml_file}")
+        return future
+
+    def _load(self, graphml_file, future):
+        started = time.perf_counter()
+        try:
+            graph = self.loader(graphml_file)
+            if graph is None:
+                raise RuntimeError(f"Không thể tải đồ thị {graphml_file}")
+        except Exception as e:
+            logging.error(f"Tải nền đồ thị {graphml_file} thất bại: {e}")
+            future.set_exception(e)
+            return
+        logging.info(f"Đồ thị {graphml_file} sẵn sàng sau {time.perf_counter() - started:.2f} s")
+        future.set_result(graph)
+
+    def get(self, graphml_file=GRAPH_FILE, timeout=None):
+        """Đồ thị đã tải; chờ nếu đang tải (bắt đầu tải nếu chưa). Ném lại lỗi của lần tải."""
+        return self.preload(graphml_file).result(timeout)
+
+    def status(self, graphml_file=GRAPH_FILE):
+        """'idle' (chưa tải), 'loading', 'ready' hoặc 'failed'."""
+        with self._lock:
+            future = self._futures.get(graphml_file)
+        if future is None:
+            return 'idle'
+        if not future.done():
+            return 'loading'
+        return 'failed' if future.exception() is not None else 'ready'
+
+    def is_ready(self, graphml_file=GRAPH_FILE):
+        return self.status(graphml_file) == 'ready'
+
+    def when_ready(self, callback, graphml_file=GRAPH_FILE):
+        """
+        Gọi callback(đồ thị, lỗi) khi tải xong (ngay lập tức nếu đã xong). Callback có thể chạy
+        trên luồng nền: giao diện Qt cần chuyển về luồng chính bằng signal.
+        """
+        def done(future):
+            error = future.exception()
+            try:
+                callback(None if error else future.result(), error)
+            except Exception as e:
+                logging.warning(f"Lỗi trong callback trạng thái đồ thị: {e}")
+        self.preload(graphml_file).add_done_callback(done)
+
+    def discard(self, graphml_file=GRAPH_FILE):
+        """Bỏ đồ thị khỏi registry (ví dụ sau khi file GraphML được cập nhật); lần get sau tải lại."""
+        with self._lock:
+            self._futures.pop(graphml_file, None)
+
+# Registry chung của tiến trình
+graph_registry = GraphRegistry()
@@ -1,6 +1,18 @@
 import logging
 import networkx as nx
-import json
+import os
+import numpy as np
+from spatial_index import EdgeGridIndex
+from way_index import WayIndex
+from routing_engine import CSRGraph
+from contraction import ContractionHierarchy, ch_path_for
+from landmarks import LandmarkTables, landmark_path_for
+from route_cache import RouteCache
+from connectivity import ConnectivityIndex
+from graph_cache import load_graph_cache, save_graph_cache
+from way_table import ensure_way_table
+from edge_geometry import ensure_edge_geometry, edge_points, edge_polyline
+from mapped_graph import MappedGraph, mapped_path_for, write_mapped_graph
 
 # Thiết lập logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,16 +23,81 @@ def load_graph(graphml_file):
     """
     logging.info(f"Tải đồ thị từ file GraphML: {graphml_file}")
     try:
-        G = nx.read_graphml(graphml_file, node_type=int)
-        for node, data in G.nodes(data=True):
-            data['lat'] = float(data['lat'])
-            data['lon'] = float(data['lon'])
+        # Ưu tiên cache nhị phân cạnh file GraphML, tránh phân tích XML khi khởi động
+        G = load_graph_cache(graphml_file)
+        if G is None:
+            G = nx.read_graphml(graphml_file, node_type=int)
+            for node, data in G.nodes(data=True):
+                data['lat'] = float(data['lat'])
+                data['lon'] = float(data['lon'])
+            # Bảng thuộc tính way (chuyển từ JSON tags nếu là file GraphML cũ)
+            ensure_way_table(G)
+            # Hình học của các cạnh gộp chuỗi node bậc 2 (nếu đồ thị đã được rút gọn)
+            ensure_edge_geometry(G)
+            try:
+                save_graph_cache(G, graphml_file)
+            except OSError as e:
+                logging.warning(f"Không ghi được cache đồ thị: {e}")
         logging.info(f"Đã tải đồ thị với {G.number_of_nodes()} node và {G.number_of_edges()} cạnh")
+        # Xây chỉ mục không gian một lần để snap điểm không phải duyệt mọi cạnh
+        G.graph['spatial_index'] = EdgeGridIndex.from_graph(G)
+        # Chỉ mục way_id <-> cạnh cho việc áp dụng trạng thái giao thông
+        G.graph['way_index'] = WayIndex.from_graph(G)
+        # Đồ thị dạng mảng CSR cho A*
+        G.graph['csr'] = CSRGraph.from_networkx(G)
+        # Thành phần liên thông mạnh để loại nhanh các cặp điểm không có đường
+        G.graph['connectivity'] = ConnectivityIndex.from_csr(G.graph['csr'])
+        _attach_preprocessed(G, graphml_file)
         return G
     except Exception as e:
         logging.error(f"Lỗi tải đồ thị: {str(e)}")
         raise
 
+def _attach_preprocessed(G, graphml_file):
+    """Gắn dữ liệu tiền xử lý nằm cạnh file GraphML (CH, landmark) và cache tuyến đường."""
+    # Contraction Hierarchies đã tiền xử lý (nếu có và còn khớp với đồ thị)
+    ch_file = ch_path_for(graphml_file)
+    if os.path.exists(ch_file):
+        hierarchy = ContractionHierarchy.load(ch_file)
+        if hierarchy.matches(G.graph['csr']):
+            G.graph['ch'] = hierarchy
+            logging.info(f"Đã tải Contraction Hierarchies từ {ch_file}")
+        else:
+            logging.warning(f"File {ch_file} không khớp với đồ thị, bỏ qua")
+    # Bảng landmark cho heuristic ALT
+    landmark_file = landmark_path_for(graphml_file)
+    if os.path.exists(landmark_file):
+        tables = LandmarkTables.load(landmark_file)
+        if tables.matches(G.graph['csr']):
+            G.graph['landmarks'] = tables
+            logging.info(f"Đã tải {len(tables.landmarks)} landmark từ {landmark_file}")
+        else:
+            logging.warning(f"File {landmark_file} không khớp với đồ thị, bỏ qua")
+    # Cache LRU cho kết quả find_route
+    G.graph['route_cache'] = RouteCache()
+
+def load_shared_graph(graphml_file):
+    """
+    Tải đồ thị chỉ đọc dùng chung giữa các tiến trình qua file ánh xạ bộ nhớ (.graph.bin).
+    Nếu file chưa có hoặc không khớp với GraphML thì tải đồ thị bình thường và ghi lại file.
+    Kết quả dùng được với find_route và find_nearest_way như đồ thị networkx.
+    """
+    path = mapped_path_for(graphml_file)
+    if os.path.exists(path):
+        try:
+            G = MappedGraph(path)
+            if G.matches_source(graphml_file):
+                _attach_preprocessed(G, graphml_file)
+                return G
+            logging.warning(f"File {path} không khớp với {graphml_file}, ghi lại")
+            G.close()
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Không đọc được {path}: {e}")
+    write_mapped_graph(load_graph(graphml_file), graphml_file, path)
+    G = MappedGraph(path)
+    _attach_preprocessed(G, graphml_file)
+    return G
+
 def distance_point_to_segment(px, py, x1, y1, x2, y2):
     """
     Tính khoảng cách từ điểm (px, py) đến đoạn thẳng từ (x1, y1) đến (x2, y2).
@@ -35,95 +112,155 @@ def distance_point_to_segment(px, py, x1, y1, x2, y2):
     projection_y = y1 + t * dy
     return ((px - projection_x) ** 2 + (py - projection_y) ** 2) ** 0.5
 
-def find_nearest_way(lat, lon, graph):
+def find_nearest_way(lat, lon, graph, max_distance_m=50):
     """
-    Tìm đoạn đường gần nhất với tọa độ (lat, lon) bằng cách duyệt tất cả các cạnh trong đồ thị.
-    Trả về way_id và danh sách tọa độ của các node trên đoạn đường đó, sắp xếp theo thứ tự liên tục.
+    Tìm đoạn đường gần nhất với tọa độ (lat, lon) qua chỉ mục lưới của đồ thị.
+    Trả về way_id và danh sách tọa độ các node của way theo thứ tự dọc way (lấy từ chỉ mục way).
     """
     try:
-        min_dist = float('inf')
-        nearest_way_id = None
-        nearest_way_nodes = []
-        nearest_edge = None
-        
-        # Duyệt qua tất cả các cạnh trong đồ thị
-        for u, v, data in graph.edges(data=True):
+        index = graph.graph.get('spatial_index')
+        if index is None:
+            index = graph.graph['spatial_index'] = EdgeGridIndex.from_graph(graph)
+        way_index = graph.graph.get('way_index')
+        if way_index is None:
+            way_index = graph.graph['way_index'] = WayIndex.from_graph(graph)
+
+        # Khoảng cách tính theo độ như trước đây, quy đổi 1 độ = 111 km
+        has_geometry = graph.graph.get('edge_geometry') is not None
+
+        def measure(u, v):
+            way_id = way_index.way_of(u, v)
+            if way_id is None:
+                return None
+            if has_geometry:
+                points = edge_polyline(graph, u, v, graph.get_edge_data(u, v))
+                return min(distance_point_to_segment(lat, lon, *a, *b)
+                           for a, b in zip(points, points[1:])) * 111, way_id
             u_lat, u_lon = graph.nodes[u]['lat'], graph.nodes[u]['lon']
             v_lat, v_lon = graph.nodes[v]['lat'], graph.nodes[v]['lon']
-            distance = distance_point_to_segment(lat, lon, u_lat, u_lon, v_lat, v_lon)
-            if distance < min_dist:
-                min_dist = distance
-                try:
-                    tags = json.loads(data['tags'])
-                    nearest_way_id = tags.get('id')
-                    if not nearest_way_id:
-                        continue
-                    nearest_edge = (u, v)
-                except (json.JSONDecodeError, KeyError):
-                    logging.warning(f"Cạnh ({u}, {v}) có tags không hợp lệ: {data.get('tags')}")
-                    continue
-        
-        if nearest_way_id and nearest_edge:
-            # Tìm tất cả các cạnh có cùng way_id để lấy đầy đủ node
-            way_nodes = set()
-            subgraph_edges = []
-            for x, y, edge_data in graph.edges(data=True):
-                try:
-                    edge_tags = json.loads(edge_data['tags'])
-                    if edge_tags.get('id') == nearest_way_id:
-                        way_nodes.add(x)
-                        way_nodes.add(y)
-                        subgraph_edges.append((x, y))
-                except (json.JSONDecodeError, KeyError):
-                    continue
-            
-            # Tạo đồ thị con từ các cạnh của way
-            subgraph = graph.edge_subgraph(subgraph_edges).copy()
-            
-            # Sắp xếp node theo đường đi liên tục
-            if way_nodes:
-                u, v = nearest_edge
-                # Chọn node đầu gần nhất với cạnh gần nhất
-                start_node = min(way_nodes, key=lambda n: ((graph.nodes[n]['lat'] - graph.nodes[u]['lat'])**2 + (graph.nodes[n]['lon'] - graph.nodes[u]['lon'])**2)**0.5)
-                
-                # Tìm đường đi bao phủ tất cả node trong way_nodes
-                sorted_nodes = [start_node]
-                remaining_nodes = way_nodes - {start_node}
-                
-                while remaining_nodes:
-                    # Tìm node tiếp theo trong đồ thị con
-                    current_node = sorted_nodes[-1]
-                    next_node = None
-                    min_path_length = float('inf')
-                    
-                    for node in remaining_nodes:
-                        if nx.has_path(subgraph, current_node, node):
-                            path = nx.shortest_path(subgraph, current_node, node)
-                            path_length = len(path)
-                            if path_length < min_path_length:
-                                min_path_length = path_length
-                                next_node = node
-                                next_path = path
-                    
-                    if next_node:
-                        # Thêm các node trong đường đi (trừ node đầu vì đã có)
-                        sorted_nodes.extend(next_path[1:])
-                        remaining_nodes.remove(next_node)
-                    else:
-                        # Nếu không tìm thấy đường đi, thêm node gần nhất theo khoảng cách Euclidean
-                        next_node = min(remaining_nodes, key=lambda n: ((graph.nodes[n]['lat'] - graph.nodes[current_node]['lat'])**2 + (graph.nodes[n]['lon'] - graph.nodes[current_node]['lon'])**2)**0.5)
-                        sorted_nodes.append(next_node)
-                        remaining_nodes.remove(next_node)
-                
-                nearest_way_nodes = [[graph.nodes[node]['lat'], graph.nodes[node]['lon']] for node in sorted_nodes]
-        
-        max_distance_m = 50
-        if nearest_way_id and min_dist * 111000 < max_distance_m:
-            logging.debug(f"Nearest way: ID={nearest_way_id}, Distance={min_dist * 111000:.2f}m, Nodes={len(nearest_way_nodes)}")
-            return nearest_way_id, nearest_way_nodes
-        else:
-            logging.warning(f"Không tìm thấy đường trong khu vực hoặc khoảng cách {min_dist * 111000:.2f}m vượt ngưỡng {max_distance_m}m")
+            return distance_point_to_segment(lat, lon, u_lat, u_lon, v_lat, v_lon) * 111, way_id
+
+        nearest = index.nearest(lat, lon, measure, max_distance_m / 1000)
+        if nearest is None:
+            logging.warning(f"Không tìm thấy đường trong bán kính {max_distance_m}m")
             return None, []
+
+        distance_km, nearest_way_id = nearest
+        nearest_way_nodes = _way_points(graph, way_index.nodes_of(nearest_way_id))
+        logging.debug(f"Nearest way: ID={nearest_way_id}, Distance={distance_km * 1000:.2f}m, Nodes={len(nearest_way_nodes)}")
+        return nearest_way_id, nearest_way_nodes
     except Exception as e:
         logging.error(f"Lỗi khi tìm đoạn đường: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def _way_points(graph, nodes):
+    """Tọa độ [lat, lon] dọc dãy node của way, mở cả điểm trung gian của các cạnh đã gộp."""
+    has_geometry = graph.graph.get('edge_geometry') is not None
+    points = []
+    for i, node in enumerate(nodes):
+        if i > 0 and has_geometry:
+            previous = nodes[i - 1]
+            data = graph.get_edge_data(previous, node)
+            if data is not None:
+                points.extend(list(point) for point in edge_points(graph, data))
+            else:
+                data = graph.get_edge_data(node, previous)
+                if data is not None:
+                    points.extend(list(point) for point in reversed(edge_points(graph, data)))
+        points.append([graph.nodes[node]['lat'], graph.nodes[node]['lon']])
+    return points
+
+# Số điểm xử lý trong một lượt của find_nearest_ways (giới hạn bộ nhớ mảng ứng viên)
+BATCH_CHUNK_SIZE = 65536
+
+def _segment_grid(graph, cell_size):
+    """
+    Mảng đoạn thẳng (lat1, lon1, lat2, lon2, way_id) của các cạnh có way, theo thứ tự cạnh
+    (cạnh gộp chuỗi cho một đoạn cho mỗi cặp điểm liên tiếp),
+    cùng danh sách (khóa ô, đoạn) đã sắp xếp cho lưới ô cell_size độ. Được cache trên đồ thị.
+    """
+    cached = graph.graph.get('segment_grid')
+    if cached is not None and cached[0] == cell_size:
+        return cached[1]
+
+    way_table = graph.graph.get('way_table')
+    if way_table is None:
+        way_table = ensure_way_table(graph)
+    rows = []
+    for u, v, data in graph.edges(data=True):
+        way = data.get('way')
+        if way is None:
+            continue
+        way_id = int(way_table.way_id(way))
+        if 'geometry' in data:
+            points = edge_polyline(graph, u, v, data)
+            rows.extend((*a, *b, way_id) for a, b in zip(points, points[1:]))
+            continue
+        u_data, v_data = graph.nodes[u], graph.nodes[v]
+        rows.append((u_data['lat'], u_data['lon'], v_data['lat'], v_data['lon'], way_id))
+    segments = np.array(rows, dtype=np.float64).reshape(-1, 5)
+    lat1, lon1, lat2, lon2 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    way_ids = segments[:, 4].astype(np.int64)
+
+    # Ô có thể chứa điểm cách đoạn không quá cell_size (hộp bao mở rộng thêm cell_size)
+    ix0 = np.floor((np.minimum(lat1, lat2) - cell_size) / cell_size).astype(np.int64)
+    ix1 = np.floor((np.maximum(lat1, lat2) + cell_size) / cell_size).astype(np.int64)
+    iy0 = np.floor((np.minimum(lon1, lon2) - cell_size) / cell_size).astype(np.int64)
+    iy1 = np.floor((np.maximum(lon1, lon2) + cell_size) / cell_size).astype(np.int64)
+    span_y = iy1 - iy0 + 1
+    counts = (ix1 - ix0 + 1) * span_y
+    segment_of = np.repeat(np.arange(len(segments)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = ix0[segment_of] + local // span_y[segment_of]
+    cell_y = iy0[segment_of] + local % span_y[segment_of]
+    keys = (cell_x << 32) | (cell_y & 0xFFFFFFFF)
+    order = np.argsort(keys, kind='stable')
+
+    grid = (lat1, lon1, lat2, lon2, way_ids, keys[order], segment_of[order])
+    graph.graph['segment_grid'] = (cell_size, grid)
+    return grid
+
+def find_nearest_ways(points, graph, max_distance_m=50):
+    """
+    Tìm way gần nhất cho nhiều tọa độ cùng lúc. points là mảng N x 2 (lat, lon).
+    Khoảng cách điểm - đoạn thẳng được tính vectơ hóa bằng NumPy trên các đoạn nằm trong
+    các ô lưới quanh điểm, cùng quy ước với find_nearest_way (theo độ, 1 độ = 111 km,
+    ngưỡng max_distance_m, bằng nhau thì lấy cạnh đứng trước).
+    Trả về (way_ids, distances): mảng int64 (-1 nếu không có way đủ gần) và khoảng cách theo mét (nan).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    cell_size = max_distance_m / 111000
+    lat1, lon1, lat2, lon2, segment_way, cell_keys, cell_segments = _segment_grid(graph, cell_size)
+
+    way_ids = np.full(len(points), -1, dtype=np.int64)
+    distances = np.full(len(points), np.nan)
+    for start in range(0, len(points), BATCH_CHUNK_SIZE):
+        chunk = points[start:start + BATCH_CHUNK_SIZE]
+        px, py = chunk[:, 0], chunk[:, 1]
+        keys = (np.floor(px / cell_size).astype(np.int64) << 32) | (np.floor(py / cell_size).astype(np.int64) & 0xFFFFFFFF)
+        lo = np.searchsorted(cell_keys, keys, side='left')
+        hi = np.searchsorted(cell_keys, keys, side='right')
+        counts = hi - lo
+        point = np.repeat(np.arange(len(chunk)), counts)
+        segment = cell_segments[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+        # Khoảng cách điểm - đoạn thẳng như distance_point_to_segment
+        x, y = px[point], py[point]
+        x1, y1 = lat1[segment], lon1[segment]
+        dx, dy = lat2[segment] - x1, lon2[segment] - y1
+        length_sq = dx * dx + dy * dy
+        degenerate = length_sq == 0
+        t = np.clip(((x - x1) * dx + (y - y1) * dy) / np.where(degenerate, 1.0, length_sq), 0, 1)
+        t[degenerate] = 0
+        distance = np.sqrt((x - (x1 + t * dx)) ** 2 + (y - (y1 + t * dy)) ** 2) * 111000
+
+        within = distance <= max_distance_m
+        point, segment, distance = point[within], segment[within], distance[within]
+        order = np.lexsort((segment, distance, point))
+        point, segment, distance = point[order], segment[order], distance[order]
+        found, first = np.unique(point, return_index=True)
+        way_ids[start + found] = segment_way[segment[first]]
+        distances[start + found] = distance[first]
+
+    logging.info(f"Tìm way gần nhất cho {len(points)} điểm, {int((way_ids >= 0).sum())} điểm có way trong {max_distance_m}m")
+    return way_ids, distances
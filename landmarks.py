@@ -0,0 +1,151 @@
+import os
+import math
+import logging
+from array import array
+import numpy as np
+
+# Số landmark mặc định chọn khi tiền xử lý
+DEFAULT_LANDMARK_COUNT = 8
+
+# Biên an toàn cho tốc độ lớn nhất (cạnh tách tại node ảo chia trọng số theo tỉ lệ phẳng)
+SPEED_MARGIN = 1.01
+
+def landmark_path_for(graphml_file):
+    """Đường dẫn file bảng landmark nằm cạnh file GraphML."""
+    return os.path.splitext(graphml_file)[0] + '.landmarks.npz'
+
+class LandmarkTables:
+    """
+    Bảng khoảng cách ALT: dist_from[i][v] = d(L_i, v), dist_to[i][v] = d(v, L_i)
+    theo chỉ số CSR, cùng tốc độ lớn nhất của đồ thị (km/h) cho cận Haversine.
+    Cận dưới dựa trên bất đẳng thức tam giác với trọng số gốc nên vẫn đúng
+    khi giao thông chỉ làm tăng trọng số hoặc xóa cạnh.
+    """
+    def __init__(self, node_ids, landmarks, dist_from, dist_to, max_speed, signature):
+        self.node_ids = node_ids  # array('q'): thứ tự chỉ số CSR khi xây bảng
+        self.landmarks = landmarks  # id node của các landmark
+        self.dist_from = dist_from  # [array('d')]
+        self.dist_to = dist_to  # [array('d')]
+        self.max_speed = max_speed
+        self.signature = signature
+
+    def matches(self, csr):
+        n, m, total = self.signature
+        n2, m2, total2 = csr.signature()
+        return n == n2 and m == m2 and math.isclose(total, total2, rel_tol=1e-9) \
+            and memoryview(self.node_ids) == memoryview(csr.node_ids)
+
+    def save(self, path):
+        np.savez_compressed(path,
+                            node_ids=np.frombuffer(self.node_ids, dtype=np.int64),
+                            landmarks=np.array(self.landmarks, dtype=np.int64),
+                            dist_from=np.array([np.frombuffer(d, dtype=np.float64) for d in self.dist_from]),
+                            dist_to=np.array([np.frombuffer(d, dtype=np.float64) for d in self.dist_to]),
+                            max_speed=np.float64(self.max_speed),
+                            signature=np.array(self.signature, dtype=np.float64))
+        logging.info(f"Đã lưu bảng {len(self.landmarks)} landmark vào {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            dist_from = [array('d', row.astype(np.float64).tobytes()) for row in data['dist_from']]
+            dist_to = [array('d', row.astype(np.float64).tobytes()) for row in data['dist_to']]
+            n, m, total = data['signature'].tolist()
+            return cls(array('q', data['node_ids'].astype(np.int64).tobytes()), data['landmarks'].tolist(), dist_from, dist_to,
+                       float(data['max_speed']), (int(n), int(m), total))
+
+    def _alt(self, v, x):
+        """Cận dưới d(v, x) theo bất đẳng thức tam giác; inf nếu chắc chắn không tới được."""
+        best = 0.0
+        for dist_from, dist_to in zip(self.dist_from, self.dist_to):
+            from_v = dist_from[v]
+            if from_v != math.inf:
+                from_x = dist_from[x]
+                if from_x == math.inf:
+                    return math.inf
+                if from_x - from_v > best:
+                    best = from_x - from_v
+            to_x = dist_to[x]
+            if to_x != math.inf:
+                to_v = dist_to[v]
+                if to_v == math.inf:
+                    return math.inf
+                if to_v - to_x > best:
+                    best = to_v - to_x
+        return best
+
+    def bound_to(self, csr, target_key, overlay=None):
+        """
+        Hàm cận dưới d(k, target) cho node gốc k. Nếu target là node ảo,
+        lấy min qua các node gốc dẫn vào nó: d(k, x) + d(x, target).
+        """
+        seeds = self._frontier(csr, target_key, overlay, backward=True)
+
+        def bound(k):
+            return min((self._alt(k, x) + d for x, d in seeds), default=math.inf)
+        return bound
+
+    def bound_from(self, csr, source_key, overlay=None):
+        """Hàm cận dưới d(source, k) cho node gốc k."""
+        seeds = self._frontier(csr, source_key, overlay, backward=False)
+
+        def bound(k):
+            return min((d + self._alt(y, k) for y, d in seeds), default=math.inf)
+        return bound
+
+    def _frontier(self, csr, key, overlay, backward):
+        if key < len(csr):
+            return [(key, 0.0)]
+        frontier = overlay.base_frontier(csr.node_of(key), backward=backward)
+        return [(csr.key_of(node), dist) for node, (dist, _) in frontier.items()]
+
+def select_landmarks(csr, count=DEFAULT_LANDMARK_COUNT):
+    """
+    Chọn landmark theo kiểu xa nhất: landmark đầu là node xa nhất (theo thời gian)
+    tính từ node gần tâm đồ thị nhất, các landmark sau là node có khoảng cách nhỏ nhất
+    tới các landmark đã chọn lớn nhất. Trả về (chỉ số landmark, bảng dist_from, bảng dist_to).
+    """
+    n = len(csr)
+    center_lat = sum(csr.lat) / n
+    center_lon = sum(csr.lon) / n
+    center = min(range(n), key=lambda k: (csr.lat[k] - center_lat) ** 2 + (csr.lon[k] - center_lon) ** 2)
+    # Bắt đầu từ vùng tới được từ tâm để không chọn landmark trên một mảnh đồ thị bị cô lập
+    from_center = csr.shortest_distances(center)
+    first = max((k for k in range(n) if from_center[k] != math.inf), key=lambda k: from_center[k])
+
+    chosen, dist_from, dist_to = [], [], []
+    nearest = array('d', [math.inf]) * n
+    candidate = first
+    while len(chosen) < min(count, n):
+        chosen.append(candidate)
+        dist_from.append(csr.shortest_distances(candidate))
+        dist_to.append(csr.shortest_distances(candidate, reverse=True))
+        for k in range(n):
+            d = min(dist_from[-1][k], dist_to[-1][k])
+            if d < nearest[k]:
+                nearest[k] = d
+        # Node xa nhất (còn tới được) so với các landmark đã chọn
+        reachable = [k for k in range(n) if nearest[k] != math.inf and k not in chosen]
+        if not reachable:
+            break
+        candidate = max(reachable, key=lambda k: nearest[k])
+    return chosen, dist_from, dist_to
+
+def max_graph_speed(csr):
+    """Tốc độ lớn nhất (km/h) trên các cạnh: độ dài cạnh (dọc hình học nếu gộp chuỗi) / trọng số thời gian."""
+    best = 0.0
+    lengths = csr.lengths
+    for u in range(len(csr)):
+        for e in range(csr.offsets[u], csr.offsets[u + 1]):
+            weight = csr.weights[e]
+            if weight > 0:
+                best = max(best, lengths[e] / weight)
+    return best * SPEED_MARGIN
+
+def build_landmark_tables(csr, count=DEFAULT_LANDMARK_COUNT):
+    """Tiền xử lý ALT: chọn landmark và tính bảng khoảng cách tiến/lùi."""
+    chosen, dist_from, dist_to = select_landmarks(csr, count)
+    tables = LandmarkTables(array('q', csr.node_ids), [csr.node_ids[k] for k in chosen], dist_from, dist_to,
+                            max_graph_speed(csr), csr.signature())
+    logging.info(f"Đã chọn {len(chosen)} landmark, tốc độ lớn nhất {tables.max_speed:.1f} km/h")
+    return tables
@@ -0,0 +1,102 @@
+import os
+import logging
+from PyQt5.QtCore import QBuffer, QIODevice
+from PyQt5.QtWebEngineCore import QWebEngineUrlScheme, QWebEngineUrlSchemeHandler, QWebEngineUrlRequestJob
+from PyQt5.QtWebEngineWidgets import QWebEngineProfile
+from tile_cache import TileCache, TILE_CACHE_FILE, ASSETS_DIR, TILE_URL as ONLINE_TILE_URL, LEAFLET_URL, LEAFLET_VERSION
+
+# Trang bản đồ lấy tile và Leaflet qua mapapp:///tiles/{z}/{x}/{y}.png và mapapp:///assets/<tệp>
+MAP_SCHEME = b'mapapp'
+TILE_URL = 'mapapp:///tiles/{z}/{x}/{y}.png'
+ASSET_URL = 'mapapp:///assets/'
+
+CONTENT_TYPES = {
+    '.png': b'image/png',
+    '.js': b'application/javascript',
+    '.css': b'text/css',
+}
+
+def register_map_scheme():
+    """Đăng ký scheme mapapp với QtWebEngine; phải gọi trước khi tạo QApplication."""
+    scheme = QWebEngineUrlScheme(MAP_SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Path)
+    scheme.setFlags(QWebEngineUrlScheme.SecureScheme | QWebEngineUrlScheme.LocalScheme |
+                    QWebEngineUrlScheme.LocalAccessAllowed | QWebEngineUrlScheme.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+class MapSchemeHandler(QWebEngineUrlSchemeHandler):
+    """
+    Trả tile từ kho MBTiles và tệp Leaflet từ thư mục assets ngay trong tiến trình,
+    không qua mạng. Tile hoặc tệp chưa có trả lỗi UrlNotFound để trang bản đồ dùng nguồn trực tuyến.
+    """
+    def __init__(self, tile_cache=None, assets_dir=ASSETS_DIR, parent=None):
+        super().__init__(parent)
+        self.tile_cache = tile_cache
+        self.assets_dir = os.path.realpath(assets_dir)
+        self.misses = 0
+
+    def _tile(self, parts):
+        if self.tile_cache is None or len(parts) != 3 or not parts[2].endswith('.png'):
+            return None
+        try:
+            zoom, x, y = int(parts[0]), int(parts[1]), int(parts[2][:-4])
+        except ValueError:
+            return None
+        return self.tile_cache.get(zoom, x, y)
+
+    def _asset(self, parts):
+        path = os.path.realpath(os.path.join(self.assets_dir, *parts))
+        # Không cho đường dẫn thoát khỏi thư mục assets
+        if not path.startswith(self.assets_dir + os.sep) or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def requestStarted(self, job):
+        parts = [part for part in job.requestUrl().path().split('/') if part]
+        data = None
+        if parts and parts[0] == 'tiles':
+            data = self._tile(parts[1:])
+        elif parts and parts[0] == 'assets':
+            data = self._asset(parts[1:])
+        if data is None:
+            self.misses += 1
+            logging.debug(f"Không có {job.requestUrl().toString()} trong bộ nhớ đệm bản đồ")
+            job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+            return
+        buffer = QBuffer(job)  # Thuộc job, giải phóng cùng request
+        buffer.setData(data)
+        buffer.open(QIODevice.ReadOnly)
+        job.reply(CONTENT_TYPES.get(os.path.splitext(parts[-1])[1], b'application/octet-stream'), buffer)
+
+# Tile chưa có trong kho: tải trực tuyến đúng tile đó (chỉ thử một lần mỗi tile)
+TILE_FALLBACK_JS = """
+baseTiles.on('tileerror', function(e) {
+    if (!e.tile.dataset.online) {
+        e.tile.dataset.online = '1';
+        e.tile.src = L.Util.template('%s', e.coords);
+    }
+});
+""" % ONLINE_TILE_URL
+
+def leaflet_asset_url(name, assets_dir=ASSETS_DIR):
+    """URL của một tệp Leaflet: bản đóng gói qua mapapp nếu có, ngược lại CDN."""
+    if os.path.isfile(os.path.join(assets_dir, *name.split('/'))):
+        return ASSET_URL + name
+    return LEAFLET_URL.format(version=LEAFLET_VERSION, name=name)
+
+_handler = None
+
+def install_map_scheme(tile_file=TILE_CACHE_FILE, assets_dir=ASSETS_DIR, profile=None):
+    """Gắn MapSchemeHandler vào profile (mặc định profile chung của mọi cửa sổ bản đồ); gọi sau khi tạo QApplication."""
+    global _handler
+    tile_cache = TileCache.open_existing(tile_file)
+    if tile_cache is None:
+        logging.warning(f"Chưa có kho tile {tile_file}, bản đồ sẽ tải tile trực tuyến (chạy tile_cache.py để tải trước)")
+    else:
+        logging.info(f"Dùng kho tile ngoại tuyến {tile_file} ({len(tile_cache)} tile)")
+    if not os.path.isdir(assets_dir):
+        logging.warning(f"Chưa có thư mục Leaflet {assets_dir}, trang bản đồ sẽ tải Leaflet trực tuyến")
+    _handler = MapSchemeHandler(tile_cache, assets_dir)
+    (profile or QWebEngineProfile.defaultProfile()).installUrlSchemeHandler(MAP_SCHEME, _handler)
+    return _handler
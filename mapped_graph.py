@@ -0,0 +1,494 @@
+import os
+import json
+import mmap
+import struct
+import logging
+from array import array
+from bisect import bisect_left
+from graph_cache import file_sha256, temp_path_for, _pack_strings
+from spatial_index import EdgeGridIndex
+from routing_engine import CSRGraph
+from connectivity import ConnectivityIndex
+from edge_geometry import EdgeGeometry
+
+MAGIC = b'MAPGRAPH'
+FORMAT_VERSION = 2
+_HEADER = struct.Struct('<8sIQ')  # magic, phiên bản, độ dài header JSON
+
+def mapped_path_for(graphml_file):
+    """Đường dẫn file đồ thị ánh xạ bộ nhớ nằm cạnh file GraphML."""
+    return os.path.splitext(graphml_file)[0] + '.graph.bin'
+
+def _cell_key(cell):
+    ix, iy = cell
+    return (ix << 32) | (iy & 0xFFFFFFFF)
+
+def _reverse_edge_ids(csr):
+    """Với mỗi vị trí trong danh sách kề ngược của CSR, chỉ số cạnh xuôi tương ứng."""
+    n = len(csr)
+    position = list(csr.rev_offsets[:n])
+    rev_edges = array('q', bytes(8 * len(csr.targets)))
+    for u in range(n):
+        for e in range(csr.offsets[u], csr.offsets[u + 1]):
+            v = csr.targets[e]
+            rev_edges[position[v]] = e
+            position[v] += 1
+    return rev_edges
+
+def _pack_lists(lists):
+    """Danh sách các danh sách số nguyên -> (offsets, giá trị) dạng CSR."""
+    offsets = array('q', [0])
+    values = array('q')
+    for items in lists:
+        values.extend(items)
+        offsets.append(len(values))
+    return offsets, values
+
+def write_mapped_graph(G, graphml_file, path=None):
+    """
+    Ghi đồ thị đã tải bằng load_graph (có CSR, chỉ mục lưới, chỉ mục way, SCC) ra một file
+    nhị phân gồm các mảng phẳng, để nhiều tiến trình cùng ánh xạ bộ nhớ một bản duy nhất.
+    File được ghi tạm rồi đổi tên nên tiến trình khác không bao giờ thấy file ghi dở.
+    """
+    path = path or mapped_path_for(graphml_file)
+    csr = G.graph['csr']
+    grid = G.graph['spatial_index']
+    way_index = G.graph['way_index']
+    way_table = G.graph['way_table']
+    connectivity = G.graph['connectivity']
+    geometry = G.graph.get('edge_geometry')
+    n = len(csr)
+
+    edge_sources = array('q')
+    edge_way = array('i')
+    edge_geometry = array('q')
+    for u in range(n):
+        node = csr.node_ids[u]
+        for e in range(csr.offsets[u], csr.offsets[u + 1]):
+            edge_sources.append(u)
+            data = G[node][csr.node_ids[csr.targets[e]]]
+            row = data.get('way')
+            edge_way.append(-1 if row is None else row)
+            edge_geometry.append(data.get('geometry', -1))
+    if geometry is None:
+        geometry = EdgeGeometry()
+
+    order = sorted(range(n), key=csr.node_ids.__getitem__)
+    cells = sorted(grid.cells.items(), key=lambda item: _cell_key(item[0]))
+    cell_offsets, cell_edges = _pack_lists(ordinals for _, ordinals in cells)
+
+    edge_position = {}
+    for e in range(len(csr.targets)):
+        edge_position[(csr.node_ids[edge_sources[e]], csr.node_ids[csr.targets[e]])] = e
+    rows = range(len(way_table))
+    way_edge_offsets, way_edge_list = _pack_lists(
+        [edge_position[edge] for edge in way_index.edges_of(way_table.way_id(row))] for row in rows)
+    way_node_offsets, way_node_list = _pack_lists(
+        [csr.index_of[node] for node in way_index.nodes_of(way_table.way_id(row))] for row in rows)
+    way_order = sorted(rows, key=lambda row: int(way_table.way_id(row)))
+    way_ids_blob, way_ids_offsets = _pack_strings(way_table.way_ids)
+    strings_blob, strings_offsets = _pack_strings(way_table.strings)
+    comp_offsets, comp_targets = _pack_lists(sorted(succ) for succ in connectivity.component_succ)
+
+    sections = {
+        'node_ids': array('q', csr.node_ids),
+        'lat': array('d', csr.lat),
+        'lon': array('d', csr.lon),
+        'lat_rad': array('d', csr.lat_rad),
+        'lon_rad': array('d', csr.lon_rad),
+        'cos_lat': array('d', csr.cos_lat),
+        'sorted_ids': array('q', (csr.node_ids[i] for i in order)),
+        'sorted_index': array('q', order),
+        'offsets': array('q', csr.offsets),
+        'targets': array('q', csr.targets),
+        'weights': array('d', csr.weights),
+        'edge_sources': edge_sources,
+        'edge_way': edge_way,
+        'edge_geometry': edge_geometry,
+        'lengths': array('d', csr.lengths),
+        'geometry_offsets': array('q', geometry.offsets),
+        'geometry_lat': array('d', geometry.lat),
+        'geometry_lon': array('d', geometry.lon),
+        'rev_offsets': array('q', csr.rev_offsets),
+        'rev_sources': array('q', csr.rev_sources),
+        'rev_weights': array('d', csr.rev_weights),
+        'rev_edges': _reverse_edge_ids(csr),
+        'cell_keys': array('q', (_cell_key(cell) for cell, _ in cells)),
+        'cell_offsets': cell_offsets,
+        'cell_edges': cell_edges,
+        'way_ids_blob': array('B', way_ids_blob.tobytes()),
+        'way_ids_offsets': array('q', way_ids_offsets.tobytes()),
+        'strings_blob': array('B', strings_blob.tobytes()),
+        'strings_offsets': array('q', strings_offsets.tobytes()),
+        'highway': array('i', way_table.highway_codes),
+        'maxspeed': array('i', way_table.maxspeed_codes),
+        'name': array('i', way_table.name_codes),
+        'oneway': array('B', way_table.oneway_flags),
+        'sorted_way_ids': array('q', (int(way_table.way_id(row)) for row in way_order)),
+        'sorted_way_rows': array('q', way_order),
+        'way_edge_offsets': way_edge_offsets,
+        'way_edge_list': way_edge_list,
+        'way_node_offsets': way_node_offsets,
+        'way_node_list': way_node_list,
+        'labels': array('q', connectivity.labels),
+        'comp_offsets': comp_offsets,
+        'comp_targets': comp_targets,
+    }
+
+    stat = os.stat(graphml_file)
+    header = {
+        'cell_size': grid.cell_size,
+        'has_geometry': G.graph.get('edge_geometry') is not None,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'source_size': stat.st_size,
+        'source_sha256': file_sha256(graphml_file),
+        'sections': {},
+    }
+    position = 0
+    for name, data in sections.items():
+        header['sections'][name] = [position, len(data), data.typecode]
+        position += -(-len(data) * data.itemsize // 8) * 8  # Căn lề 8 byte
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(_HEADER.size + len(header_bytes)) % 8)
+
+    # File tạm riêng cho từng tiến trình: hai tiến trình cùng dựng lại file cũ không ghi đè lên nhau
+    tmp_path = temp_path_for(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for data in sections.values():
+                raw = data.tobytes()
+                f.write(raw)
+                f.write(b'\0' * (-len(raw) % 8))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logging.info(f"Đã ghi đồ thị ánh xạ bộ nhớ vào {path} ({n} node, {len(csr.targets)} cạnh)")
+    return path
+
+class _SortedIndex:
+    """
+    Ánh xạ id node -> chỉ số CSR bằng tìm kiếm nhị phân trên mảng id đã sắp xếp.
+    Kết quả được nhớ lại trong tiến trình, chỉ cho các node đã từng tra.
+    """
+    def __init__(self, sorted_ids, sorted_index):
+        self._ids = sorted_ids
+        self._index = sorted_index
+        self._memo = {}
+
+    def get(self, node, default=None):
+        k = self._memo.get(node)
+        if k is not None:
+            return k
+        i = bisect_left(self._ids, node)
+        if i < len(self._ids) and self._ids[i] == node:
+            k = self._memo[node] = self._index[i]
+            return k
+        return default
+
+    def __getitem__(self, node):
+        i = self.get(node)
+        if i is None:
+            raise KeyError(node)
+        return i
+
+    def __contains__(self, node):
+        return self.get(node) is not None
+
+class _CSRLists:
+    """Dãy các danh sách lưu dạng (offsets, giá trị); phần tử i là lát cắt giá trị."""
+    def __init__(self, offsets, values):
+        self._offsets = offsets
+        self._values = values
+
+    def __getitem__(self, i):
+        return self._values[self._offsets[i]:self._offsets[i + 1]]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+class _PackedStrings:
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __getitem__(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+class _MappedCells:
+    """Ô lưới của chỉ mục không gian: cells.get((ix, iy), ()) -> các thứ tự cạnh."""
+    def __init__(self, keys, lists):
+        self._keys = keys
+        self._lists = lists
+
+    def get(self, cell, default=None):
+        key = _cell_key(cell)
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return self._lists[i]
+        return default
+
+    def __len__(self):
+        return len(self._keys)
+
+class _MappedEdgeList:
+    """Thứ tự cạnh của chỉ mục lưới (trùng thứ tự cạnh CSR) -> (u, v)."""
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, e):
+        g = self._graph
+        return g.node_ids[g.edge_sources[e]], g.node_ids[g.targets[e]]
+
+    def __len__(self):
+        return len(self._graph.targets)
+
+class MappedWayTable:
+    """Cùng giao diện truy cập với WayTable, đọc trực tiếp từ các cột trong file ánh xạ."""
+    def __init__(self, graph):
+        s = graph.sections
+        self._way_ids = _PackedStrings(s['way_ids_blob'], s['way_ids_offsets'])
+        self._strings = _PackedStrings(s['strings_blob'], s['strings_offsets'])
+        self._sorted_ids = s['sorted_way_ids']
+        self._sorted_rows = s['sorted_way_rows']
+        self.highway_codes = s['highway']
+        self.maxspeed_codes = s['maxspeed']
+        self.name_codes = s['name']
+        self.oneway_flags = s['oneway']
+
+    def __len__(self):
+        return len(self._way_ids)
+
+    def row_of(self, way_id):
+        try:
+            key = int(way_id)
+        except (TypeError, ValueError):
+            return None
+        i = bisect_left(self._sorted_ids, key)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == key:
+            return self._sorted_rows[i]
+        return None
+
+    def way_id(self, row):
+        return self._way_ids[row]
+
+    def highway(self, row):
+        return self._strings[self.highway_codes[row]] or None
+
+    def maxspeed(self, row):
+        return self._strings[self.maxspeed_codes[row]] or None
+
+    def name(self, row):
+        return self._strings[self.name_codes[row]] or None
+
+    def oneway(self, row):
+        return bool(self.oneway_flags[row])
+
+class MappedWayIndex:
+    """Cùng giao diện với WayIndex (way_of, edges_of, nodes_of) trên file ánh xạ."""
+    def __init__(self, graph):
+        self._graph = graph
+        self._table = graph.graph['way_table']
+        self._way_edges = _CSRLists(graph.sections['way_edge_offsets'], graph.sections['way_edge_list'])
+        self._way_nodes = _CSRLists(graph.sections['way_node_offsets'], graph.sections['way_node_list'])
+
+    def way_of(self, u, v):
+        g = self._graph
+        e = g.edge_index(u, v)
+        if e is None or g.edge_way[e] < 0:
+            return None
+        return self._table.way_id(g.edge_way[e])
+
+    def edges_of(self, way_id):
+        row = self._table.row_of(way_id)
+        if row is None:
+            return []
+        g = self._graph
+        return [(g.node_ids[g.edge_sources[e]], g.node_ids[g.targets[e]]) for e in self._way_edges[row]]
+
+    def nodes_of(self, way_id):
+        row = self._table.row_of(way_id)
+        if row is None:
+            return []
+        return [self._graph.node_ids[k] for k in self._way_nodes[row]]
+
+class _MappedNodes:
+    """G.nodes[node] -> {'lat': ..., 'lon': ...}."""
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, node):
+        k = self._graph.index_of[node]
+        return {'lat': self._graph.lat[k], 'lon': self._graph.lon[k]}
+
+    def __contains__(self, node):
+        return node in self._graph.index_of
+
+    def __iter__(self):
+        return iter(self._graph.node_ids)
+
+    def __len__(self):
+        return len(self._graph.node_ids)
+
+class _MappedPred:
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, v):
+        return self._graph._adjacency(v, reverse=True)
+
+class MappedGraph:
+    """
+    Đồ thị chỉ đọc trên file ánh xạ bộ nhớ (mmap): mọi mảng là memoryview trên trang nhớ
+    dùng chung giữa các tiến trình, không phải phân tích hay sao chép khi khởi động.
+    Hỗ trợ phần giao diện DiGraph mà routing và graph_utils sử dụng; G.graph chứa
+    các chỉ mục (csr, spatial_index, way_index, way_table, connectivity) dựng trên cùng các mảng.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sections = {}
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"File {path} không phải đồ thị ánh xạ phiên bản {FORMAT_VERSION}")
+        self.header = json.loads(bytes(self._mmap[_HEADER.size:_HEADER.size + header_len]))
+        base = _HEADER.size + header_len
+        buffer = self._buffer = memoryview(self._mmap)
+        self.sections = {}
+        for name, (position, length, typecode) in self.header['sections'].items():
+            itemsize = array(typecode).itemsize
+            start = base + position
+            self.sections[name] = buffer[start:start + length * itemsize].cast(typecode)
+
+        s = self.sections
+        self.node_ids = s['node_ids']
+        self.lat = s['lat']
+        self.lon = s['lon']
+        self.offsets = s['offsets']
+        self.targets = s['targets']
+        self.weights = s['weights']
+        self.edge_sources = s['edge_sources']
+        self.edge_way = s['edge_way']
+        self.edge_geometry = s['edge_geometry']
+        self.rev_offsets = s['rev_offsets']
+        self.rev_sources = s['rev_sources']
+        self.rev_edges = s['rev_edges']
+        self.index_of = _SortedIndex(s['sorted_ids'], s['sorted_index'])
+        self.nodes = _MappedNodes(self)
+        self.pred = _MappedPred(self)
+
+        self.graph = {}
+        self.graph['csr'] = CSRGraph(self.node_ids, self.lat, self.lon, self.offsets, self.targets, self.weights,
+                                     index_of=self.index_of,
+                                     reverse=(self.rev_offsets, self.rev_sources, s['rev_weights']),
+                                     trig=(s['lat_rad'], s['lon_rad'], s['cos_lat']),
+                                     lengths=s['lengths'])
+        if self.header['has_geometry']:
+            self.graph['edge_geometry'] = EdgeGeometry(s['geometry_offsets'], s['geometry_lat'], s['geometry_lon'])
+        grid = EdgeGridIndex(self.header['cell_size'])
+        grid.cells = _MappedCells(s['cell_keys'], _CSRLists(s['cell_offsets'], s['cell_edges']))
+        grid.edges = _MappedEdgeList(self)
+        self.graph['spatial_index'] = grid
+        self.graph['way_table'] = MappedWayTable(self)
+        self.graph['way_index'] = MappedWayIndex(self)
+        self.graph['connectivity'] = ConnectivityIndex(s['labels'], _CSRLists(s['comp_offsets'], s['comp_targets']))
+        logging.info(f"Đã ánh xạ đồ thị {path}: {len(self.node_ids)} node, {len(self.targets)} cạnh")
+
+    def matches_source(self, graphml_file):
+        """Kiểm tra file ánh xạ còn khớp với file GraphML nguồn (mtime + kích thước, hoặc SHA-256)."""
+        stat = os.stat(graphml_file)
+        if self.header['source_mtime_ns'] == stat.st_mtime_ns and self.header['source_size'] == stat.st_size:
+            return True
+        return self.header['source_sha256'] == file_sha256(graphml_file)
+
+    def close(self):
+        """Giải phóng các view và đóng mmap (chỉ đóng được khi không còn đối tượng nào giữ view)."""
+        self.graph = {}
+        for view in self.sections.values():
+            view.release()
+        self.sections = {}
+        try:
+            if getattr(self, '_buffer', None) is not None:
+                self._buffer.release()
+            self._mmap.close()
+        except BufferError:
+            logging.warning(f"Còn đối tượng giữ dữ liệu của {self.path}, mmap sẽ đóng khi được thu gom")
+        self._file.close()
+
+    def edge_index(self, u, v):
+        k = self.index_of.get(u)
+        if k is None:
+            return None
+        t = self.index_of.get(v)
+        if t is None:
+            return None
+        for e in range(self.offsets[k], self.offsets[k + 1]):
+            if self.targets[e] == t:
+                return e
+        return None
+
+    def _edge_data(self, e):
+        data = {'weight': self.weights[e]}
+        if self.edge_way[e] >= 0:
+            data['way'] = self.edge_way[e]
+        if self.edge_geometry[e] >= 0:
+            data['geometry'] = self.edge_geometry[e]
+        return data
+
+    def _adjacency(self, node, reverse=False):
+        k = self.index_of[node]
+        node_ids = self.node_ids
+        if reverse:
+            return {node_ids[self.rev_sources[i]]: self._edge_data(self.rev_edges[i])
+                    for i in range(self.rev_offsets[k], self.rev_offsets[k + 1])}
+        return {node_ids[self.targets[e]]: self._edge_data(e) for e in range(self.offsets[k], self.offsets[k + 1])}
+
+    def __getitem__(self, u):
+        return self._adjacency(u)
+
+    def __contains__(self, node):
+        return node in self.index_of
+
+    def __iter__(self):
+        return iter(self.node_ids)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def neighbors(self, u):
+        return iter(self._adjacency(u))
+
+    successors = neighbors
+
+    def predecessors(self, v):
+        return iter(self._adjacency(v, reverse=True))
+
+    def has_node(self, node):
+        return node in self.index_of
+
+    def has_edge(self, u, v):
+        return self.edge_index(u, v) is not None
+
+    def get_edge_data(self, u, v, default=None):
+        e = self.edge_index(u, v)
+        return default if e is None else self._edge_data(e)
+
+    def edges(self, data=False):
+        node_ids = self.node_ids
+        for e in range(len(self.targets)):
+            u, v = node_ids[self.edge_sources[e]], node_ids[self.targets[e]]
+            yield (u, v, self._edge_data(e)) if data else (u, v)
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.targets)
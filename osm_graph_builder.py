@@ -1,9 +1,29 @@
 import osmium
 import networkx as nx
 import math
-import json
 import logging
+import os
 import re
+import sys
+import json
+import argparse
+import time
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from routing_engine import CSRGraph
+from contraction import build_contraction_hierarchy, ch_path_for
+from landmarks import build_landmark_tables, landmark_path_for
+from graph_cache import (save_graph_cache, save_graph_cache_arrays, write_graphml, write_graphml_arrays,
+                         save_npz_atomic, _pack_strings, _unpack_strings)
+from way_table import WayTable
+from edge_geometry import EdgeGeometry
+
+try:
+    import resource
+except ImportError:  # Windows không có module resource
+    resource = None
 
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -102,105 +122,960 @@ def clip_segment_to_bbox(x1, y1, x2, y2, bbox_min_lat, bbox_min_lon, bbox_max_la
 
     return clipped_points[0], clipped_points[1] if len(clipped_points) == 2 else None
 
+# Hộp giới hạn mặc định (khu Kim Liên)
+DEFAULT_BBOX = (20.999906919559084, 105.82855224609376, 21.011445179194784, 105.8395278453827)
+
+# Số dải vĩ độ chia cạnh đa giác để kiểm tra điểm/đoạn thẳng nhanh
+POLYGON_BANDS = 256
+# id tạm (âm) cho node tạo tại điểm cắt vùng khi xây theo ô, đánh số lại lúc ghép các ô
+TILE_CLIP_ID_BASE = -(1 << 62)
+
+class BBoxArea:
+    """Vùng xây đồ thị dạng hộp giới hạn (min_lat, min_lon, max_lat, max_lon)."""
+    def __init__(self, min_lat, min_lon, max_lat, max_lon):
+        self.bounds = (min_lat, min_lon, max_lat, max_lon)
+
+    def overlaps(self, min_lat, min_lon, max_lat, max_lon):
+        """True nếu hộp đã cho giao với hộp bao của vùng (dùng để lọc sớm way)."""
+        a_min_lat, a_min_lon, a_max_lat, a_max_lon = self.bounds
+        return min_lat <= a_max_lat and max_lat >= a_min_lat and min_lon <= a_max_lon and max_lon >= a_min_lon
+
+    def clip_segment(self, lon1, lat1, lon2, lat2):
+        """Các đoạn con ((lon, lat), (lon, lat)) nằm trong vùng."""
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        clipped = clip_segment_to_bbox(lon1, lat1, lon2, lat2, min_lat, min_lon, max_lat, max_lon)
+        return [clipped] if clipped else []
+
+class PolygonArea(BBoxArea):
+    """
+    Vùng xây đồ thị dạng đa giác (một hoặc nhiều vòng [(lon, lat)], quy tắc chẵn-lẻ nên
+    vòng lỗ và multipolygon đều dùng được). Cạnh đa giác được chia theo dải vĩ độ để
+    mỗi phép kiểm tra chỉ xét các cạnh cùng dải.
+    """
+    def __init__(self, rings):
+        self.rings = [list(ring) for ring in rings]
+        edges = []
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if (x1, y1) != (x2, y2):
+                    edges.append((x1, y1, x2, y2))
+        if not edges:
+            raise ValueError("Đa giác không có cạnh nào")
+        lons = [x for x1, _, x2, _ in edges for x in (x1, x2)]
+        lats = [y for _, y1, _, y2 in edges for y in (y1, y2)]
+        super().__init__(min(lats), min(lons), max(lats), max(lons))
+        self._band_height = (self.bounds[2] - self.bounds[0]) / POLYGON_BANDS or 1.0
+        self._bands = [[] for _ in range(POLYGON_BANDS)]
+        for edge in edges:
+            for band in range(self._band(min(edge[1], edge[3])), self._band(max(edge[1], edge[3])) + 1):
+                self._bands[band].append(edge)
+
+    def _band(self, lat):
+        return min(max(int((lat - self.bounds[0]) / self._band_height), 0), POLYGON_BANDS - 1)
+
+    def contains(self, lon, lat):
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        inside = False
+        for x1, y1, x2, y2 in self._bands[self._band(lat)]:
+            if (y1 > lat) != (y2 > lat) and x1 + (lat - y1) * (x2 - x1) / (y2 - y1) > lon:
+                inside = not inside
+        return inside
+
+    def clip_segment(self, lon1, lat1, lon2, lat2):
+        if not self.overlaps(min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)):
+            return []
+        dx, dy = lon2 - lon1, lat2 - lat1
+        cuts = [0.0, 1.0]
+        for band in range(self._band(min(lat1, lat2)), self._band(max(lat1, lat2)) + 1):
+            for x1, y1, x2, y2 in self._bands[band]:
+                ex, ey = x2 - x1, y2 - y1
+                denom = dx * ey - dy * ex
+                if denom == 0:
+                    continue
+                t = ((x1 - lon1) * ey - (y1 - lat1) * ex) / denom
+                s = ((x1 - lon1) * dy - (y1 - lat1) * dx) / denom
+                if 0 < t < 1 and 0 <= s <= 1:
+                    cuts.append(t)
+        cuts = sorted(set(cuts))
+
+        def point(t):
+            if t == 0.0:
+                return lon1, lat1
+            if t == 1.0:
+                return lon2, lat2
+            return lon1 + dx * t, lat1 + dy * t
+
+        # Giữ các đoạn con có trung điểm nằm trong đa giác, nối các đoạn liền nhau
+        pieces = []
+        for a, b in zip(cuts, cuts[1:]):
+            middle = (a + b) / 2
+            if not self.contains(lon1 + dx * middle, lat1 + dy * middle):
+                continue
+            if pieces and pieces[-1][1] == a:
+                pieces[-1][1] = b
+            else:
+                pieces.append([a, b])
+        return [(point(a), point(b)) for a, b in pieces]
+
+def load_polygon(path):
+    """
+    Đọc vùng đa giác từ file .poly (định dạng Osmosis/Geofabrik) hoặc GeoJSON
+    (Polygon, MultiPolygon, Feature, FeatureCollection).
+    """
+    rings = []
+    if path.endswith('.poly'):
+        with open(path, encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        ring = None
+        for line in lines[1:]:  # Dòng đầu là tên vùng
+            if not line:
+                continue
+            if ring is None:
+                if line == 'END':
+                    break
+                ring = []  # Tên vòng (vòng lỗ bắt đầu bằng '!')
+            elif line == 'END':
+                rings.append(ring)
+                ring = None
+            else:
+                lon, lat = line.split()[:2]
+                ring.append((float(lon), float(lat)))
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        geometries = [data]
+        while geometries:
+            geometry = geometries.pop()
+            kind = geometry.get('type')
+            if kind == 'FeatureCollection':
+                geometries.extend(feature['geometry'] for feature in geometry['features'])
+            elif kind == 'Feature':
+                geometries.append(geometry['geometry'])
+            elif kind == 'Polygon':
+                rings.extend([tuple(p[:2]) for p in ring] for ring in geometry['coordinates'])
+            elif kind == 'MultiPolygon':
+                rings.extend([tuple(p[:2]) for p in ring] for polygon in geometry['coordinates'] for ring in polygon)
+    # Bỏ điểm lặp lại ở cuối vòng
+    rings = [ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring for ring in rings]
+    logging.info(f"Đã đọc đa giác {path}: {len(rings)} vòng, {sum(len(r) for r in rings)} đỉnh")
+    return PolygonArea(rings)
+
 # Class để xử lý file OSM
+class TileGrid:
+    """
+    Lưới rows x cols ô phủ hộp bao của vùng cắt, dùng khi xây đồ thị song song theo ô.
+    Mỗi đoạn way thuộc đúng một ô: ô chứa điểm đầu đoạn (điểm ngoài lưới tính vào ô biên gần nhất).
+    """
+    def __init__(self, bounds, rows, cols):
+        self.min_lat, self.min_lon, self.max_lat, self.max_lon = bounds
+        self.rows = rows
+        self.cols = cols
+
+    @classmethod
+    def for_count(cls, bounds, tiles):
+        cols = math.ceil(math.sqrt(tiles))
+        return cls(bounds, math.ceil(tiles / cols), cols)
+
+    def __len__(self):
+        return self.rows * self.cols
+
+    def tile_of(self, lat, lon):
+        row = int((lat - self.min_lat) / (self.max_lat - self.min_lat) * self.rows)
+        col = int((lon - self.min_lon) / (self.max_lon - self.min_lon) * self.cols)
+        return min(max(row, 0), self.rows - 1) * self.cols + min(max(col, 0), self.cols - 1)
+
+    def tiles_of(self, lat, lon):
+        """Như tile_of cho mảng tọa độ."""
+        row = ((lat - self.min_lat) / (self.max_lat - self.min_lat) * self.rows).astype(np.int64)
+        col = ((lon - self.min_lon) / (self.max_lon - self.min_lon) * self.cols).astype(np.int64)
+        return np.clip(row, 0, self.rows - 1) * self.cols + np.clip(col, 0, self.cols - 1)
+
 class RoadGraphHandler(osmium.SimpleHandler):
-    def __init__(self):
+    """
+    Đọc các way đường xe từ file OSM. Tọa độ node lấy qua chỉ mục vị trí của osmium
+    (apply_file với locations=True) nên không giữ mọi node của file trong dict Python.
+    Cạnh được ghi vào các mảng gọn: id hai đầu, tọa độ hai đầu, trọng số và dòng way.
+    area là vùng cắt đồ thị (BBoxArea hoặc PolygonArea), mặc định khu Kim Liên.
+    """
+    def __init__(self, area=None, tile_grid=None, tile=None):
         super().__init__()
-        self.nodes = {}  # Lưu tọa độ node: {node_id: (lat, lon)}
-        self.edges = []  # Lưu cạnh: [(node1, node2, weight, tags)]
+        self.edge_src = array('q')  # id node đầu của từng cạnh
+        self.edge_dst = array('q')  # id node cuối
+        self.src_lat = array('d')
+        self.src_lon = array('d')
+        self.dst_lat = array('d')
+        self.dst_lon = array('d')
+        self.edge_weight = array('d')  # thời gian di chuyển (giờ)
+        self.edge_way = array('i')  # dòng trong bảng way
+        self.way_table = WayTable()  # Thuộc tính way dạng cột, cạnh chỉ lưu số dòng
         self.vehicle_highways = [
             'motorway', 'trunk', 'primary', 'secondary', 'tertiary',
             'unclassified', 'residential', 'service', 'track',
             'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link'
         ]
-        # Hộp giới hạn
-        self.bbox_min_lat = 20.999906919559084
-        self.bbox_min_lon = 105.82855224609376
-        self.bbox_max_lat = 21.011445179194784
-        self.bbox_max_lon = 105.8395278453827
-        self.next_node_id = max([0] + [n for n in self.nodes.keys()]) + 1 if self.nodes else 1
+        self.clip_area = area or BBoxArea(*DEFAULT_BBOX)
+        self.skipped_ways = 0  # Way đường xe nằm hoàn toàn ngoài vùng
+        self.next_node_id = 1  # id cho node mới tạo tại điểm cắt vùng
+        # Dãy node của từng way đã dùng (để cập nhật tăng dần): mỗi lượt ghi một dãy cho một dòng way,
+        # lượt sau ghi đè lượt trước
+        self.run_rows = array('i')
+        self.run_offsets = array('q', [0])
+        self.run_refs = array('q')
+        # Tọa độ các node nằm trên way đã dùng hoặc way highway khác trong vùng
+        # (có thể lặp, bản ghi sau được ưu tiên)
+        self.node_refs = array('q')
+        self.node_lat = array('d')
+        self.node_lon = array('d')
+        # Xây theo ô (TileGrid): chỉ tạo cạnh cho đoạn thuộc ô tile; khóa thứ tự (way, đoạn)
+        # của từng cạnh và node cắt để ghép các ô theo đúng thứ tự của lượt đọc tuần tự
+        self.tile_grid = tile_grid
+        self.tile = tile
+        self.way_seq = -1  # thứ tự của way đang đọc trong file
+        self.row_seq = array('q')  # way_seq của từng dòng bảng way
+        self.edge_keys = array('q')
+        self.clip_keys = array('q')
+        if tile_grid is not None:
+            self.next_node_id = TILE_CLIP_ID_BASE
 
-    def node(self, n):
-        lat, lon = n.location.lat, n.location.lon
-        self.nodes[n.id] = (lat, lon)
+    def _clip_node_id(self, key):
+        node_id = self.next_node_id
+        self.next_node_id += 1
+        if self.tile_grid is not None:
+            self.clip_keys.append(key)
+        return node_id
+
+    def _add_edge(self, n1, lat1, lon1, n2, lat2, lon2, weight, way_row):
+        self.edge_src.append(n1)
+        self.edge_dst.append(n2)
+        self.src_lat.append(lat1)
+        self.src_lon.append(lon1)
+        self.dst_lat.append(lat2)
+        self.dst_lon.append(lon2)
+        self.edge_weight.append(weight)
+        self.edge_way.append(way_row)
+
+    def _record_way(self, row, nodes):
+        self.run_rows.append(row)
+        for ref, lat, lon in nodes:
+            self.run_refs.append(ref)
+            self.node_refs.append(ref)
+            self.node_lat.append(lat)
+            self.node_lon.append(lon)
+        self.run_offsets.append(len(self.run_refs))
 
     def way(self, w):
+        self.way_seq += 1
         if 'highway' not in w.tags:
             return
 
         highway_type = w.tags['highway']
+        # Chỉ giữ node có tọa độ trong file
+        valid_nodes = [(n.ref, n.lat, n.lon) for n in w.nodes if n.location.valid()]
         if highway_type not in self.vehicle_highways:
-            logging.info(f"Bỏ qua way {w.id} vì không phải đường xe: highway={highway_type}")
+            logging.debug(f"Bỏ qua way {w.id} vì không phải đường xe: highway={highway_type}")
+            self.remember_nodes(valid_nodes)
+            return
+
+        if len(valid_nodes) < 2:
+            return
+        if not self.overlaps(valid_nodes):
             return
 
-        is_oneway = w.tags.get('oneway', 'no') == 'yes'
-        node_refs = [n.ref for n in w.nodes]
         tags = {t.k: t.v for t in w.tags}
         tags['id'] = str(w.id)
+        self.add_way(tags, valid_nodes)
+
+    def remember_nodes(self, nodes):
+        """
+        Giữ tọa độ node của way highway không phải đường xe nằm trong vùng, để cập nhật tăng dần
+        tính được way khi nó đổi thành đường xe hoặc way mới dùng lại các node này
+        (file .osc không lặp lại tọa độ của node không đổi).
+        """
+        if not nodes:
+            return
+        lats = [lat for _, lat, _ in nodes]
+        lons = [lon for _, _, lon in nodes]
+        if not self.clip_area.overlaps(min(lats), min(lons), max(lats), max(lons)):
+            return
+        for ref, lat, lon in nodes:
+            self.node_refs.append(ref)
+            self.node_lat.append(lat)
+            self.node_lon.append(lon)
+
+    def overlaps(self, nodes):
+        """Lọc sớm: False (và đếm way bị bỏ) nếu hộp bao của các node không giao vùng."""
+        lats = [lat for _, lat, _ in nodes]
+        lons = [lon for _, _, lon in nodes]
+        if not self.clip_area.overlaps(min(lats), min(lons), max(lats), max(lons)):
+            self.skipped_ways += 1
+            return False
+        return True
+
+    def add_way(self, tags, nodes):
+        """
+        Tạo cạnh cho một way đường xe từ dãy (id node, lat, lon), cắt bỏ phần ngoài vùng.
+        Trả về số dòng way, hoặc None nếu way không có đoạn nào trong vùng.
+        """
+        is_oneway = tags.get('oneway', 'no') == 'yes'
+        speed = get_speed(tags)
+        edges = []
+        edge_keys = []
+
+        # Tạo cạnh với cắt bỏ phần ngoài vùng
+        for i in range(len(nodes) - 1):
+            n1, lat1, lon1 = nodes[i]
+            n2, lat2, lon2 = nodes[i + 1]
+            if self.tile_grid is not None and self.tile_grid.tile_of(lat1, lon1) != self.tile:
+                continue
+            key = (self.way_seq << 32) | (i << 12)
+
+            # Cắt đoạn thẳng nếu cần (đa giác lõm có thể cho nhiều đoạn con)
+            pieces = self.clip_area.clip_segment(lon1, lat1, lon2, lat2)
+            for piece, ((clip_lon1, clip_lat1), (clip_lon2, clip_lat2)) in enumerate(pieces):
+                # Tạo node mới nếu điểm cắt không phải node gốc
+                node1_id = n1
+                if (clip_lon1, clip_lat1) != (lon1, lat1):
+                    node1_id = self._clip_node_id(key | (piece << 1))
+                    logging.debug(f"Tạo node mới {node1_id} tại ({clip_lat1}, {clip_lon1})")
+
+                node2_id = n2
+                if (clip_lon2, clip_lat2) != (lon2, lat2):
+                    node2_id = self._clip_node_id(key | (piece << 1) | 1)
+                    logging.debug(f"Tạo node mới {node2_id} tại ({clip_lat2}, {clip_lon2})")
+
+                # Tính trọng số và thêm cạnh
+                length = haversine(clip_lon1, clip_lat1, clip_lon2, clip_lat2)
+                weight = length / speed  # Trọng số là thời gian di chuyển (giờ)
+                edges.append((node1_id, clip_lat1, clip_lon1, node2_id, clip_lat2, clip_lon2, weight))
+                edge_keys.append(key)
+                if not is_oneway:
+                    edges.append((node2_id, clip_lat2, clip_lon2, node1_id, clip_lat1, clip_lon1, weight))
+                    edge_keys.append(key)
+                logging.debug(f"Cạnh ({node1_id}, {node2_id}), way_id={tags['id']}, length={length:.3f} km, "
+                              f"speed={speed} km/h, weight={weight:.6f} giờ")
+
+        if not edges:
+            return None
+        way_row = self.way_table.set_way(tags)
+        if self.tile_grid is not None:
+            if way_row == len(self.row_seq):
+                self.row_seq.append(self.way_seq)
+            self.edge_keys.extend(edge_keys)
+        for edge in edges:
+            self._add_edge(*edge, way_row)
+        self._record_way(way_row, nodes)
+        return way_row
 
-        # Xử lý từng đoạn của way
-        valid_nodes = []
-        for i in range(len(node_refs)):
-            if node_refs[i] in self.nodes:
-                lat, lon = self.nodes[node_refs[i]]
-                valid_nodes.append((node_refs[i], lat, lon))
-
-        # Tạo cạnh với cắt bỏ ngoài bbox
-        for i in range(len(valid_nodes) - 1):
-            n1, lat1, lon1 = valid_nodes[i]
-            n2, lat2, lon2 = valid_nodes[i + 1]
-
-            # Cắt đoạn thẳng nếu cần
-            clipped = clip_segment_to_bbox(lon1, lat1, lon2, lat2,
-                                          self.bbox_min_lat, self.bbox_min_lon,
-                                          self.bbox_max_lat, self.bbox_max_lon)
-            if not clipped:
+    def add_split_way(self, tags, nodes):
+        """
+        Như add_way cho dãy node có thể thiếu tọa độ (lat nan: node chưa biết hoặc đã bị xóa):
+        way được tách tại các node đó như khi cắt ở biên vùng, không nối thẳng qua chỗ trống.
+        Dãy node lưu lại vẫn đầy đủ để lần cập nhật sau tính lại khi node được bổ sung.
+        Trả về số dòng way, hoặc None nếu không có đoạn nào tạo được cạnh.
+        """
+        built = None
+        piece = []
+        for node in nodes + [(None, math.nan, math.nan)]:
+            if not math.isnan(node[1]):
+                piece.append(node)
                 continue
+            if len(piece) >= 2:
+                row = self.add_way(tags, piece)
+                built = row if row is not None else built
+            piece = []
+        row = self.way_table.row_of(tags['id'])
+        if row is not None:
+            self._record_way(row, nodes)
+        return built
+
+    def set_node(self, node_id, coords):
+        """Ghi tọa độ mới của một node (None nếu node bị xóa)."""
+        lat, lon = coords if coords is not None else (math.nan, math.nan)
+        self.node_refs.append(node_id)
+        self.node_lat.append(lat)
+        self.node_lon.append(lon)
+
+    def drop_ways(self, rows):
+        """Xóa mọi cạnh của các dòng way đã cho (trước khi tính lại chúng)."""
+        if not rows:
+            return
+        keep = ~np.isin(np.frombuffer(self.edge_way, dtype=np.int32), np.asarray(rows, dtype=np.int32))
+        for name in ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'edge_way'):
+            values = getattr(self, name)
+            setattr(self, name, array(values.typecode, np.frombuffer(values, dtype=values.typecode)[keep].tobytes()))
+        for row in rows:
+            self._record_way(row, ())
+
+    def way_refs(self):
+        """Dãy node hiện tại của từng dòng way (lượt ghi sau cùng): (offsets theo dòng, mảng id node)."""
+        rows = len(self.way_table)
+        run_offsets = np.frombuffer(self.run_offsets, dtype=np.int64)
+        last = np.full(rows, -1, dtype=np.int64)
+        np.maximum.at(last, np.frombuffer(self.run_rows, dtype=np.int32), np.arange(len(self.run_rows)))
+        has_run = last >= 0
+        starts = np.where(has_run, run_offsets[np.maximum(last, 0)], 0)
+        counts = np.where(has_run, run_offsets[np.maximum(last, 0) + 1] - starts, 0)
+        offsets = np.zeros(rows + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        index = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return offsets, np.frombuffer(self.run_refs, dtype=np.int64)[index]
+
+    def known_nodes(self):
+        """Tọa độ mới nhất của các node đã biết: (id sắp xếp, lat, lon); node bị xóa có tọa độ nan."""
+        ids = np.frombuffer(self.node_refs, dtype=np.int64)[::-1]
+        node_ids, last = np.unique(ids, return_index=True)
+        return node_ids, np.frombuffer(self.node_lat)[::-1][last], np.frombuffer(self.node_lon)[::-1][last]
 
-            (clip_lon1, clip_lat1), (clip_lon2, clip_lat2) = clipped
-
-            # Tạo node mới nếu điểm cắt không phải node gốc
-            node1_id = n1
-            if (clip_lon1, clip_lat1) != (lon1, lat1):
-                node1_id = self.next_node_id
-                self.nodes[node1_id] = (clip_lat1, clip_lon1)
-                self.next_node_id += 1
-                logging.info(f"Tạo node mới {node1_id} tại ({clip_lat1}, {clip_lon1})")
-
-            node2_id = n2
-            if (clip_lon2, clip_lat2) != (lon2, lat2):
-                node2_id = self.next_node_id
-                self.nodes[node2_id] = (clip_lat2, clip_lon2)
-                self.next_node_id += 1
-                logging.info(f"Tạo node mới {node2_id} tại ({clip_lat2}, {clip_lon2})")
-
-            # Tính trọng số và thêm cạnh
-            length = haversine(clip_lon1, clip_lat1, clip_lon2, clip_lat2)
-            speed = get_speed(tags)
-            weight = length / speed  # Trọng số là thời gian di chuyển (giờ)
-            self.edges.append((node1_id, node2_id, weight, tags))
-            if not is_oneway:
-                self.edges.append((node2_id, node1_id, weight, tags))
-            logging.info(f"Cạnh ({node1_id}, {node2_id}), way_id={tags['id']}, length={length:.3f} km, "
-                         f"speed={speed} km/h, weight={weight:.6f} giờ")
-
-def build_graph(osm_file, graphml_file='road_network.graphml'):
+    def to_csr(self):
+        """
+        Gom các cạnh đã đọc thành đồ thị CSR: node (chỉ những node nằm trên cạnh) sắp theo id,
+        cạnh trùng (u, v) giữ vị trí lần đầu và thuộc tính lần cuối như DiGraph.add_edge.
+        Trả về (CSRGraph, mảng dòng way theo thứ tự cạnh CSR).
+        """
+        m = len(self.edge_src)
+        ids = np.concatenate([np.frombuffer(self.edge_src, dtype=np.int64), np.frombuffer(self.edge_dst, dtype=np.int64)])
+        lat_all = np.concatenate([np.frombuffer(self.src_lat), np.frombuffer(self.dst_lat)])
+        lon_all = np.concatenate([np.frombuffer(self.src_lon), np.frombuffer(self.dst_lon)])
+        node_ids, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        del ids
+        lat, lon = lat_all[first], lon_all[first]
+        del lat_all, lon_all
+        n = len(node_ids)
+        source, target = inverse[:m], inverse[m:]
+
+        key = source * n + target
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+        group_start = np.ones(m, dtype=bool)
+        group_start[1:] = sorted_key[1:] != sorted_key[:-1]
+        group_end = np.ones(m, dtype=bool)
+        group_end[:-1] = group_start[1:]
+        first_pos, last_pos = order[group_start], order[group_end]
+        del key, order, sorted_key
+        csr_order = np.lexsort((first_pos, source[first_pos]))
+        first_pos, last_pos = first_pos[csr_order], last_pos[csr_order]
+
+        sources = source[first_pos]
+        offsets = np.searchsorted(sources, np.arange(n + 1))
+        weights = np.frombuffer(self.edge_weight)[last_pos]
+        ways = np.frombuffer(self.edge_way, dtype=np.int32)[last_pos]
+        csr = CSRGraph(array('q', node_ids.astype(np.int64).tobytes()),
+                       array('d', lat.tobytes()), array('d', lon.tobytes()),
+                       array('q', offsets.astype(np.int64).tobytes()),
+                       array('q', target[first_pos].astype(np.int64).tobytes()),
+                       array('d', weights.tobytes()))
+        return csr, array('i', ways.astype(np.int32).tobytes())
+
+def _chain_interior_nodes(csr, ways):
+    """
+    Đánh dấu node hình dạng nằm giữa một way: đúng một cạnh vào và một cạnh ra (đường một chiều)
+    hoặc hai láng giềng nối hai chiều, mọi cạnh kề cùng một way. Node đổi way, ngã ba, đầu mút giữ lại.
+    """
+    n = len(csr)
+    in_way = array('i', [-2]) * n  # -2: chưa có cạnh, -3: nhiều way
+    for e, v in enumerate(csr.targets):
+        if in_way[v] == -2:
+            in_way[v] = ways[e]
+        elif in_way[v] != ways[e]:
+            in_way[v] = -3
+    removable = bytearray(n)
+    for k in range(n):
+        start, end = csr.offsets[k], csr.offsets[k + 1]
+        out = set(csr.targets[start:end])
+        into = set(csr.rev_sources[csr.rev_offsets[k]:csr.rev_offsets[k + 1]])
+        if k in out or in_way[k] < 0 or any(ways[e] != in_way[k] for e in range(start, end)):
+            continue
+        one_way = len(out) == 1 and len(into) == 1 and out != into
+        two_way = len(out) == 2 and out == into
+        if one_way or two_way:
+            removable[k] = 1
+    return removable
+
+def simplify_chains(csr, ways):
+    """
+    Gộp các chuỗi node bậc 2 (điểm hình dạng của way) thành một cạnh với trọng số và độ dài
+    cộng dồn; tọa độ các node bị bỏ được lưu vào bảng EdgeGeometry để dựng lại đường gấp khúc.
+    Hai chuỗi nối cùng cặp node (hoặc chuỗi khép kín về chính nó) được tách bằng cách giữ
+    node giữa của một chuỗi. Trả về (CSRGraph mới, dòng way, mã hình học từng cạnh, EdgeGeometry).
+    """
+    n = len(csr)
+    offsets, targets, weights, lengths = csr.offsets, csr.targets, csr.weights, csr.lengths
+    removable = _chain_interior_nodes(csr, ways)
+
+    def walk(s, e):
+        previous, x = s, targets[e]
+        weight, length, interior = weights[e], lengths[e], []
+        while removable[x]:
+            interior.append(x)
+            f = next(f for f in range(offsets[x], offsets[x + 1]) if targets[f] != previous)
+            previous, x = x, targets[f]
+            weight += weights[f]
+            length += lengths[f]
+        return x, interior, weight, length
+
+    while True:
+        chains = []  # (s, t, interior, weight, length, way)
+        seen = {}
+        covered = bytearray(n)
+        conflicts = []
+        for s in range(n):
+            if removable[s]:
+                continue
+            for e in range(offsets[s], offsets[s + 1]):
+                t, interior, weight, length = walk(s, e)
+                for x in interior:
+                    covered[x] = 1
+                other = seen.get((s, t))
+                if (s == t and interior) or other is not None:
+                    # Cạnh song song hoặc vòng: giữ node giữa để tách chuỗi
+                    chain = interior if interior else chains[other][2]
+                    if chain:
+                        conflicts.append(chain[len(chain) // 2])
+                seen[(s, t)] = len(chains)
+                chains.append((s, t, interior, weight, length, ways[e]))
+        # Vòng kín chỉ gồm node bậc 2 không được chuỗi nào đi qua: giữ một node của vòng
+        conflicts.extend(k for k in range(n) if removable[k] and not covered[k])
+        if not conflicts:
+            break
+        for k in conflicts:
+            removable[k] = 0
+
+    new_index = array('q', [-1]) * n
+    kept = [k for k in range(n) if not removable[k]]
+    for i, k in enumerate(kept):
+        new_index[k] = i
+    geometry = EdgeGeometry()
+    chain_row = {}  # {(node đầu, node trung gian đầu tiên): dòng hình học}
+    new_offsets = array('q', [0] * (len(kept) + 1))
+    new_targets, new_weights, new_lengths = array('q'), array('d'), array('d')
+    new_ways, codes = array('i'), array('q')
+    for s, t, interior, weight, length, way in chains:
+        new_offsets[new_index[s] + 1] += 1
+        new_targets.append(new_index[t])
+        new_weights.append(weight)
+        new_lengths.append(length)
+        new_ways.append(way)
+        if not interior:
+            codes.append(-1)
+            continue
+        # Chiều về của đường hai chiều dùng lại dãy điểm của chiều đi theo thứ tự ngược
+        row = chain_row.get((t, interior[-1]))
+        if row is not None:
+            codes.append(2 * row + 1)
+        else:
+            row = chain_row[(s, interior[0])] = geometry.add((csr.lat[x], csr.lon[x]) for x in interior)
+            codes.append(2 * row)
+    for i in range(len(kept)):
+        new_offsets[i + 1] += new_offsets[i]
+
+    simplified = CSRGraph(array('q', (csr.node_ids[k] for k in kept)), array('d', (csr.lat[k] for k in kept)),
+                          array('d', (csr.lon[k] for k in kept)), new_offsets, new_targets, new_weights,
+                          lengths=new_lengths)
+    logging.info(f"Gộp chuỗi node bậc 2: {n} -> {len(kept)} node, {len(targets)} -> {len(new_targets)} cạnh, "
+                 f"{len(geometry.lat)} điểm hình học")
+    return simplified, new_ways, codes, geometry
+
+def peak_rss_mb():
+    """Bộ nhớ RSS lớn nhất của tiến trình (MB), None nếu hệ điều hành không hỗ trợ."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _apply_osm(handler, osm_file):
+    """Cho handler đọc file .osm hoặc .osm.pbf (osmium nhận dạng theo phần mở rộng)."""
+    # Chỉ mục vị trí node do osmium quản lý (bộ nhớ gọn, nằm ngoài Python);
+    # bộ lọc khóa highway bỏ các way khác trước khi gọi sang Python
+    handler.apply_file(osm_file, locations=True, idx='flex_mem', filters=[osmium.filter.KeyFilter('highway')])
+    return handler
+
+def _read_osm(osm_file, area=None):
+    """Đọc file OSM một lượt, tạo cạnh của các way đường xe trong vùng."""
+    handler = _apply_osm(RoadGraphHandler(area), osm_file)
+    logging.info(f"Đã đọc {len(handler.edge_src)} cạnh của {len(handler.way_table)} way đường xe, "
+                 f"bỏ qua {handler.skipped_ways} way ngoài vùng")
+    return handler
+
+class WayCollector(RoadGraphHandler):
+    """
+    Lượt đọc duy nhất của chế độ xây theo ô: lọc way như RoadGraphHandler nhưng chỉ ghi lại
+    thứ tự, tags và dãy (id node, lat, lon) của way vào mảng gọn, việc cắt vùng và tính
+    trọng số để các tiến trình con làm theo ô (_partition_ways, _build_tile).
+    """
+    def __init__(self, area=None):
+        super().__init__(area)
+        self.collected_seqs = array('q')
+        self.collected_tags = []
+        self.collected_offsets = array('q', [0])
+        self.collected_refs = array('q')
+        self.collected_lat = array('d')
+        self.collected_lon = array('d')
+
+    def add_way(self, tags, nodes):
+        self.collected_seqs.append(self.way_seq)
+        self.collected_tags.append(tags)
+        for ref, lat, lon in nodes:
+            self.collected_refs.append(ref)
+            self.collected_lat.append(lat)
+            self.collected_lon.append(lon)
+        self.collected_offsets.append(len(self.collected_refs))
+
+def _partition_ways(collector, grid):
+    """
+    Chia các way đã đọc theo ô: mỗi ô nhận (theo thứ tự file) các way có ít nhất một đoạn
+    bắt đầu trong ô, kèm dãy node đầy đủ của way. Trả về danh sách phần việc (pickle được) theo ô.
+    """
+    offsets = np.frombuffer(collector.collected_offsets, dtype=np.int64)
+    refs = np.frombuffer(collector.collected_refs, dtype=np.int64)
+    lat = np.frombuffer(collector.collected_lat)
+    lon = np.frombuffer(collector.collected_lon)
+    seqs = np.frombuffer(collector.collected_seqs, dtype=np.int64)
+    counts = np.diff(offsets)
+    way_count = len(counts)
+    # Mỗi way có ít nhất 2 node; đoạn bắt đầu ở mọi node trừ node cuối của way
+    has_next = np.ones(len(refs), dtype=bool)
+    has_next[offsets[1:] - 1] = False
+    starts = np.flatnonzero(has_next)
+    seg_way = np.repeat(np.arange(way_count), counts - 1)
+    pairs = np.unique(grid.tiles_of(lat[starts], lon[starts]) * way_count + seg_way)
+    pair_tiles, pair_ways = pairs // way_count, pairs % way_count
+
+    payloads = []
+    for tile in range(len(grid)):
+        ways = pair_ways[pair_tiles == tile]
+        lengths = counts[ways]
+        tile_offsets = np.zeros(len(ways) + 1, dtype=np.int64)
+        tile_offsets[1:] = np.cumsum(lengths)
+        index = np.repeat(offsets[ways] - tile_offsets[:-1], lengths) + np.arange(tile_offsets[-1])
+        payloads.append({'seqs': seqs[ways], 'tags': [collector.collected_tags[w] for w in ways.tolist()],
+                         'offsets': tile_offsets, 'refs': refs[index], 'lat': lat[index], 'lon': lon[index]})
+    return payloads
+
+HANDLER_ARRAYS = ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'edge_way',
+                  'run_rows', 'run_offsets', 'run_refs', 'node_refs', 'node_lat', 'node_lon',
+                  'row_seq', 'edge_keys', 'clip_keys')
+
+def _build_tile(payload, area, tile_grid, tile):
+    """Tiến trình con: cắt vùng và tạo cạnh cho các đoạn way thuộc một ô, trả về mảng của handler (pickle được)."""
+    started = time.perf_counter()
+    handler = RoadGraphHandler(area, tile_grid, tile)
+    offsets = payload['offsets'].tolist()
+    refs, lat, lon = payload['refs'].tolist(), payload['lat'].tolist(), payload['lon'].tolist()
+    for k, (seq, tags) in enumerate(zip(payload['seqs'].tolist(), payload['tags'])):
+        start, end = offsets[k], offsets[k + 1]
+        handler.way_seq = seq
+        handler.add_way(tags, list(zip(refs[start:end], lat[start:end], lon[start:end])))
+    part = {name: getattr(handler, name) for name in HANDLER_ARRAYS}
+    part.update(way_table=handler.way_table, seconds=time.perf_counter() - started)
+    return part
+
+def _stitch_tiles(parts, area):
+    """
+    Ghép kết quả các ô thành một handler như lượt đọc tuần tự: way xuất hiện ở nhiều ô gộp
+    về một dòng, node đầu mút chung giữa các ô nối lại qua id OSM, node cắt vùng đánh số lại
+    và cạnh sắp theo (thứ tự way, đoạn) nên đồ thị ghép giống hệt khi đọc một lượt.
+    """
+    handler = RoadGraphHandler(area)
+    seqs = np.unique(np.concatenate([np.frombuffer(p['row_seq'], dtype=np.int64) for p in parts]))
+    tables = {}
+    for p in parts:
+        for row, seq in enumerate(p['row_seq']):
+            tables.setdefault(seq, (p['way_table'], row))
+    for seq in seqs.tolist():
+        table, row = tables[seq]
+        handler.way_table.add_way(table.tags(row))
+
+    # Node cắt vùng: id tạm của từng ô -> id theo thứ tự tạo của lượt tuần tự
+    clip_keys = np.concatenate([np.frombuffer(p['clip_keys'], dtype=np.int64) for p in parts])
+    clip_ids = np.empty(len(clip_keys), dtype=np.int64)
+    clip_ids[np.argsort(clip_keys, kind='stable')] = np.arange(1, len(clip_keys) + 1)
+    handler.next_node_id = len(clip_keys) + 1
+
+    columns = {name: [] for name in ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon',
+                                     'edge_weight', 'edge_way', 'edge_keys', 'run_rows', 'run_refs', 'run_counts',
+                                     'node_refs', 'node_lat', 'node_lon')}
+    clip_start = 0
+    for p in parts:
+        rows = np.searchsorted(seqs, np.frombuffer(p['row_seq'], dtype=np.int64)).astype(np.int32)
+        local_clip = clip_ids[clip_start:clip_start + len(p['clip_keys'])]
+        clip_start += len(p['clip_keys'])
+        for name in ('edge_src', 'edge_dst'):
+            ids = np.frombuffer(p[name], dtype=np.int64).copy()
+            clipped = ids < 0
+            ids[clipped] = local_clip[ids[clipped] - TILE_CLIP_ID_BASE]
+            columns[name].append(ids)
+        for name in ('src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'node_lat', 'node_lon'):
+            columns[name].append(np.frombuffer(p[name]))
+        for name in ('edge_keys', 'run_refs', 'node_refs'):
+            columns[name].append(np.frombuffer(p[name], dtype=np.int64))
+        columns['edge_way'].append(rows[np.frombuffer(p['edge_way'], dtype=np.int32)])
+        columns['run_rows'].append(rows[np.frombuffer(p['run_rows'], dtype=np.int32)])
+        columns['run_counts'].append(np.diff(np.frombuffer(p['run_offsets'], dtype=np.int64)))
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+
+    order = np.argsort(columns.pop('edge_keys'), kind='stable')
+    for name in ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'edge_way'):
+        typecode = getattr(handler, name).typecode
+        setattr(handler, name, array(typecode, columns[name][order].astype(typecode).tobytes()))
+    run_offsets = np.zeros(len(columns['run_counts']) + 1, dtype=np.int64)
+    run_offsets[1:] = np.cumsum(columns['run_counts'])
+    handler.run_offsets = array('q', run_offsets.tobytes())
+    for name in ('run_rows', 'run_refs', 'node_refs', 'node_lat', 'node_lon'):
+        typecode = getattr(handler, name).typecode
+        setattr(handler, name, array(typecode, columns[name].astype(typecode).tobytes()))
+    return handler
+
+def source_path_for(graphml_file):
+    """Đường dẫn file dữ liệu nguồn (cạnh chưa gộp, dãy node của way) nằm cạnh file GraphML."""
+    return os.path.splitext(graphml_file)[0] + '.source.npz'
+
+def save_graph_source(handler, graphml_file, simplified):
+    """
+    Lưu trạng thái của handler sau khi đọc OSM để cập nhật tăng dần (osm_update) không phải
+    đọc lại cả file OSM: cạnh chưa gộp, dãy node của các way đã dùng, tọa độ node của
+    mọi way highway trong vùng, bảng way, id node cắt tiếp theo và vùng cắt.
+    """
+    path = source_path_for(graphml_file)
+    offsets, refs = handler.way_refs()
+    node_ids, lat, lon = handler.known_nodes()
+    # Giữ mọi node chưa bị xóa (cả node của way highway khác trong vùng, xem remember_nodes)
+    keep = ~np.isnan(lat)
+    table = handler.way_table
+    rings = getattr(handler.clip_area, 'rings', [])
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    ring_points = np.array([point for ring in rings for point in ring], dtype=np.float64).reshape(-1, 2)
+    way_ids_blob, way_ids_offsets = _pack_strings(table.way_ids)
+    strings_blob, strings_offsets = _pack_strings(table.strings)
+    save_npz_atomic(path,
+                    **{name: np.frombuffer(getattr(handler, name), dtype=getattr(handler, name).typecode)
+                       for name in ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'edge_way')},
+                    way_ref_offsets=offsets,
+                    way_refs=refs,
+                    node_ids=node_ids[keep],
+                    node_lat=lat[keep],
+                    node_lon=lon[keep],
+                    next_node_id=np.int64(handler.next_node_id),
+                    simplified=np.bool_(simplified),
+                    way_ids_blob=way_ids_blob,
+                    way_ids_offsets=way_ids_offsets,
+                    strings_blob=strings_blob,
+                    strings_offsets=strings_offsets,
+                    highway=np.frombuffer(table.highway_codes, dtype=np.int32),
+                    maxspeed=np.frombuffer(table.maxspeed_codes, dtype=np.int32),
+                    name=np.frombuffer(table.name_codes, dtype=np.int32),
+                    oneway=np.frombuffer(bytes(table.oneway_flags), dtype=np.uint8),
+                    area_bounds=np.array(handler.clip_area.bounds, dtype=np.float64),
+                    area_ring_offsets=ring_offsets,
+                    area_ring_points=ring_points)
+    logging.info(f"Đã lưu dữ liệu nguồn cho cập nhật tăng dần vào {path}")
+    return path
+
+def load_graph_source(graphml_file):
+    """Khôi phục RoadGraphHandler từ file dữ liệu nguồn. Trả về (handler, đồ thị có gộp chuỗi hay không)."""
+    with np.load(source_path_for(graphml_file)) as data:
+        ring_offsets = data['area_ring_offsets'].tolist()
+        if len(ring_offsets) > 1:
+            points = [tuple(p) for p in data['area_ring_points'].tolist()]
+            area = PolygonArea([points[a:b] for a, b in zip(ring_offsets, ring_offsets[1:])])
+        else:
+            area = BBoxArea(*data['area_bounds'].tolist())
+        handler = RoadGraphHandler(area)
+        for name in ('edge_src', 'edge_dst', 'src_lat', 'src_lon', 'dst_lat', 'dst_lon', 'edge_weight', 'edge_way'):
+            typecode = getattr(handler, name).typecode
+            setattr(handler, name, array(typecode, data[name].astype(typecode).tobytes()))
+        handler.way_table = WayTable.from_columns(_unpack_strings(data['way_ids_blob'], data['way_ids_offsets']),
+                                                  _unpack_strings(data['strings_blob'], data['strings_offsets']),
+                                                  data['highway'].tolist(), data['maxspeed'].tolist(),
+                                                  data['name'].tolist(), data['oneway'].tolist())
+        # Mỗi dòng way một lượt ghi dãy node
+        handler.run_rows = array('i', range(len(handler.way_table)))
+        handler.run_offsets = array('q', data['way_ref_offsets'].astype(np.int64).tobytes())
+        handler.run_refs = array('q', data['way_refs'].astype(np.int64).tobytes())
+        handler.node_refs = array('q', data['node_ids'].astype(np.int64).tobytes())
+        handler.node_lat = array('d', data['node_lat'].astype(np.float64).tobytes())
+        handler.node_lon = array('d', data['node_lon'].astype(np.float64).tobytes())
+        handler.next_node_id = int(data['next_node_id'])
+        simplified = bool(data['simplified'])
+    return handler, simplified
+
+@contextmanager
+def stage_timer(timings, name):
+    """Đo thời gian một giai đoạn xây đồ thị, ghi vào timings[name] (giây)."""
+    started = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - started
+
+def log_timings(timings):
+    logging.info("Thời gian từng giai đoạn: " + ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items()))
+
+def write_graph_files(handler, graphml_file, simplify=True, timings=None):
+    """
+    Gom cạnh của handler thành CSR (gộp chuỗi node bậc 2 nếu simplify), ghi GraphML,
+    cache nhị phân và dữ liệu nguồn cho cập nhật tăng dần. Trả về (CSRGraph, số way).
+    timings (dict) nhận thời gian của từng giai đoạn.
+    """
+    timings = {} if timings is None else timings
+    way_table = handler.way_table
+    with stage_timer(timings, 'csr'):
+        csr, ways = handler.to_csr()
+    geometry = edge_geometry = None
+    if simplify:
+        with stage_timer(timings, 'simplify'):
+            csr, ways, geometry, edge_geometry = simplify_chains(csr, ways)
+
+    with stage_timer(timings, 'graphml'):
+        write_graphml_arrays(graphml_file, csr.node_ids, csr.lat, csr.lon, csr.offsets, csr.targets, csr.weights,
+                             ways, way_table, geometry, edge_geometry)
+    with stage_timer(timings, 'cache'):
+        sources = np.repeat(np.frombuffer(csr.node_ids, dtype=np.int64), np.diff(np.frombuffer(csr.offsets, dtype=np.int64)))
+        targets = np.frombuffer(csr.node_ids, dtype=np.int64)[np.frombuffer(csr.targets, dtype=np.int64)]
+        save_graph_cache_arrays(graphml_file, csr.node_ids, csr.lat, csr.lon, sources, targets, csr.weights, ways, way_table,
+                                geometry=geometry, edge_geometry=edge_geometry)
+        save_graph_source(handler, graphml_file, simplify)
+    return csr, len(way_table)
+
+def build_graph_streaming(osm_file, graphml_file='road_network.graphml', area=None, simplify=True):
+    """
+    Xây đồ thị tiết kiệm bộ nhớ: đọc file OSM một lượt với chỉ mục vị trí, gom cạnh thành
+    mảng CSR rồi ghi GraphML và cache nhị phân trực tiếp từ mảng, không dựng đồ thị networkx.
+    simplify gộp các chuỗi node bậc 2 thành cạnh có hình học (simplify_chains).
+    Trả về CSRGraph (dùng cho preprocess_routing) và ghi log RSS lớn nhất.
+    """
+    logging.info(f"Xây dựng đồ thị (streaming) từ file OSM: {osm_file}")
+    handler = _read_osm(osm_file, area)
+    csr, way_count = write_graph_files(handler, graphml_file, simplify)
+    del handler
+
+    peak = peak_rss_mb()
+    logging.info(f"Đã tạo đồ thị với {len(csr)} node, {len(csr.targets)} cạnh và {way_count} way; "
+                 + (f"RSS lớn nhất {peak:.1f} MB" if peak is not None else "không đo được RSS"))
+    return csr
+
+def build_graph_tiled(osm_file, graphml_file='road_network.graphml', area=None, simplify=True,
+                      workers=None, tiles=None, timings=None):
+    """
+    Xây đồ thị song song theo ô: đọc file OSM một lượt (một chỉ mục vị trí node, WayCollector),
+    chia hộp bao vùng thành lưới tiles ô (mặc định bằng số tiến trình) và gửi cho mỗi tiến trình
+    trong pool chỉ các way có đoạn thuộc ô của nó để cắt vùng và tính trọng số; kết quả ghép
+    lại (_stitch_tiles) giống hệt build_graph_streaming. Lượt đọc vẫn tuần tự, phần chia theo
+    ô là tạo cạnh. Ghi log thời gian từng giai đoạn (và trả về qua timings nếu truyền dict).
+    """
+    area = area or BBoxArea(*DEFAULT_BBOX)
+    workers = workers or os.cpu_count() or 1
+    grid = TileGrid.for_count(area.bounds, tiles or workers)
+    timings = {} if timings is None else timings
+    logging.info(f"Xây dựng đồ thị theo {len(grid)} ô ({grid.rows}x{grid.cols}) với {workers} tiến trình: {osm_file}")
+
+    with stage_timer(timings, 'read'):
+        collector = _apply_osm(WayCollector(area), osm_file)
+    with stage_timer(timings, 'partition'):
+        payloads = _partition_ways(collector, grid)
+    skipped_ways = collector.skipped_ways
+    remembered = (collector.node_refs, collector.node_lat, collector.node_lon)
+    logging.info(f"Đã đọc {len(collector.collected_tags)} way đường xe ({len(collector.collected_refs)} node), "
+                 f"chia thành {sum(len(p['tags']) for p in payloads)} phần việc theo ô")
+    del collector
+
+    with stage_timer(timings, 'tiles'):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_build_tile, payloads, [area] * len(grid), [grid] * len(grid), range(len(grid))))
+    del payloads
+    for tile, part in enumerate(parts):
+        logging.debug(f"Ô {tile}: {len(part['edge_src'])} cạnh trong {part['seconds']:.2f} s")
+    with stage_timer(timings, 'stitch'):
+        handler = _stitch_tiles(parts, area)
+    del parts
+    handler.skipped_ways = skipped_ways
+    for name, values in zip(('node_refs', 'node_lat', 'node_lon'), remembered):
+        getattr(handler, name).extend(values)
+    del remembered
+    logging.info(f"Đã đọc {len(handler.edge_src)} cạnh của {len(handler.way_table)} way đường xe, "
+                 f"bỏ qua {handler.skipped_ways} way ngoài vùng")
+    csr, way_count = write_graph_files(handler, graphml_file, simplify, timings)
+    del handler
+
+    peak = peak_rss_mb()
+    logging.info(f"Đã tạo đồ thị với {len(csr)} node, {len(csr.targets)} cạnh và {way_count} way; "
+                 + (f"RSS lớn nhất {peak:.1f} MB" if peak is not None else "không đo được RSS"))
+    return csr
+
+def build_graph(osm_file, graphml_file='road_network.graphml', area=None, simplify=True):
+    """Xây đồ thị như build_graph_streaming nhưng trả về DiGraph của networkx."""
     logging.info(f"Xây dựng đồ thị từ file OSM: {osm_file}")
-    handler = RoadGraphHandler()
-    handler.apply_file(osm_file)
+    handler = _read_osm(osm_file, area)
+    csr, ways = handler.to_csr()
+    geometry = None
+    G = nx.DiGraph(way_table=handler.way_table)
+    if simplify:
+        csr, ways, geometry, G.graph['edge_geometry'] = simplify_chains(csr, ways)
 
-    G = nx.DiGraph()
-    for node_id, (lat, lon) in handler.nodes.items():
+    for node_id, lat, lon in zip(csr.node_ids, csr.lat, csr.lon):
         G.add_node(node_id, lat=lat, lon=lon)
-    for n1, n2, weight, tags in handler.edges:
-        tags_str = json.dumps(tags)
-        G.add_edge(n1, n2, weight=weight, tags=tags_str)
+    for u in range(len(csr)):
+        for e in range(csr.offsets[u], csr.offsets[u + 1]):
+            attr = {'weight': csr.weights[e], 'way': ways[e]}
+            if geometry is not None and geometry[e] >= 0:
+                attr['geometry'] = geometry[e]
+            G.add_edge(csr.node_ids[u], csr.node_ids[csr.targets[e]], **attr)
 
-    logging.info(f"Đã tạo đồ thị với {G.number_of_nodes()} node và {G.number_of_edges()} cạnh")
-    nx.write_graphml(G, graphml_file)
+    logging.info(f"Đã tạo đồ thị với {G.number_of_nodes()} node, {G.number_of_edges()} cạnh và {len(handler.way_table)} way")
+    write_graphml(G, graphml_file)
     logging.info(f"Đã lưu đồ thị vào {graphml_file}")
+    save_graph_cache(G, graphml_file)
+    save_graph_source(handler, graphml_file, simplify)
     return G
 
+def preprocess_routing(G, graphml_file='road_network.graphml'):
+    """
+    Tiền xử lý ngoại tuyến sau build_graph: xây Contraction Hierarchies và bảng
+    landmark (ALT), lưu cạnh file GraphML để ứng dụng không phải tính lại khi khởi động.
+    G có thể là DiGraph hoặc CSRGraph (từ build_graph_streaming).
+    """
+    csr = G if isinstance(G, CSRGraph) else CSRGraph.from_networkx(G)
+    hierarchy = build_contraction_hierarchy(csr)
+    hierarchy.save(ch_path_for(graphml_file))
+    tables = build_landmark_tables(csr)
+    tables.save(landmark_path_for(graphml_file))
+    return hierarchy, tables
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Xây đồ thị đường xe từ file OSM (.osm hoặc .osm.pbf)")
+    parser.add_argument('osm_file', nargs='?', default='kim_lien.osm', help="File OSM XML hoặc PBF")
+    parser.add_argument('-o', '--output', default='road_network.graphml', help="File GraphML đầu ra")
+    area = parser.add_mutually_exclusive_group()
+    area.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                      help="Hộp giới hạn (mặc định khu Kim Liên)")
+    area.add_argument('--polygon', help="Vùng đa giác: file .poly (Osmosis/Geofabrik) hoặc GeoJSON")
+    parser.add_argument('--keep-shape-nodes', action='store_true',
+                        help="Không gộp chuỗi node bậc 2 (giữ mọi node hình dạng trong đồ thị)")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="Số tiến trình xây theo ô (0 = số CPU; mặc định 1 = đọc tuần tự)")
+    parser.add_argument('--tiles', type=int, help="Số ô chia vùng khi xây song song (mặc định bằng số tiến trình)")
+    args = parser.parse_args(argv)
+    if args.workers < 0 or (args.tiles is not None and args.tiles < 1):
+        parser.error("--workers cần >= 0 và --tiles cần >= 1")
+    if args.bbox and (args.bbox[0] >= args.bbox[2] or args.bbox[1] >= args.bbox[3]):
+        parser.error("--bbox cần MIN_LAT < MAX_LAT và MIN_LON < MAX_LON")
+    return args
+
+def area_from_args(args):
+    if args.polygon:
+        return load_polygon(args.polygon)
+    return BBoxArea(*(args.bbox or DEFAULT_BBOX))
+
 if __name__ == "__main__":
-    osm_file = 'kim_lien.osm'
-    build_graph(osm_file)
\ No newline at end of file
+    args = parse_args()
+    timings = {}
+    if args.workers == 1 and args.tiles is None:
+        with stage_timer(timings, 'build'):
+            csr = build_graph_streaming(args.osm_file, args.output, area_from_args(args),
+                                        simplify=not args.keep_shape_nodes)
+    else:
+        csr = build_graph_tiled(args.osm_file, args.output, area_from_args(args), simplify=not args.keep_shape_nodes,
+                                workers=args.workers or None, tiles=args.tiles, timings=timings)
+    with stage_timer(timings, 'preprocess'):
+        preprocess_routing(csr, args.output)
+    log_timings(timings)
\ No newline at end of file
@@ -0,0 +1,176 @@
+import os
+import sys
+import math
+import time
+import logging
+import argparse
+import numpy as np
+from collections import Counter
+import osmium
+from osm_graph_builder import load_graph_source, write_graph_files, preprocess_routing, _read_osm
+from contraction import ch_path_for
+from landmarks import landmark_path_for
+
+class OsmChangeHandler(osmium.SimpleHandler):
+    """
+    Đọc file OsmChange (.osc, .osc.gz): phiên bản sau cùng của từng node và way trong file.
+    nodes: {id: (lat, lon) hoặc None nếu bị xóa}, ways: {id: (tags, [id node]) hoặc None nếu bị xóa}.
+    """
+    def __init__(self):
+        super().__init__()
+        self.nodes = {}
+        self.ways = {}
+
+    def node(self, n):
+        if n.deleted or not n.location.valid():
+            self.nodes[n.id] = None
+        else:
+            self.nodes[n.id] = (n.location.lat, n.location.lon)
+
+    def way(self, w):
+        if w.deleted:
+            self.ways[w.id] = None
+            return
+        tags = {t.k: t.v for t in w.tags}
+        tags['id'] = str(w.id)
+        self.ways[w.id] = (tags, [n.ref for n in w.nodes])
+
+def _locate(node_ids, lat, lon, refs):
+    """Dãy (id node, lat, lon) theo refs; node chưa biết hoặc đã bị xóa có tọa độ nan."""
+    refs = np.asarray(refs, dtype=np.int64)
+    if not len(node_ids):
+        return [(ref, math.nan, math.nan) for ref in refs.tolist()]
+    index = np.minimum(np.searchsorted(node_ids, refs), len(node_ids) - 1)
+    found = node_ids[index] == refs
+    return list(zip(refs.tolist(), np.where(found, lat[index], np.nan).tolist(),
+                    np.where(found, lon[index], np.nan).tolist()))
+
+def _located_nodes(way_id, nodes):
+    """Ghi cảnh báo nếu way có node thiếu tọa độ; trả về danh sách node có tọa độ."""
+    located = [node for node in nodes if not math.isnan(node[1])]
+    if len(located) < len(nodes):
+        logging.warning(f"Way {way_id}: thiếu tọa độ của {len(nodes) - len(located)} node "
+                        f"(đã xóa hoặc không có trong dữ liệu nguồn lẫn file thay đổi), tách way tại các node này")
+    return located
+
+def _remove_stale_preprocessing(graphml_file):
+    """Xóa file CH và landmark không còn khớp với đồ thị đã cập nhật."""
+    for path in (ch_path_for(graphml_file), landmark_path_for(graphml_file)):
+        if os.path.exists(path):
+            os.remove(path)
+            logging.warning(f"Đã xóa {path} (không còn khớp với đồ thị); chạy lại với --preprocess "
+                            f"để xây lại Contraction Hierarchies và bảng landmark")
+
+def apply_osc(osc_file, graphml_file='road_network.graphml', preprocess=False):
+    """
+    Cập nhật đồ thị đã xây bằng một file thay đổi OSM mà không đọc lại cả file OSM:
+    chỉ tính lại cạnh của các way bị sửa/xóa/thêm và các way có node bị di chuyển hoặc xóa,
+    từ dữ liệu nguồn lưu cạnh file GraphML (save_graph_source).
+    Phần cục bộ chỉ là đọc .osc và tính lại các way đó; GraphML, cache .graph.npz và
+    .source.npz vẫn được ghi lại toàn bộ (tuyến tính theo kích thước đồ thị, không phải
+    đọc OSM), file .graph.bin tự dựng lại khi nạp. Contraction Hierarchies và bảng landmark
+    là dữ liệu toàn cục, xây lại tốn như lần xây đầu: mặc định file cũ bị xóa (ứng dụng
+    dùng A* thường cho tới khi tiền xử lý lại ngoại tuyến), preprocess=True xây lại ngay.
+    """
+    started = time.perf_counter()
+    handler, simplified = load_graph_source(graphml_file)
+    changes = OsmChangeHandler()
+    changes.apply_file(osc_file)
+    logging.info(f"Đã đọc {osc_file}: {len(changes.nodes)} node, {len(changes.ways)} way thay đổi")
+
+    offsets, refs = handler.way_refs()
+    table = handler.way_table
+    affected = set()
+    if changes.nodes:
+        changed_nodes = np.fromiter(changes.nodes, dtype=np.int64, count=len(changes.nodes))
+        ref_rows = np.repeat(np.arange(len(table)), np.diff(offsets))
+        affected.update(ref_rows[np.isin(refs, changed_nodes)].tolist())
+    for way_id in changes.ways:
+        row = table.row_of(way_id)
+        if row is not None:
+            affected.add(row)
+    edges_before = len(handler.edge_src)
+    handler.drop_ways(sorted(affected))
+
+    for node_id, coords in changes.nodes.items():
+        handler.set_node(node_id, coords)
+    node_ids, lat, lon = handler.known_nodes()
+
+    rebuilt = 0
+    # Way chỉ bị ảnh hưởng qua node: dùng tags và dãy node đã lưu
+    for row in sorted(affected):
+        if int(table.way_id(row)) in changes.ways:
+            continue
+        nodes = _locate(node_ids, lat, lon, refs[offsets[row]:offsets[row + 1]])
+        _located_nodes(table.way_id(row), nodes)
+        if handler.add_split_way(table.tags(row), nodes) is not None:
+            rebuilt += 1
+
+    for way_id, change in changes.ways.items():
+        if change is None:
+            continue
+        tags, way_refs = change
+        if tags.get('highway') not in handler.vehicle_highways:
+            continue
+        nodes = _locate(node_ids, lat, lon, way_refs)
+        located = _located_nodes(way_id, nodes)
+        if len(located) >= 2 and handler.overlaps(located) and handler.add_split_way(tags, nodes) is not None:
+            rebuilt += 1
+
+    logging.info(f"Tính lại {rebuilt} way ({len(affected)} way cũ bị ảnh hưởng), "
+                 f"cạnh chưa gộp: {edges_before} -> {len(handler.edge_src)}")
+    csr, way_count = write_graph_files(handler, graphml_file, simplified)
+    if preprocess:
+        preprocess_routing(csr, graphml_file)
+    else:
+        _remove_stale_preprocessing(graphml_file)
+    logging.info(f"Đã cập nhật {graphml_file}: {len(csr)} node, {len(csr.targets)} cạnh, {way_count} way "
+                 f"trong {time.perf_counter() - started:.1f} s")
+    return csr
+
+def _segments(handler):
+    """Cạnh chưa gộp của handler theo (way_id, tọa độ hai đầu, trọng số), không theo id node."""
+    table = handler.way_table
+    way_ids = [table.way_id(row) for row in handler.edge_way]
+    weights = [round(weight, 12) for weight in handler.edge_weight]
+    return Counter(zip(way_ids, handler.src_lat, handler.src_lon, handler.dst_lat, handler.dst_lon, weights))
+
+def compare_with_rebuild(graphml_file, osm_file, max_examples=10):
+    """
+    Kiểm tra một lần cập nhật: xây lại đồ thị từ file OSM đã sửa (cùng vùng cắt) và so cạnh
+    chưa gộp với dữ liệu nguồn của graphml_file. Node tạo tại điểm cắt vùng được đánh số khác
+    nhau giữa hai cách xây nên cạnh được so theo tọa độ. Trả về (cạnh thiếu, cạnh thừa) so với bản xây lại.
+    """
+    updated, _ = load_graph_source(graphml_file)
+    rebuilt = _read_osm(osm_file, updated.clip_area)
+    expected, actual = _segments(rebuilt), _segments(updated)
+    missing, extra = expected - actual, actual - expected
+    for label, diff in (("thiếu", missing), ("thừa", extra)):
+        for segment in list(diff)[:max_examples]:
+            logging.warning(f"Cạnh {label} so với bản xây lại: way {segment[0]} "
+                            f"({segment[1]}, {segment[2]}) -> ({segment[3]}, {segment[4]})")
+    if missing or extra:
+        logging.error(f"{graphml_file} khác bản xây lại từ {osm_file}: thiếu {sum(missing.values())} cạnh, "
+                      f"thừa {sum(extra.values())} cạnh")
+    else:
+        logging.info(f"{graphml_file} khớp với bản xây lại từ {osm_file} ({sum(expected.values())} cạnh)")
+    return missing, extra
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cập nhật đồ thị đường xe từ file thay đổi OSM (.osc)")
+    parser.add_argument('osc_file', help="File OsmChange (.osc hoặc .osc.gz)")
+    parser.add_argument('-g', '--graph', default='road_network.graphml',
+                        help="File GraphML đã xây bằng osm_graph_builder (cần file .source.npz đi kèm)")
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Xây lại Contraction Hierarchies và bảng landmark cho cả đồ thị (chậm như lần xây đầu); "
+                             "mặc định chỉ xóa file cũ")
+    parser.add_argument('--verify', metavar='OSM_FILE',
+                        help="Sau khi cập nhật, so đồ thị với bản xây lại từ file OSM đã sửa (thoát mã 1 nếu khác)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    apply_osc(args.osc_file, args.graph, preprocess=args.preprocess)
+    if args.verify:
+        missing, extra = compare_with_rebuild(args.graph, args.verify)
+        sys.exit(1 if missing or extra else 0)
@@ -0,0 +1,67 @@
+import logging
+from collections import OrderedDict
+
+# Số tuyến đường tối đa giữ trong bộ nhớ đệm
+DEFAULT_ROUTE_CACHE_SIZE = 1024
+
+# Độ phân giải (mét) của vị trí snap dọc theo cạnh trong khóa cache
+OFFSET_BUCKET_M = 5.0
+
+class RouteCache:
+    """
+    Bộ nhớ đệm LRU có giới hạn cho kết quả tìm đường.
+    Khóa gồm vị trí snap của hai đầu (cạnh, vị trí dọc cạnh) và tham số tìm đường;
+    toàn bộ cache được xóa khi phiên bản trạng thái giao thông thay đổi.
+    """
+    def __init__(self, max_size=DEFAULT_ROUTE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._traffic_version = None
+        self._snap_keys = OrderedDict()  # {(lat, lng): phần khóa snap}, không phụ thuộc giao thông
+
+    def _check_version(self, traffic_version):
+        if traffic_version != self._traffic_version:
+            if self._entries:
+                logging.info(f"Trạng thái giao thông đổi sang phiên bản {traffic_version}, xóa {len(self._entries)} tuyến trong cache")
+            self._entries.clear()
+            self._traffic_version = traffic_version
+
+    def get(self, key, traffic_version):
+        self._check_version(traffic_version)
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, traffic_version, value):
+        self._check_version(traffic_version)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def snap_key(self, lat, lng, compute):
+        """Phần khóa snap của một tọa độ; compute(lat, lng) chỉ được gọi khi tọa độ chưa gặp."""
+        key = (lat, lng)
+        value = self._snap_keys.get(key)
+        if value is None:
+            value = self._snap_keys[key] = compute(lat, lng)
+            while len(self._snap_keys) > 2 * self.max_size:
+                self._snap_keys.popitem(last=False)
+        else:
+            self._snap_keys.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,16 @@
 import mysql.connector
-import networkx as nx
 import math
-import json
 import heapq
 import logging
+import numpy as np
 from math import radians, sin, cos, sqrt, atan2
+from graph_overlay import GraphOverlay
+from routing_engine import CSRGraph, bidirectional_search
+from traffic import get_traffic_snapshot
+from route_cache import OFFSET_BUCKET_M
+from connectivity import ConnectivityIndex, reachable
+from way_index import WayIndex, edge_way_id
+from edge_geometry import edge_points, edge_polyline, edge_length_km, has_geometry, polyline_fraction
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -43,53 +49,57 @@ def get_blocked_ways(db_config):
         logging.error(f"Lỗi truy vấn traffic_changes: {str(e)}")
         return set()
 
-def apply_traffic_penalties(G, db_config, penalty_factors={'slow': 2, 'blocked': 10}):
-    G_modified = G.copy()
-    blocked_edges = 0
-    edges_to_remove = []
-    try:
-        conn = mysql.connector.connect(**db_config)
-        cursor = conn.cursor(dictionary=True)
-        for u, v, data in G_modified.edges(data=True):
-            try:
-                tags = json.loads(data['tags'])
-                way_id = tags.get('id')
-                query = "SELECT traffic_type FROM traffic_changes WHERE way_id = %s"
-                cursor.execute(query, (way_id,))
-                result = cursor.fetchone()
-                if result:
-                    traffic_type = result['traffic_type']
-                    if traffic_type == 'closed':
-                        edges_to_remove.append((u, v))
-                    elif traffic_type in penalty_factors:
-                        original_weight = data['weight']
-                        penalty = penalty_factors[traffic_type]
-                        data['weight'] = original_weight * penalty
-                        blocked_edges += 1
-                        logging.info(f"Áp dụng phạt cho cạnh ({u}, {v}), way_id: {way_id}, traffic_type: {traffic_type}, trọng số cũ: {original_weight:.3f}, trọng số mới: {data['weight']:.3f}")
-            except (json.JSONDecodeError, KeyError):
-                continue
+def apply_traffic_penalties(G, db_config, penalty_factors={'slow': 2, 'blocked': 10}, snapshot=None):
+    # Ghi thay đổi vào lớp phủ thay vì sao chép đồ thị gốc
+    G_modified = G if isinstance(G, GraphOverlay) else GraphOverlay(G)
+    if snapshot is None:
+        snapshot = get_traffic_snapshot(db_config)
+        if snapshot is None:
+            logging.error("Không có dữ liệu giao thông, bỏ qua áp dụng phạt")
+            return G_modified
+
+    way_index = G_modified.graph.get('way_index')
+    if way_index is None:
+        way_index = G_modified.graph['way_index'] = WayIndex.from_graph(G_modified.base)
+
+    penalized, closed = snapshot.edge_effects(way_index, penalty_factors)
+    penalized = dict(penalized)
+    closed = list(closed)
+
+    # Cạnh tách tại node ảo không có trong chỉ mục, xét riêng theo way của chúng
+    for u, v in G_modified.virtual_edges():
+        traffic_type = snapshot.traffic_type(edge_way_id(G_modified[u][v], G_modified.graph.get('way_table')))
+        if traffic_type == 'closed':
+            closed.append((u, v))
+        elif traffic_type in penalty_factors:
+            penalized[(u, v)] = penalty_factors[traffic_type]
 
-        for u, v in edges_to_remove:
-            if G_modified.has_edge(u, v):
-                G_modified.remove_edge(u, v)
-            if G_modified.has_edge(v, u):
-                G_modified.remove_edge(v, u)
+    blocked_edges = 0
+    for (u, v), penalty in penalized.items():
+        data = G_modified.get_edge_data(u, v)
+        if data is None:
+            continue  # Cạnh gốc đã bị tách bởi node ảo
+        original_weight = data['weight']
+        G_modified.add_edge(u, v, **{**data, 'weight': original_weight * penalty})
+        blocked_edges += 1
+        logging.info(f"Áp dụng phạt cho cạnh ({u}, {v}), hệ số: {penalty}, trọng số cũ: {original_weight:.3f}, trọng số mới: {original_weight * penalty:.3f}")
+
+    for u, v in closed:
+        removed = False
+        if G_modified.has_edge(u, v):
+            G_modified.remove_edge(u, v)
+            removed = True
+        if G_modified.has_edge(v, u):
+            G_modified.remove_edge(v, u)
+            removed = True
+        if removed:
             blocked_edges += 1
-            logging.info(f"Xóa cạnh ({u}, {v}) do trạng thái closed, way_id: {way_id}")
+            logging.info(f"Xóa cạnh ({u}, {v}) do trạng thái closed")
 
-        cursor.close()
-        conn.close()
-    except mysql.connector.Error as err:
-        logging.error(f"Lỗi truy vấn CSDL trong apply_traffic_penalties: {err}")
     logging.info(f"Áp dụng phạt hoặc xóa cho {blocked_edges} cạnh")
     return G_modified
 
-def project_to_edge(G, u, v, target_lat, target_lng):
-    x1, y1 = G.nodes[u]['lat'], G.nodes[u]['lon']
-    x2, y2 = G.nodes[v]['lat'], G.nodes[v]['lon']
-    x, y = target_lat, target_lng
-
+def _project_to_segment(x1, y1, x2, y2, x, y):
     if x1 == x2 and y1 == y2:
         dist = haversine(y, x, y1, x1)
         return x1, y1, dist, 0
@@ -105,25 +115,66 @@ def project_to_edge(G, u, v, target_lat, target_lng):
 
     return proj_x, proj_y, dist, t
 
-def snap_to_edge(G, target_lat, target_lng, max_distance_km=0.5):
-    min_dist = float('inf')
-    closest_edge = None
-    closest_point = None
-    closest_t = None
+def project_to_edge(G, u, v, target_lat, target_lng):
+    """
+    Chiếu điểm lên cạnh (u, v). Cạnh gộp từ chuỗi node bậc 2 được chiếu lên đoạn gần nhất
+    của đường gấp khúc; t là vị trí dọc cả cạnh. Trả về (lat, lon, khoảng cách km, t).
+    """
+    data = G.get_edge_data(u, v)
+    if data is not None and has_geometry(data):
+        points = edge_polyline(G, u, v, data)
+        best = None
+        for i, ((x1, y1), (x2, y2)) in enumerate(zip(points, points[1:])):
+            proj_x, proj_y, dist, t = _project_to_segment(x1, y1, x2, y2, target_lat, target_lng)
+            if best is None or dist < best[2]:
+                best = (proj_x, proj_y, dist, polyline_fraction(points, i, t))
+        return best
 
+    x1, y1 = G.nodes[u]['lat'], G.nodes[u]['lon']
+    x2, y2 = G.nodes[v]['lat'], G.nodes[v]['lon']
+    return _project_to_segment(x1, y1, x2, y2, target_lat, target_lng)
+
+def locate_on_edge(G, target_lat, target_lng, max_distance_km=0.5):
+    """
+    Tìm cạnh gần nhất với điểm (target_lat, target_lng) trong max_distance_km.
+    Trả về (u, v, (proj_lat, proj_lon), t) hoặc None nếu không có cạnh nào đủ gần.
+    """
+    index = G.graph.get('spatial_index')
+    if index is not None:
+        if isinstance(G, GraphOverlay):
+            # Cạnh nối node ảo của lớp phủ không có trong lưới
+            index = index.with_extra_edges(G.virtual_edges())
+
+        # Chỉ xét các cạnh nằm trong các ô lưới quanh điểm click
+        def measure(u, v):
+            if not G.has_edge(u, v):
+                return None
+            proj_lat, proj_lon, dist, t = project_to_edge(G, u, v, target_lat, target_lng)
+            return dist, u, v, (proj_lat, proj_lon), t
+
+        nearest = index.nearest(target_lat, target_lng, measure, max_distance_km)
+        return nearest[1:] if nearest is not None else None
+
+    min_dist = float('inf')
+    closest = None
     for u, v in G.edges():
         proj_lat, proj_lon, dist, t = project_to_edge(G, u, v, target_lat, target_lng)
         if dist < min_dist and dist <= max_distance_km:
             min_dist = dist
-            closest_edge = (u, v)
-            closest_point = (proj_lat, proj_lon)
-            closest_t = t
+            closest = (u, v, (proj_lat, proj_lon), t)
+    return closest
 
-    if closest_edge is None:
+def snap_to_edge(G, target_lat, target_lng, max_distance_km=0.5):
+    """
+    Snap điểm vào đồ thị. Nếu cần tách cạnh, node ảo được thêm vào một GraphOverlay
+    trên đồ thị gốc (không sao chép đồ thị). Trả về (node, đồ thị/lớp phủ dùng để tìm đường).
+    """
+    located = locate_on_edge(G, target_lat, target_lng, max_distance_km)
+    if located is None:
         logging.warning("Không tìm thấy cạnh nào trong khoảng cách tối đa")
         return None, G
 
-    u, v = closest_edge
+    u, v, closest_point, closest_t = located
     if closest_t < 0.01:
         logging.info(f"Snap đến node hiện có {u}")
         return u, G
@@ -131,30 +182,11 @@ def snap_to_edge(G, target_lat, target_lng, max_distance_km=0.5):
         logging.info(f"Snap đến node hiện có {v}")
         return v, G
 
-    G_modified = G.copy()
-    new_node = max(G.nodes()) + 1
-    G_modified.add_node(new_node, lat=closest_point[0], lon=closest_point[1])
-
-    edge_data = G.get_edge_data(u, v)
-    weight = edge_data['weight'] * closest_t
-    G_modified.add_edge(u, new_node, weight=weight, tags=edge_data['tags'])
-
-    weight = edge_data['weight'] * (1 - closest_t)
-    G_modified.add_edge(new_node, v, weight=weight, tags=edge_data['tags'])
-
-    if G_modified.has_edge(v, u):
-        edge_data = G.get_edge_data(v, u)
-        weight = edge_data['weight'] * (1 - closest_t)
-        G_modified.add_edge(v, new_node, weight=weight, tags=edge_data['tags'])
-        weight = edge_data['weight'] * closest_t
-        G_modified.add_edge(new_node, u, weight=weight, tags=edge_data['tags'])
-
-    G_modified.remove_edge(u, v)
-    if G_modified.has_edge(v, u):
-        G_modified.remove_edge(v, u)
+    overlay = G if isinstance(G, GraphOverlay) else GraphOverlay(G)
+    new_node = overlay.split_edge(u, v, closest_t, closest_point[0], closest_point[1])
 
     logging.info(f"Tạo node ảo {new_node} tại ({closest_point[0]}, {closest_point[1]})")
-    return new_node, G_modified
+    return new_node, overlay
 
 def a_star_path(G, source, target, end_lat, end_lng):
     max_speed = 100  # Tốc độ tối đa (km/h) cho heuristic
@@ -193,11 +225,116 @@ def a_star_path(G, source, target, end_lat, end_lng):
     logging.warning(f"Không tìm thấy đường từ {source} đến {target}")
     return []
 
+def bidirectional_a_star_path(G, source, target, max_speed=100):
+    """
+    A* hai chiều trên đồ thị networkx (hoặc GraphOverlay): chiều lùi đi theo G.pred
+    nên đường một chiều vẫn được tôn trọng.
+    """
+    def coords(node):
+        return G.nodes[node]['lon'], G.nodes[node]['lat']
+
+    def potential(node):
+        return (haversine(*coords(node), *coords(target)) - haversine(*coords(source), *coords(node))) / (2 * max_speed)
+
+    path = bidirectional_search(source, target,
+                                lambda u: ((v, data['weight']) for v, data in G[u].items()),
+                                lambda v: ((u, data['weight']) for u, data in G.pred[v].items()),
+                                potential)
+    if not path:
+        logging.warning(f"Không tìm thấy đường từ {source} đến {target}")
+    return path
+
+def get_routing_engine(G):
+    """
+    Lấy đồ thị CSR đã xây khi tải đồ thị (G.graph['csr']), xây mới nếu chưa có.
+    """
+    csr = G.graph.get('csr')
+    if csr is None:
+        base = G.base if isinstance(G, GraphOverlay) else G
+        csr = G.graph['csr'] = CSRGraph.from_networkx(base)
+    return csr
+
+def get_connectivity(G, snapshot, penalty_factors):
+    """
+    Chỉ mục liên thông mạnh ứng với trạng thái giao thông hiện tại. Không có cạnh bị cấm thì
+    dùng chỉ mục tính khi tải đồ thị; ngược lại tính lại một lần cho mỗi phiên bản giao thông.
+    """
+    csr = get_routing_engine(G)
+    way_index = G.graph.get('way_index')
+    if way_index is None:
+        way_index = G.graph['way_index'] = WayIndex.from_graph(G.base if isinstance(G, GraphOverlay) else G)
+    _, closed = snapshot.edge_effects(way_index, penalty_factors)
+    if not closed:
+        connectivity = G.graph.get('connectivity')
+        if connectivity is None:
+            connectivity = G.graph['connectivity'] = ConnectivityIndex.from_csr(csr)
+        return connectivity
+
+    key = (snapshot.version, tuple(sorted(penalty_factors.items())))
+    cached = G.graph.get('traffic_connectivity')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # Cạnh bị cấm được xóa theo cả hai chiều như trong apply_traffic_penalties
+    removed = set()
+    for u, v in closed:
+        if u in csr.index_of and v in csr.index_of:
+            removed.add((csr.index_of[u], csr.index_of[v]))
+            removed.add((csr.index_of[v], csr.index_of[u]))
+    connectivity = ConnectivityIndex.from_csr(csr, removed)
+    G.graph['traffic_connectivity'] = (key, connectivity)
+    return connectivity
+
+def _snap_cache_key(G, lat, lng):
+    """
+    Phần khóa cache cho một đầu mút: node nếu snap trùng node, ngược lại cạnh và vị trí
+    dọc cạnh làm tròn theo OFFSET_BUCKET_M. Trả về (khóa, điểm chiếu trên cạnh hoặc None).
+    """
+    located = locate_on_edge(G, lat, lng)
+    if located is None:
+        return None, None
+    u, v, point, t = located
+    # Cùng ngưỡng với snap_to_edge
+    if t < 0.01:
+        return ('node', u), None
+    if t > 0.99:
+        return ('node', v), None
+    data = G.get_edge_data(u, v)
+    if has_geometry(data):
+        length_m = edge_length_km(G, u, v, data) * 1000
+    else:
+        length_m = haversine(G.nodes[u]['lon'], G.nodes[u]['lat'], G.nodes[v]['lon'], G.nodes[v]['lat']) * 1000
+    return ('edge', u, v, round(t * length_m / OFFSET_BUCKET_M)), point
+
+def path_points(G, path):
+    """Tọa độ (lat, lon) dọc đường đi: các node của path và điểm trung gian của các cạnh đã gộp."""
+    points = []
+    for i, node in enumerate(path):
+        if i > 0:
+            data = G.get_edge_data(path[i - 1], node)
+            if data is not None:
+                points.extend(edge_points(G, data))
+        points.append((G.nodes[node]['lat'], G.nodes[node]['lon']))
+    return points
+
+def get_route_cache_stats(graph):
+    """Số lần trúng/trượt và kích thước cache tuyến đường của đồ thị."""
+    cache = graph.graph.get('route_cache')
+    return cache.stats() if cache is not None else None
+
 def find_route(start_lat, start_lng, end_lat, end_lng, graph,
                db_config={'host': 'localhost', 'user': 'root', 'password': '', 'database': 'map_app'},
-               penalty_factors={'slow': 2, 'blocked': 10, 'closed': 1000}):
+               penalty_factors={'slow': 2, 'blocked': 10, 'closed': 1000},
+               engine='csr', algorithm='astar'):
+    """
+    Tìm đường giữa hai điểm. engine='csr' dùng A* trên mảng CSR,
+    engine='networkx' dùng a_star_path trên dict của networkx để so sánh.
+    algorithm='bidirectional' chạy A* hai chiều thay cho A* một chiều,
+    algorithm='ch' dùng Contraction Hierarchies đã tiền xử lý khi không có thay đổi giao thông.
+    """
     try:
-        if not test_db_connection(db_config):
+        # Trạng thái giao thông được đọc một lần vào bộ nhớ, không truy vấn CSDL theo từng cạnh
+        snapshot = get_traffic_snapshot(db_config)
+        if snapshot is None:
             logging.error("Không thể kết nối CSDL")
             return []
 
@@ -205,6 +342,30 @@ def find_route(start_lat, start_lng, end_lat, end_lng, graph,
             logging.error("Đồ thị không được cung cấp")
             return []
 
+        # Tuyến đã tìm với cùng vị trí snap và cùng trạng thái giao thông được lấy lại từ cache
+        cache = graph.graph.get('route_cache')
+        cache_key = None
+        if cache is not None:
+            def locate(lat, lng):
+                return _snap_cache_key(graph, lat, lng)
+            start_key, start_point = cache.snap_key(start_lat, start_lng, locate)
+            end_key, end_point = cache.snap_key(end_lat, end_lng, locate)
+            if start_key is not None and end_key is not None:
+                cache_key = (start_key, end_key, engine, algorithm, tuple(sorted(penalty_factors.items())))
+                cached = cache.get(cache_key, snapshot.version)
+                if cached is not None:
+                    if not cached:
+                        logging.error("Không tìm thấy đường đi (cache)")
+                        return []
+                    # Thay điểm chiếu của node ảo bằng điểm chiếu của yêu cầu hiện tại
+                    points = [list(point) for point in cached]
+                    if start_point is not None:
+                        points[0] = list(start_point)
+                    if end_point is not None:
+                        points[-1] = list(end_point)
+                    logging.info(f"Lấy đường đi từ cache ({len(points) + 2} điểm)")
+                    return [[start_lat, start_lng]] + points + [[end_lat, end_lng]]
+
         start_node, G = snap_to_edge(graph, start_lat, start_lng)
         if start_node is None:
             logging.error(f"Không snap được điểm bắt đầu tại ({start_lat}, {start_lng})")
@@ -215,23 +376,107 @@ def find_route(start_lat, start_lng, end_lat, end_lng, graph,
             logging.error(f"Không snap được điểm kết thúc tại ({end_lat}, {end_lng})")
             return []
 
-        G_modified = apply_traffic_penalties(G, db_config, penalty_factors)
-
-        if not nx.has_path(G_modified.to_undirected(), start_node, end_node):
-            logging.error(f"Không có đường nối giữa node {start_node} và {end_node}")
-            return []
-
-        path = a_star_path(G_modified, start_node, end_node, end_lat, end_lng)
+        G_modified = apply_traffic_penalties(G, db_config, penalty_factors, snapshot=snapshot)
+
+        # Loại ngay các cặp điểm không liên thông (theo chiều đường một chiều và cạnh bị cấm)
+        connectivity = get_connectivity(G_modified, snapshot, penalty_factors)
+        if not reachable(connectivity, get_routing_engine(G_modified), start_node, end_node, G_modified):
+            logging.warning(f"Không có đường từ {start_node} đến {end_node} (khác thành phần liên thông)")
+            path = []
+        elif algorithm == 'ch' and G_modified.graph.get('ch') is not None and not G_modified.modifies_base_weights():
+            path = G_modified.graph['ch'].query(start_node, end_node, overlay=G_modified)
+        elif engine == 'csr':
+            csr = get_routing_engine(G_modified)
+            # Bảng landmark (nếu đã tiền xử lý) cho cận dưới ALT
+            landmarks = G_modified.graph.get('landmarks')
+            if algorithm == 'ch':
+                # Trọng số CH là trọng số gốc, không dùng được khi giao thông làm thay đổi cạnh
+                logging.info("Không dùng được Contraction Hierarchies, chuyển sang A* hai chiều")
+                path = csr.bidirectional_astar(start_node, end_node, overlay=G_modified, landmarks=landmarks)
+            elif algorithm == 'bidirectional':
+                path = csr.bidirectional_astar(start_node, end_node, overlay=G_modified, landmarks=landmarks)
+            else:
+                path = csr.astar(start_node, end_node, overlay=G_modified, landmarks=landmarks)
+        elif algorithm == 'bidirectional':
+            path = bidirectional_a_star_path(G_modified, start_node, end_node)
+        else:
+            path = a_star_path(G_modified, start_node, end_node, end_lat, end_lng)
+        # Tìm kiếm chạy trên đồ thị đã gộp chuỗi, hình học được mở ra khi dựng đường gấp khúc
+        points = path_points(G_modified, path)
+        if cache_key is not None:
+            cache.put(cache_key, snapshot.version, tuple(points))
         if not path:
             logging.error("Không tìm thấy đường đi")
             return []
 
-        route = [[start_lat, start_lng]] + \
-                [[G_modified.nodes[node]['lat'], G_modified.nodes[node]['lon']] for node in path] + \
-                [[end_lat, end_lng]]
+        route = [[start_lat, start_lng]] + [list(point) for point in points] + [[end_lat, end_lng]]
         logging.info(f"Tìm thấy đường đi với {len(route)} điểm, bắt đầu tại ({start_lat}, {start_lng}), kết thúc tại ({end_lat}, {end_lng})")
         return route
 
     except Exception as e:
         logging.error(f"Lỗi tìm đường: {str(e)}")
-        return []
\ No newline at end of file
+        return []
+
+def travel_time_matrix(origins, destinations, graph,
+                       db_config={'host': 'localhost', 'user': 'root', 'password': '', 'database': 'map_app'},
+                       penalty_factors={'slow': 2, 'blocked': 10, 'closed': 1000}):
+    """
+    Ma trận khoảng cách và thời gian đi giữa các điểm xuất phát và điểm đích
+    (danh sách (lat, lng)). Mọi điểm được snap một lần vào cùng một lớp phủ, giao thông
+    được áp dụng một lần, sau đó chạy một Dijkstra một-nhiều cho mỗi điểm xuất phát.
+    Trả về (distances, times): mảng NumPy kích thước len(origins) x len(destinations),
+    khoảng cách theo km dọc đường nhanh nhất, thời gian theo giờ. Cặp không có đường là inf,
+    điểm không snap được là nan. Trả về None nếu lỗi.
+    """
+    try:
+        snapshot = get_traffic_snapshot(db_config)
+        if snapshot is None:
+            logging.error("Không thể kết nối CSDL")
+            return None
+
+        if graph is None:
+            logging.error("Đồ thị không được cung cấp")
+            return None
+
+        G = graph
+        snapped = []
+        for lat, lng in list(origins) + list(destinations):
+            node, G = snap_to_edge(G, lat, lng)
+            if node is None:
+                logging.warning(f"Không snap được điểm ({lat}, {lng})")
+            snapped.append(node)
+        origin_nodes = snapped[:len(origins)]
+        destination_nodes = snapped[len(origins):]
+
+        G_modified = apply_traffic_penalties(G, db_config, penalty_factors, snapshot=snapshot)
+        csr = get_routing_engine(G_modified)
+
+        distances = np.full((len(origin_nodes), len(destination_nodes)), np.nan)
+        times = np.full((len(origin_nodes), len(destination_nodes)), np.nan)
+        connectivity = get_connectivity(G_modified, snapshot, penalty_factors)
+        for i, source in enumerate(origin_nodes):
+            if source is None:
+                continue
+            # Đích không tới được được gán inf ngay, Dijkstra không phải duyệt hết đồ thị để tìm chúng
+            columns = []
+            for j, node in enumerate(destination_nodes):
+                if node is None:
+                    continue
+                if reachable(connectivity, csr, source, node, G_modified):
+                    columns.append(j)
+                else:
+                    times[i, j] = distances[i, j] = np.inf
+            if not columns:
+                continue
+            targets = [destination_nodes[j] for j in columns]
+            row_times, row_lengths = csr.one_to_many(source, targets, overlay=G_modified)
+            times[i, columns] = row_times
+            distances[i, columns] = row_lengths
+
+        logging.info(f"Tính ma trận {len(origin_nodes)} x {len(destination_nodes)}, "
+                     f"{int(np.isfinite(times).sum())} cặp có đường đi")
+        return distances, times
+
+    except Exception as e:
+        logging.error(f"Lỗi tính ma trận thời gian: {str(e)}")
+        return None
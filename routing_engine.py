@@ -0,0 +1,388 @@
+import math
+import heapq
+import logging
+from array import array
+from edge_geometry import edge_length_km, has_geometry
+
+R_EARTH_KM = 6371.0
+
+class CSRGraph:
+    """
+    Đồ thị có hướng lưu dạng CSR trong các mảng phẳng:
+    tọa độ node, offsets danh sách kề, node đích và trọng số của từng cạnh.
+    Node được đánh chỉ số 0..n-1; node ảo của GraphOverlay nhận chỉ số n, n+1, ...
+    """
+    def __init__(self, node_ids, lat, lon, offsets, targets, weights, index_of=None, reverse=None, trig=None,
+                 lengths=None):
+        """
+        index_of, reverse (rev_offsets, rev_sources, rev_weights), trig (lat_rad, lon_rad, cos_lat)
+        và lengths có thể truyền sẵn (ví dụ từ file ánh xạ bộ nhớ) để không phải tính lại.
+        lengths bắt buộc khi đồ thị có cạnh gộp chuỗi (độ dài khác Haversine giữa hai đầu).
+        """
+        self.node_ids = node_ids  # array('q'): chỉ số -> id node OSM
+        self.lat = lat  # array('d')
+        self.lon = lon  # array('d')
+        self.offsets = offsets  # array('q'), độ dài n + 1
+        self.targets = targets  # array('q'): chỉ số node đích của từng cạnh
+        self.weights = weights  # array('d'): thời gian di chuyển (giờ)
+        self.index_of = index_of if index_of is not None else {node: i for i, node in enumerate(node_ids)}
+        if reverse is None:
+            self._build_reverse()
+        else:
+            self.rev_offsets, self.rev_sources, self.rev_weights = reverse
+        # Giá trị lượng giác tính sẵn cho heuristic Haversine
+        if trig is None:
+            self.lat_rad = array('d', (math.radians(x) for x in lat))
+            self.lon_rad = array('d', (math.radians(x) for x in lon))
+            self.cos_lat = array('d', (math.cos(x) for x in self.lat_rad))
+        else:
+            self.lat_rad, self.lon_rad, self.cos_lat = trig
+        self._lengths = lengths
+
+    @classmethod
+    def from_networkx(cls, G):
+        node_ids = array('q', G.nodes())
+        index_of = {node: i for i, node in enumerate(node_ids)}
+        lat = array('d', (G.nodes[n]['lat'] for n in node_ids))
+        lon = array('d', (G.nodes[n]['lon'] for n in node_ids))
+        offsets = array('q', [0])
+        targets = array('q')
+        weights = array('d')
+        # Độ dài dọc hình học của cạnh gộp chuỗi node bậc 2
+        lengths = array('d') if G.graph.get('edge_geometry') is not None else None
+        for node in node_ids:
+            for neighbor, data in G[node].items():
+                targets.append(index_of[neighbor])
+                weights.append(data['weight'])
+                if lengths is not None:
+                    lengths.append(edge_length_km(G, node, neighbor, data))
+            offsets.append(len(targets))
+        logging.info(f"Đã xây đồ thị CSR với {len(node_ids)} node và {len(targets)} cạnh")
+        return cls(node_ids, lat, lon, offsets, targets, weights, lengths=lengths)
+
+    def _build_reverse(self):
+        """Danh sách kề ngược (cạnh vào) cho tìm kiếm chiều lùi, giữ đúng đường một chiều."""
+        n = len(self.node_ids)
+        counts = [0] * (n + 1)
+        for target in self.targets:
+            counts[target + 1] += 1
+        for i in range(n):
+            counts[i + 1] += counts[i]
+        self.rev_offsets = array('q', counts)
+        self.rev_sources = array('q', bytes(8 * len(self.targets)))
+        self.rev_weights = array('d', bytes(8 * len(self.targets)))
+        position = counts[:n]
+        for u in range(n):
+            for e in range(self.offsets[u], self.offsets[u + 1]):
+                v = self.targets[e]
+                slot = position[v]
+                self.rev_sources[slot] = u
+                self.rev_weights[slot] = self.weights[e]
+                position[v] = slot + 1
+
+    def signature(self):
+        """(số node, số cạnh, tổng trọng số) dùng để kiểm tra dữ liệu tiền xử lý còn khớp."""
+        return len(self.node_ids), len(self.targets), math.fsum(self.weights)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def key_of(self, node, overlay=None):
+        """Chỉ số trong CSR của một node (node ảo nằm sau các node gốc)."""
+        if overlay is not None and overlay.is_virtual(node):
+            return len(self.node_ids) - node - 1
+        return self.index_of[node]
+
+    def node_of(self, key):
+        n = len(self.node_ids)
+        return self.node_ids[key] if key < n else n - key - 1
+
+    def _coords_rad(self, key, overlay):
+        if key < len(self.node_ids):
+            return self.lat_rad[key], self.lon_rad[key], self.cos_lat[key]
+        data = overlay.nodes[self.node_of(key)]
+        lat_rad = math.radians(data['lat'])
+        return lat_rad, math.radians(data['lon']), math.cos(lat_rad)
+
+    def successors(self, key, overlay=None):
+        """Danh sách (chỉ số đích, trọng số) của các cạnh ra, có tính đến lớp phủ."""
+        if overlay is not None:
+            node = self.node_of(key)
+            if overlay.successors_modified(node):
+                return [(self.key_of(v, overlay), data['weight']) for v, data in overlay[node].items()]
+        start, end = self.offsets[key], self.offsets[key + 1]
+        return zip(self.targets[start:end], self.weights[start:end])
+
+    def predecessors(self, key, overlay=None):
+        """Danh sách (chỉ số nguồn, trọng số) của các cạnh vào, có tính đến lớp phủ."""
+        if overlay is not None:
+            node = self.node_of(key)
+            if overlay.predecessors_modified(node):
+                return [(self.key_of(u, overlay), data['weight']) for u, data in overlay.pred[node].items()]
+        start, end = self.rev_offsets[key], self.rev_offsets[key + 1]
+        return zip(self.rev_sources[start:end], self.rev_weights[start:end])
+
+    def _unwind(self, pred, key):
+        path = []
+        while key != -1:
+            path.append(self.node_of(key))
+            key = pred[key]
+        path.reverse()
+        return path
+
+    def lower_bound_to(self, target_key, overlay=None, max_speed=100, landmarks=None):
+        """
+        Hàm cận dưới thời gian đi (giờ) từ một node (chỉ số CSR) tới target_key:
+        Haversine / max_speed, kết hợp với cận ALT nếu có bảng landmark. Kết quả được cache theo node.
+        """
+        t_lat, t_lon, t_cos = self._coords_rad(target_key, overlay)
+        n = len(self.node_ids)
+        lat_rad, lon_rad, cos_lat = self.lat_rad, self.lon_rad, self.cos_lat
+        scale = 2 * R_EARTH_KM / max_speed
+        alt = landmarks.bound_to(self, target_key, overlay) if landmarks is not None else None
+        cache = {}
+
+        def heuristic(k):
+            h = cache.get(k)
+            if h is None:
+                if k < n:
+                    lat, lon, cos_k = lat_rad[k], lon_rad[k], cos_lat[k]
+                else:
+                    lat, lon, cos_k = self._coords_rad(k, overlay)
+                a = math.sin((t_lat - lat) / 2) ** 2 + cos_k * t_cos * math.sin((t_lon - lon) / 2) ** 2
+                h = scale * math.asin(min(1.0, math.sqrt(a)))
+                if alt is not None and k < n:
+                    h = max(h, alt(k))
+                cache[k] = h
+            return h
+
+        return heuristic
+
+    def lower_bound_from(self, source_key, overlay=None, max_speed=100, landmarks=None):
+        """Hàm cận dưới thời gian đi (giờ) từ source_key tới một node, dùng cho chiều lùi."""
+        haversine_bound = self.lower_bound_to(source_key, overlay, max_speed)
+        alt = landmarks.bound_from(self, source_key, overlay) if landmarks is not None else None
+        if alt is None:
+            return haversine_bound
+        n = len(self.node_ids)
+        return lambda k: max(haversine_bound(k), alt(k)) if k < n else haversine_bound(k)
+
+    def astar(self, source, target, overlay=None, max_speed=100, landmarks=None):
+        """
+        A* trên mảng CSR, lưu node cha thay vì sao chép đường đi trong heap.
+        Heuristic Haversine / max_speed (và cận ALT nếu truyền landmarks) được tính
+        một lần cho mỗi node. Trả về danh sách id node từ source đến target, hoặc [].
+        """
+        s = self.key_of(source, overlay)
+        t = self.key_of(target, overlay)
+        if landmarks is not None:
+            max_speed = landmarks.max_speed
+        heuristic = self.lower_bound_to(t, overlay, max_speed, landmarks)
+
+        g_score = {s: 0.0}
+        pred = {s: -1}
+        closed = set()
+        open_set = [(heuristic(s), s)]
+        while open_set:
+            _, current = heapq.heappop(open_set)
+            if current == t:
+                logging.debug(f"A* (CSR) duyệt {len(closed)} node")
+                return self._unwind(pred, t)
+            if current in closed:
+                continue
+            closed.add(current)
+
+            g_current = g_score[current]
+            for neighbor, weight in self.successors(current, overlay):
+                if neighbor in closed:
+                    continue
+                tentative = g_current + weight
+                if tentative < g_score.get(neighbor, math.inf):
+                    g_score[neighbor] = tentative
+                    pred[neighbor] = current
+                    heapq.heappush(open_set, (tentative + heuristic(neighbor), neighbor))
+
+        logging.warning(f"Không tìm thấy đường từ {source} đến {target}")
+        return []
+
+    def shortest_distances(self, source_key, reverse=False):
+        """
+        Dijkstra từ một node trên đồ thị gốc (không lớp phủ) tới mọi node.
+        reverse=True tính khoảng cách từ mọi node tới source_key. Trả về array('d'), inf nếu không tới được.
+        """
+        n = len(self.node_ids)
+        offsets, targets, weights = (self.rev_offsets, self.rev_sources, self.rev_weights) if reverse \
+            else (self.offsets, self.targets, self.weights)
+        dist = array('d', [math.inf]) * n
+        dist[source_key] = 0.0
+        heap = [(0.0, source_key)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + weights[e]
+                if new_dist < dist[v]:
+                    dist[v] = new_dist
+                    heapq.heappush(heap, (new_dist, v))
+        return dist
+
+    def haversine_rad(self, a, b, overlay=None):
+        """Khoảng cách Haversine (km) giữa hai node theo chỉ số CSR."""
+        lat1, lon1, cos1 = self._coords_rad(a, overlay)
+        lat2, lon2, cos2 = self._coords_rad(b, overlay)
+        h = math.sin((lat2 - lat1) / 2) ** 2 + cos1 * cos2 * math.sin((lon2 - lon1) / 2) ** 2
+        return 2 * R_EARTH_KM * math.asin(min(1.0, math.sqrt(h)))
+
+    @property
+    def lengths(self):
+        """
+        Độ dài (km) của từng cạnh: truyền sẵn khi xây (cạnh gộp chuỗi), ngược lại
+        Haversine giữa hai đầu, tính một lần khi cần.
+        """
+        if self._lengths is None:
+            lengths = array('d', bytes(8 * len(self.targets)))
+            for u in range(len(self.node_ids)):
+                for e in range(self.offsets[u], self.offsets[u + 1]):
+                    lengths[e] = self.haversine_rad(u, self.targets[e])
+            self._lengths = lengths
+        return self._lengths
+
+    def one_to_many(self, source, targets, overlay=None):
+        """
+        Dijkstra từ source tới nhiều đích, dừng khi đã chốt hết các đích tới được.
+        Trả về (thời gian, độ dài km) theo thứ tự targets; độ dài là độ dài của đường
+        nhanh nhất. Đích không tới được có giá trị inf.
+        """
+        s = self.key_of(source, overlay)
+        wanted = {self.key_of(target, overlay) for target in targets}
+        n = len(self.node_ids)
+        offsets, csr_targets, weights, lengths = self.offsets, self.targets, self.weights, self.lengths
+
+        time = {s: 0.0}
+        length = {s: 0.0}
+        settled = set()
+        heap = [(0.0, s)]
+        while heap and wanted:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            wanted.discard(u)
+
+            node = self.node_of(u)
+            if u >= n or (overlay is not None and overlay.successors_modified(node)):
+                edges = [(self.key_of(v, overlay), data['weight'],
+                          edge_length_km(overlay, node, v, data) if has_geometry(data)
+                          else self.haversine_rad(u, self.key_of(v, overlay), overlay))
+                         for v, data in overlay[node].items()]
+            else:
+                edges = ((csr_targets[e], weights[e], lengths[e]) for e in range(offsets[u], offsets[u + 1]))
+            for v, weight, edge_length in edges:
+                new_time = d + weight
+                if new_time < time.get(v, math.inf):
+                    time[v] = new_time
+                    length[v] = length[u] + edge_length
+                    heapq.heappush(heap, (new_time, v))
+
+        result_time, result_length = [], []
+        for target in targets:
+            t = self.key_of(target, overlay)
+            reached = t in settled
+            result_time.append(time[t] if reached else math.inf)
+            result_length.append(length[t] if reached else math.inf)
+        return result_time, result_length
+
+    def bidirectional_astar(self, source, target, overlay=None, max_speed=100, landmarks=None):
+        """
+        A* hai chiều: chiều tiến theo cạnh ra, chiều lùi theo danh sách kề ngược.
+        Trả về danh sách id node từ source đến target, hoặc [] nếu không có đường.
+        """
+        s = self.key_of(source, overlay)
+        t = self.key_of(target, overlay)
+        if landmarks is not None:
+            max_speed = landmarks.max_speed
+        to_target = self.lower_bound_to(t, overlay, max_speed, landmarks)
+        from_source = self.lower_bound_from(s, overlay, max_speed, landmarks)
+
+        def potential(k):
+            return (to_target(k) - from_source(k)) / 2
+
+        path = bidirectional_search(s, t,
+                                    lambda k: self.successors(k, overlay),
+                                    lambda k: self.predecessors(k, overlay),
+                                    potential)
+        if not path:
+            logging.warning(f"Không tìm thấy đường từ {source} đến {target}")
+        return [self.node_of(k) for k in path]
+
+def bidirectional_search(source, target, successors, predecessors, potential):
+    """
+    A* hai chiều với thế trung bình p(v): khóa chiều tiến là g_f(v) + p(v),
+    khóa chiều lùi là g_b(v) - p(v). Dừng khi tổng hai khóa nhỏ nhất không nhỏ hơn
+    độ dài đường tốt nhất đã gặp. successors(v) và predecessors(v) trả về các cặp
+    (node, trọng số). Trả về danh sách node từ source đến target, hoặc [].
+    """
+    if source == target:
+        return [source]
+
+    potential_cache = {}
+
+    def cached_potential(node):
+        p = potential_cache.get(node)
+        if p is None:
+            p = potential_cache[node] = potential(node)
+        return p
+
+    g_score = ({source: 0.0}, {target: 0.0})
+    parent = ({source: None}, {target: None})
+    closed = (set(), set())
+    open_sets = ([(cached_potential(source), source)], [(-cached_potential(target), target)])
+    sign = (1, -1)
+    expand = (successors, predecessors)
+    best, meeting = math.inf, None
+
+    while True:
+        for side in (0, 1):
+            heap = open_sets[side]
+            while heap and heap[0][1] in closed[side]:
+                heapq.heappop(heap)
+        if not open_sets[0] or not open_sets[1]:
+            break
+        if open_sets[0][0][0] + open_sets[1][0][0] >= best:
+            break
+
+        side = 0 if open_sets[0][0][0] <= open_sets[1][0][0] else 1
+        _, current = heapq.heappop(open_sets[side])
+        closed[side].add(current)
+        g_side, g_other = g_score[side], g_score[1 - side]
+        g_current = g_side[current]
+
+        for neighbor, weight in expand[side](current):
+            if neighbor in closed[side]:
+                continue
+            tentative = g_current + weight
+            if tentative < g_side.get(neighbor, math.inf):
+                g_side[neighbor] = tentative
+                parent[side][neighbor] = current
+                heapq.heappush(open_sets[side], (tentative + sign[side] * cached_potential(neighbor), neighbor))
+            if neighbor in g_other and g_side[neighbor] + g_other[neighbor] < best:
+                best = g_side[neighbor] + g_other[neighbor]
+                meeting = neighbor
+
+    logging.debug(f"A* hai chiều duyệt {len(closed[0]) + len(closed[1])} node")
+    if meeting is None:
+        return []
+
+    path = []
+    node = meeting
+    while node is not None:
+        path.append(node)
+        node = parent[0][node]
+    path.reverse()
+    node = parent[1][meeting]
+    while node is not None:
+        path.append(node)
+        node = parent[1][node]
+    return path
@@ -0,0 +1,123 @@
+import math
+import logging
+from collections import defaultdict
+from edge_geometry import edge_polyline
+
+# Kích thước ô lưới mặc định (độ), khoảng 110 m theo vĩ độ
+DEFAULT_CELL_SIZE = 0.001
+
+# Số km tối thiểu trên một độ vĩ tuyến (lấy nhỏ hơn thực tế để cận dưới luôn an toàn)
+KM_PER_DEGREE_LOWER = 110.0
+
+class EdgeGridIndex:
+    """
+    Chỉ mục lưới đều trên các cạnh của đồ thị.
+    Mỗi cạnh được đăng ký vào mọi ô mà hộp bao của các đoạn thẳng của nó đi qua
+    (cạnh gộp chuỗi node bậc 2 là đường gấp khúc nhiều đoạn).
+    """
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)  # {(ix, iy): [thứ tự cạnh]}
+        self.edges = []  # [(u, v)] theo thứ tự duyệt G.edges()
+        self.extra_edges = []  # Cạnh thêm sau khi xây chỉ mục (không nằm trong lưới)
+
+    @classmethod
+    def from_graph(cls, G, cell_size=DEFAULT_CELL_SIZE):
+        index = cls(cell_size)
+        nodes = G.nodes
+        for u, v, data in G.edges(data=True):
+            if 'geometry' in data:
+                index.add_polyline(u, v, edge_polyline(G, u, v, data))
+            else:
+                index.add_segment(u, v, nodes[u]['lat'], nodes[u]['lon'], nodes[v]['lat'], nodes[v]['lon'])
+        logging.info(f"Đã xây chỉ mục lưới cho {len(index.edges)} cạnh trên {len(index.cells)} ô (ô {cell_size}°)")
+        return index
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def add_segment(self, u, v, lat1, lon1, lat2, lon2):
+        ordinal = len(self.edges)
+        self.edges.append((u, v))
+        ix1, iy1 = self._cell(min(lat1, lat2), min(lon1, lon2))
+        ix2, iy2 = self._cell(max(lat1, lat2), max(lon1, lon2))
+        for ix in range(ix1, ix2 + 1):
+            for iy in range(iy1, iy2 + 1):
+                self.cells[(ix, iy)].append(ordinal)
+
+    def add_polyline(self, u, v, points):
+        """Đăng ký cạnh (u, v) có hình học là dãy điểm (lat, lon), mỗi ô một lần."""
+        ordinal = len(self.edges)
+        self.edges.append((u, v))
+        cells = set()
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            ix1, iy1 = self._cell(min(lat1, lat2), min(lon1, lon2))
+            ix2, iy2 = self._cell(max(lat1, lat2), max(lon1, lon2))
+            for ix in range(ix1, ix2 + 1):
+                for iy in range(iy1, iy2 + 1):
+                    if (ix, iy) not in cells:
+                        cells.add((ix, iy))
+                        self.cells[(ix, iy)].append(ordinal)
+
+    def with_extra_edges(self, edges):
+        """
+        Trả về chỉ mục mới dùng chung lưới nhưng có thêm các cạnh phụ (ví dụ cạnh tách tại node ảo).
+        Không sao chép lưới.
+        """
+        derived = EdgeGridIndex.__new__(EdgeGridIndex)
+        derived.cell_size = self.cell_size
+        derived.cells = self.cells
+        derived.edges = self.edges
+        derived.extra_edges = self.extra_edges + list(edges)
+        return derived
+
+    def _ring(self, ix0, iy0, k):
+        if k == 0:
+            yield ix0, iy0
+            return
+        for iy in range(iy0 - k, iy0 + k + 1):
+            yield ix0 - k, iy
+            yield ix0 + k, iy
+        for ix in range(ix0 - k + 1, ix0 + k):
+            yield ix, iy0 - k
+            yield ix, iy0 + k
+
+    def nearest(self, lat, lon, measure, max_distance_km):
+        """
+        Tìm cạnh gần nhất với (lat, lon) bằng cách mở rộng dần các vòng ô quanh điểm.
+        measure(u, v) trả về tuple (khoảng cách km, ...) hoặc None nếu bỏ qua cạnh.
+        Trả về kết quả của measure cho cạnh gần nhất trong max_distance_km, hoặc None.
+        Khi khoảng cách bằng nhau, cạnh đứng trước trong thứ tự G.edges() được chọn.
+        """
+        # Cận dưới (km) cho khoảng cách tới một ô cách k vòng, an toàn cho cả kinh độ
+        max_lat = min(89.0, abs(lat) + max_distance_km / KM_PER_DEGREE_LOWER)
+        km_per_cell = self.cell_size * KM_PER_DEGREE_LOWER * math.cos(math.radians(max_lat))
+        max_ring = int(max_distance_km / km_per_cell) + 1
+
+        ix0, iy0 = self._cell(lat, lon)
+        best = None  # (dist, thứ tự, kết quả)
+        seen = set()
+        for k in range(max_ring + 1):
+            if best is not None and (k - 1) * km_per_cell > best[0]:
+                break
+            for cell in self._ring(ix0, iy0, k):
+                for ordinal in self.cells.get(cell, ()):
+                    if ordinal in seen:
+                        continue
+                    seen.add(ordinal)
+                    result = measure(*self.edges[ordinal])
+                    if result is None or result[0] > max_distance_km:
+                        continue
+                    if best is None or (result[0], ordinal) < (best[0], best[1]):
+                        best = (result[0], ordinal, result)
+
+        # Cạnh phụ ít nên duyệt hết
+        for offset, (u, v) in enumerate(self.extra_edges):
+            result = measure(u, v)
+            if result is None or result[0] > max_distance_km:
+                continue
+            ordinal = len(self.edges) + offset
+            if best is None or (result[0], ordinal) < (best[0], best[1]):
+                best = (result[0], ordinal, result)
+
+        return best[2] if best else None
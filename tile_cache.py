@@ -0,0 +1,184 @@
+import os
+import math
+import time
+import sqlite3
+import pathlib
+import logging
+import argparse
+import threading
+import urllib.request
+import urllib.error
+
+# Thiết lập logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TILE_CACHE_FILE = os.path.join(BASE_DIR, 'map_tiles.mbtiles')
+ASSETS_DIR = os.path.join(BASE_DIR, 'map_assets')
+TILE_URL = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'
+LEAFLET_VERSION = '1.9.4'
+LEAFLET_URL = 'https://unpkg.com/leaflet@{version}/dist/{name}'
+LEAFLET_FILES = ('leaflet.js', 'leaflet.css',
+                 'images/marker-icon.png', 'images/marker-icon-2x.png', 'images/marker-shadow.png',
+                 'images/layers.png', 'images/layers-2x.png')
+# Chính sách dùng tile của OSM yêu cầu User-Agent nhận diện được ứng dụng
+USER_AGENT = 'Map-App/1.0 (offline tile prefetch)'
+# Vùng bản đồ cố định của ứng dụng (khu Kim Liên) và mức zoom cửa sổ bản đồ dùng
+MAP_BBOX = (21.0001700, 105.8287500, 21.0111400, 105.8382700)
+MAP_ZOOMS = (18,)
+
+def tile_xy(lat, lon, zoom):
+    """Chỉ số tile (x, y) kiểu slippy map chứa điểm (lat, lon) ở mức zoom."""
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_range(bbox, zoom):
+    """Các tile (x, y) phủ hộp (min_lat, min_lon, max_lat, max_lon) ở mức zoom."""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    x0, y0 = tile_xy(max_lat, min_lon, zoom)
+    x1, y1 = tile_xy(min_lat, max_lon, zoom)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+class TileCache:
+    """
+    Kho tile dạng MBTiles (SQLite): bảng tiles theo lược đồ TMS (hàng đếm từ dưới lên)
+    và bảng metadata. Dùng chung một kết nối, khóa để đọc được từ nhiều luồng.
+    """
+    def __init__(self, path=TILE_CACHE_FILE, readonly=False):
+        self.path = path
+        if readonly:
+            # URI mã hóa đúng đường dẫn có ký tự đặc biệt (?, #, %)
+            uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                                  tile_data BLOB,
+                                                  PRIMARY KEY (zoom_level, tile_column, tile_row));
+            """)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open_existing(cls, path=TILE_CACHE_FILE):
+        """Mở kho chỉ đọc nếu file đã tồn tại, ngược lại trả về None."""
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path, readonly=True)
+        except sqlite3.Error as e:
+            logging.warning(f"Không mở được kho tile {path}: {e}")
+            return None
+
+    @staticmethod
+    def _row(zoom, y):
+        return (1 << zoom) - 1 - y
+
+    def get(self, zoom, x, y):
+        """Dữ liệu PNG của tile (z, x, y) theo đánh số slippy map, None nếu chưa có."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x, self._row(zoom, y))).fetchone()
+        return bytes(row[0]) if row else None
+
+    def has(self, zoom, x, y):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x, self._row(zoom, y))).fetchone() is not None
+
+    def put(self, zoom, x, y, data):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (zoom, x, self._row(zoom, y), data))
+
+    def set_metadata(self, **values):
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                                  [(name, str(value)) for name, value in values.items()])
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+def _download(url, timeout=30):
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+def prefetch_tiles(cache, bbox=MAP_BBOX, zooms=MAP_ZOOMS, url=TILE_URL, delay=0.05, refresh=False):
+    """
+    Tải trước các tile phủ bbox ở các mức zoom vào kho (bỏ qua tile đã có trừ khi refresh).
+    delay giãn cách các request để tôn trọng giới hạn của máy chủ tile.
+    Trả về (số tile tải mới, số tile đã có, số tile lỗi).
+    """
+    downloaded = existing = failed = 0
+    for zoom in zooms:
+        tiles = tile_range(bbox, zoom)
+        logging.info(f"Zoom {zoom}: {len(tiles)} tile")
+        for x, y in tiles:
+            if not refresh and cache.has(zoom, x, y):
+                existing += 1
+                continue
+            try:
+                cache.put(zoom, x, y, _download(url.format(z=zoom, x=x, y=y)))
+                downloaded += 1
+            except (urllib.error.URLError, OSError) as e:
+                logging.warning(f"Không tải được tile {zoom}/{x}/{y}: {e}")
+                failed += 1
+            if downloaded and downloaded % 100 == 0:
+                cache.commit()
+            time.sleep(delay)
+    min_lat, min_lon, max_lat, max_lon = bbox
+    cache.set_metadata(name='Map-App', format='png', type='baselayer',
+                       bounds=f"{min_lon},{min_lat},{max_lon},{max_lat}",
+                       minzoom=min(zooms), maxzoom=max(zooms))
+    cache.commit()
+    logging.info(f"Đã tải {downloaded} tile, {existing} tile có sẵn, {failed} tile lỗi ({len(cache)} tile trong kho)")
+    return downloaded, existing, failed
+
+def fetch_leaflet_assets(assets_dir=ASSETS_DIR, version=LEAFLET_VERSION, refresh=False):
+    """Tải bộ Leaflet (JS, CSS, ảnh marker) vào assets_dir để trang bản đồ không cần mạng."""
+    for name in LEAFLET_FILES:
+        path = os.path.join(assets_dir, *name.split('/'))
+        if os.path.exists(path) and not refresh:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = _download(LEAFLET_URL.format(version=version, name=name))
+        with open(path, 'wb') as f:
+            f.write(data)
+        logging.info(f"Đã tải {name} ({len(data)} byte)")
+    with open(os.path.join(assets_dir, 'VERSION'), 'w', encoding='utf-8') as f:
+        f.write(version + '\n')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Tải trước tile bản đồ và Leaflet để ứng dụng chạy không cần mạng")
+    parser.add_argument('--bbox', nargs=4, type=float, default=MAP_BBOX,
+                        metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'), help="Vùng cần tải (mặc định vùng bản đồ của ứng dụng)")
+    parser.add_argument('--zoom', type=int, nargs='+', default=list(MAP_ZOOMS), help="Các mức zoom cần tải")
+    parser.add_argument('-o', '--output', default=TILE_CACHE_FILE, help="File MBTiles")
+    parser.add_argument('--url', default=TILE_URL, help="Mẫu URL máy chủ tile")
+    parser.add_argument('--delay', type=float, default=0.05, help="Giãn cách giữa các request (giây)")
+    parser.add_argument('--refresh', action='store_true', help="Tải lại cả tile và tệp Leaflet đã có")
+    parser.add_argument('--no-assets', action='store_true', help="Không tải bộ Leaflet")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.no_assets:
+        fetch_leaflet_assets(refresh=args.refresh)
+    cache = TileCache(args.output)
+    try:
+        prefetch_tiles(cache, tuple(args.bbox), args.zoom, args.url, args.delay, args.refresh)
+    finally:
+        cache.close()
@@ -0,0 +1,95 @@
+import time
+import logging
+import itertools
+import weakref
+import mysql.connector
+
+# Bộ đếm phiên bản trạng thái giao thông
+_versions = itertools.count(1)
+
+class TrafficSnapshot:
+    """
+    Ảnh chụp bảng traffic_changes trong bộ nhớ: {way_id: traffic_type}.
+    Được tải bằng một truy vấn duy nhất và dùng lại cho nhiều lần tìm đường.
+    """
+    def __init__(self, traffic_types):
+        self.traffic_types = traffic_types
+        self.loaded_at = time.monotonic()
+        self.version = next(_versions)  # Tăng mỗi khi nội dung traffic_changes thay đổi
+        # Bộ nhớ đệm {chỉ mục way: {hệ số phạt: kết quả}}; khóa yếu theo chính đối tượng chỉ mục
+        # (không theo id()) để đồ thị tải lại tại cùng địa chỉ không nhận nhầm kết quả của đồ thị cũ
+        self._edge_effects = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def load(cls, db_config):
+        conn = mysql.connector.connect(**db_config)
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("SELECT way_id, traffic_type FROM traffic_changes")
+            traffic_types = {}
+            for row in cursor.fetchall():
+                # Giữ bản ghi đầu tiên của mỗi way như truy vấn fetchone() trước đây
+                traffic_types.setdefault(str(row['way_id']), row['traffic_type'])
+            cursor.close()
+        finally:
+            conn.close()
+        logging.info(f"Đã tải trạng thái giao thông của {len(traffic_types)} way")
+        return cls(traffic_types)
+
+    def traffic_type(self, way_id):
+        if way_id is None:
+            return None
+        return self.traffic_types.get(str(way_id))
+
+    def edge_effects(self, way_index, penalty_factors):
+        """
+        Trả về ({(u, v): hệ số phạt}, [(u, v) bị cấm]) cho các cạnh của đồ thị gốc
+        thuộc các way có trong ảnh chụp. Chi phí O(số cạnh bị ảnh hưởng).
+        """
+        key = tuple(sorted(penalty_factors.items()))
+        cached = self._edge_effects.setdefault(way_index, {}).get(key)
+        if cached is not None:
+            return cached
+
+        penalized = {}
+        closed = []
+        for way_id, traffic_type in self.traffic_types.items():
+            edges = way_index.edges_of(way_id)
+            if traffic_type == 'closed':
+                closed.extend(edges)
+            elif traffic_type in penalty_factors:
+                penalty = penalty_factors[traffic_type]
+                for edge in edges:
+                    penalized[edge] = penalty
+
+        self._edge_effects[way_index][key] = (penalized, closed)
+        return penalized, closed
+
+# Ảnh chụp dùng chung trong tiến trình, theo cấu hình CSDL
+_snapshots = {}
+
+def get_traffic_snapshot(db_config, max_age=30.0):
+    """
+    Lấy ảnh chụp giao thông, chỉ truy vấn lại CSDL khi ảnh chụp cũ hơn max_age giây
+    hoặc đã bị invalidate. Trả về None nếu chưa từng tải được.
+    """
+    key = tuple(sorted(db_config.items()))
+    snapshot = _snapshots.get(key)
+    if snapshot is not None and time.monotonic() - snapshot.loaded_at < max_age:
+        return snapshot
+    try:
+        previous = snapshot
+        snapshot = TrafficSnapshot.load(db_config)
+        # Tải lại theo thời hạn mà nội dung không đổi thì giữ phiên bản cũ
+        if previous is not None and previous.traffic_types == snapshot.traffic_types:
+            snapshot.version = previous.version
+        _snapshots[key] = snapshot
+    except mysql.connector.Error as err:
+        logging.error(f"Lỗi tải traffic_changes: {err}")
+        if snapshot is not None:
+            logging.warning("Dùng lại ảnh chụp giao thông cũ")
+    return snapshot
+
+def invalidate_traffic_snapshot():
+    """Bỏ các ảnh chụp hiện có, gọi sau khi ghi vào traffic_changes."""
+    _snapshots.clear()
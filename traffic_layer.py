@@ -0,0 +1,87 @@
+import json
+import logging
+
+# Màu tô đoạn đường theo trạng thái giao thông
+TRAFFIC_COLORS = {'slow': '#FFA500', 'blocked': 'red', 'closed': 'black'}
+
+# Lớp Leaflet chung cho mọi đoạn đường được tô (chèn vào trang bản đồ khi tạo).
+# window.highlightedWays[way_id] trỏ tới layer con của từng way để xóa riêng lẻ.
+TRAFFIC_LAYER_JS = """
+window.highlightedWays = window.highlightedWays || {};
+window.trafficLayer = L.geoJSON(null, {
+    style: function(feature) {
+        return {color: feature.properties.color, weight: 5, opacity: 0.8};
+    },
+    onEachFeature: function(feature, layer) {
+        var wayId = feature.properties.way_id;
+        if (window.highlightedWays[wayId]) {
+            window.trafficLayer.removeLayer(window.highlightedWays[wayId]);
+        }
+        window.highlightedWays[wayId] = layer;
+    }
+}).addTo(map);
+window.showTrafficWays = function(collection) {
+    window.trafficLayer.addData(collection);
+    return collection.features.length;
+};
+window.removeTrafficWay = function(wayId) {
+    if (window.highlightedWays[wayId]) {
+        window.trafficLayer.removeLayer(window.highlightedWays[wayId]);
+        delete window.highlightedWays[wayId];
+    }
+};
+"""
+
+def traffic_feature(way_id, coords, traffic_type):
+    """Feature GeoJSON của một đoạn đường; coords là [[lat, lon], ...] như lưu trong traffic_changes."""
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat, lon in coords]},
+        'properties': {'way_id': str(way_id), 'traffic_type': traffic_type,
+                       'color': TRAFFIC_COLORS.get(traffic_type, 'red')},
+    }
+
+def build_traffic_collection(rows, skip=()):
+    """
+    Gom các dòng traffic_changes (way_id, coordinates JSON, traffic_type) thành một FeatureCollection.
+    Mỗi way lấy dòng đầu tiên; bỏ qua way trong skip (đã tô).
+    Trả về (FeatureCollection, {way_id: lý do} của các dòng không dùng được).
+    """
+    features = []
+    failures = {}
+    seen = set(str(way_id) for way_id in skip)
+    for row in rows:
+        way_id = str(row['way_id'])
+        if way_id in seen:
+            continue
+        try:
+            coords = json.loads(row['coordinates'])
+        except (TypeError, json.JSONDecodeError) as e:
+            failures[way_id] = f"JSON không hợp lệ: {e}"
+            continue
+        if not (isinstance(coords, list) and len(coords) >= 2
+                and all(isinstance(c, list) and len(c) == 2 for c in coords)):
+            failures[way_id] = "tọa độ không hợp lệ"
+            continue
+        seen.add(way_id)
+        features.append(traffic_feature(way_id, coords, row['traffic_type']))
+    return {'type': 'FeatureCollection', 'features': features}, failures
+
+def show_traffic_script(collection):
+    """Một lệnh JavaScript duy nhất vẽ cả FeatureCollection vào lớp giao thông."""
+    return f"window.showTrafficWays({json.dumps(collection)});"
+
+def render_traffic_rows(page, rows, skip=()):
+    """
+    Tô các đoạn đường trong rows lên trang bản đồ (QWebEnginePage) bằng một lần gọi
+    runJavaScript. Trả về (danh sách way_id đã gửi, {way_id: lý do} của các dòng lỗi).
+    """
+    collection, failures = build_traffic_collection(rows, skip)
+    way_ids = [feature['properties']['way_id'] for feature in collection['features']]
+    if way_ids:
+        page.runJavaScript(show_traffic_script(collection),
+                           lambda count: logging.debug(f"Bản đồ đã vẽ {count} đoạn đường giao thông"))
+    logging.info(f"Tô {len(way_ids)} đoạn đường giao thông trong một lần gọi, {len(failures)} dòng lỗi")
+    if failures:
+        logging.warning(f"Không tô được các way: {failures}")
+    return way_ids, failures
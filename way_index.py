@@ -0,0 +1,98 @@
+import json
+import logging
+from collections import defaultdict
+
+def edge_way_id(data, way_table=None):
+    """
+    Lấy way_id (chuỗi) từ thuộc tính cạnh: qua số dòng 'way' trong bảng way nếu có,
+    ngược lại giải mã JSON tags (đồ thị cũ). None nếu cạnh không gắn với way nào.
+    """
+    row = data.get('way')
+    if row is not None and way_table is not None:
+        return way_table.way_id(row)
+    try:
+        way_id = json.loads(data['tags']).get('id')
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return None
+    return str(way_id) if way_id is not None else None
+
+class WayIndex:
+    """
+    Chỉ mục way_id <-> cạnh, xây một lần khi tải đồ thị để không phải
+    tra thuộc tính của từng cạnh trong mỗi lần tìm đường.
+    """
+    def __init__(self):
+        self.edge_way = {}  # {(u, v): way_id}
+        self.way_edges = defaultdict(list)  # {way_id: [(u, v)]}
+        self.way_nodes = {}  # {way_id: [node]} theo thứ tự dọc way
+
+    @classmethod
+    def from_graph(cls, G):
+        index = cls()
+        way_table = G.graph.get('way_table')
+        for u, v, data in G.edges(data=True):
+            way_id = edge_way_id(data, way_table)
+            if way_id is None:
+                logging.warning(f"Cạnh ({u}, {v}) không gắn với way nào")
+                continue
+            index.edge_way[(u, v)] = way_id
+            index.way_edges[way_id].append((u, v))
+        for way_id, edges in index.way_edges.items():
+            index.way_nodes[way_id] = order_way_nodes(edges)
+        logging.info(f"Đã xây chỉ mục cho {len(index.way_edges)} way, {len(index.edge_way)} cạnh")
+        return index
+
+    def way_of(self, u, v):
+        return self.edge_way.get((u, v))
+
+    def edges_of(self, way_id):
+        return self.way_edges.get(str(way_id), [])
+
+    def nodes_of(self, way_id):
+        return self.way_nodes.get(str(way_id), [])
+
+def order_way_nodes(edges):
+    """
+    Dựng lại dãy node theo thứ tự của way OSM từ các cạnh của nó: đi dọc chuỗi đoạn thẳng,
+    bắt đầu từ một đầu mút (với đường một chiều là đầu không có cạnh đi vào).
+    Way bị cắt thành nhiều đoạn (ngoài bbox) được nối tiếp nhau; way khép kín lặp lại node đầu.
+    """
+    directed = set(edges)
+    neighbors = {}
+    unused = set()
+    for u, v in edges:
+        pair = frozenset((u, v))
+        if len(pair) < 2 or pair in unused:
+            continue
+        unused.add(pair)
+        neighbors.setdefault(u, []).append(v)
+        neighbors.setdefault(v, []).append(u)
+
+    def remaining(node):
+        return sum(1 for w in neighbors[node] if frozenset((node, w)) in unused)
+
+    def is_start(node):
+        # Không có cạnh một chiều nào đi vào node
+        return all((w, node) not in directed or (node, w) in directed
+                   for w in neighbors[node] if frozenset((node, w)) in unused)
+
+    sequence = []
+    while unused:
+        candidates = [node for node in neighbors if remaining(node) > 0]
+        odd = [node for node in candidates if remaining(node) % 2 == 1]
+        start = next((node for node in odd if is_start(node)), None)
+        if start is None:
+            start = next((node for node in candidates if is_start(node)), candidates[0])
+        current = start
+        sequence.append(current)
+        while True:
+            options = [w for w in neighbors[current] if frozenset((current, w)) in unused]
+            if not options:
+                break
+            # Ưu tiên đi theo chiều của cạnh (đường một chiều)
+            following = [w for w in options if (current, w) in directed]
+            nxt = following[0] if following else options[0]
+            unused.discard(frozenset((current, nxt)))
+            sequence.append(nxt)
+            current = nxt
+    return sequence
@@ -0,0 +1,145 @@
+import json
+import logging
+from array import array
+
+# Các cột chuỗi được intern trong bảng way
+STRING_COLUMNS = ('highway', 'maxspeed', 'name')
+
+class WayTable:
+    """
+    Bảng thuộc tính way dạng cột: mỗi way một dòng với highway, maxspeed, oneway và name.
+    Chuỗi được intern vào một bảng chung (mã 0 là chuỗi rỗng / không có tag);
+    mỗi cạnh của đồ thị chỉ lưu số dòng 'way' thay cho chuỗi JSON tags.
+    """
+    def __init__(self):
+        self.way_ids = []  # [way_id (chuỗi)] theo dòng
+        self.strings = ['']  # Bảng chuỗi intern
+        self.highway_codes = array('i')
+        self.maxspeed_codes = array('i')
+        self.name_codes = array('i')
+        self.oneway_flags = bytearray()
+        self._row_of = {}  # {way_id: dòng}
+        self._code_of = {'': 0}
+
+    def _intern(self, value):
+        if value is None:
+            return 0
+        code = self._code_of.get(value)
+        if code is None:
+            code = self._code_of[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def add_way(self, tags):
+        """Thêm way từ dict tags OSM (có khóa 'id'), trả về số dòng. Way đã có thì trả về dòng cũ."""
+        way_id = str(tags['id'])
+        row = self._row_of.get(way_id)
+        if row is not None:
+            return row
+        row = self._row_of[way_id] = len(self.way_ids)
+        self.way_ids.append(way_id)
+        self.highway_codes.append(self._intern(tags.get('highway')))
+        self.maxspeed_codes.append(self._intern(tags.get('maxspeed')))
+        self.name_codes.append(self._intern(tags.get('name')))
+        self.oneway_flags.append(1 if tags.get('oneway', 'no') == 'yes' else 0)
+        return row
+
+    def set_way(self, tags):
+        """Như add_way nhưng ghi đè thuộc tính nếu way đã có (cập nhật từ file thay đổi OSM)."""
+        way_id = str(tags['id'])
+        row = self._row_of.get(way_id)
+        if row is None:
+            return self.add_way(tags)
+        self.highway_codes[row] = self._intern(tags.get('highway'))
+        self.maxspeed_codes[row] = self._intern(tags.get('maxspeed'))
+        self.name_codes[row] = self._intern(tags.get('name'))
+        self.oneway_flags[row] = 1 if tags.get('oneway', 'no') == 'yes' else 0
+        return row
+
+    def tags(self, row):
+        """Dựng lại dict tags (các tag đã lưu) của một dòng, dùng khi tính lại cạnh của way."""
+        tags = {'id': self.way_ids[row], 'oneway': 'yes' if self.oneway(row) else 'no'}
+        for key in STRING_COLUMNS:
+            value = getattr(self, key)(row)
+            if value is not None:
+                tags[key] = value
+        return tags
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    def row_of(self, way_id):
+        return self._row_of.get(str(way_id))
+
+    def way_id(self, row):
+        return self.way_ids[row]
+
+    def highway(self, row):
+        return self.strings[self.highway_codes[row]] or None
+
+    def maxspeed(self, row):
+        return self.strings[self.maxspeed_codes[row]] or None
+
+    def name(self, row):
+        return self.strings[self.name_codes[row]] or None
+
+    def oneway(self, row):
+        return bool(self.oneway_flags[row])
+
+    def to_json(self):
+        """Chuỗi JSON các cột, lưu làm thuộc tính đồ thị trong file GraphML."""
+        return json.dumps({
+            'way_ids': self.way_ids,
+            'strings': self.strings,
+            'highway': self.highway_codes.tolist(),
+            'maxspeed': self.maxspeed_codes.tolist(),
+            'name': self.name_codes.tolist(),
+            'oneway': list(self.oneway_flags),
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_columns(cls, way_ids, strings, highway, maxspeed, name, oneway):
+        table = cls()
+        table.way_ids = list(way_ids)
+        table.strings = list(strings)
+        table.highway_codes = array('i', highway)
+        table.maxspeed_codes = array('i', maxspeed)
+        table.name_codes = array('i', name)
+        table.oneway_flags = bytearray(oneway)
+        table._row_of = {way_id: row for row, way_id in enumerate(table.way_ids)}
+        table._code_of = {value: code for code, value in enumerate(table.strings)}
+        return table
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls.from_columns(data['way_ids'], data['strings'], data['highway'],
+                                data['maxspeed'], data['name'], data['oneway'])
+
+def ensure_way_table(G):
+    """
+    Đảm bảo G.graph['way_table'] là WayTable và mọi cạnh có thuộc tính 'way' (số dòng).
+    Đồ thị cũ chỉ có JSON tags trên cạnh được chuyển đổi một lần khi tải.
+    """
+    table = G.graph.get('way_table')
+    if isinstance(table, WayTable):
+        return table
+    if isinstance(table, str):
+        table = G.graph['way_table'] = WayTable.from_json(table)
+        return table
+
+    table = WayTable()
+    converted = 0
+    for u, v, data in G.edges(data=True):
+        try:
+            tags = json.loads(data['tags'])
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logging.warning(f"Cạnh ({u}, {v}) có tags không hợp lệ: {data.get('tags')}")
+            continue
+        if tags.get('id') is None:
+            continue
+        data['way'] = table.add_way(tags)
+        converted += 1
+    G.graph['way_table'] = table
+    logging.info(f"Đã chuyển tags của {converted} cạnh sang bảng {len(table)} way")
+    return table